@@ -0,0 +1 @@
+../../src/gae_bingo/alternative_selection.py
\ No newline at end of file
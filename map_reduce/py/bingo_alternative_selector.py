@@ -1,118 +1,169 @@
 #!/usr/bin/env python
 
-"""A reducer script that reads the identity of a user CROSS JOINed with
-all the alternative values for an experiment and determines which alternative
-bucket the user belongs to.
+"""A streaming script that determines which alternative bucket each bingo
+identity belongs to, for one or many experiments.
 
 Input:
-    Rows with tab delimited column values of
-    [bingo_identity, participating_tests,
-        canonical_name, hashable_name, alternative_name, alternative_weight].
-
-    Note that every single row will have the same canonical_name and
-    hashable_name value, as this reducer is intended to analyze a single test.
+    Rows with tab (or \\x01) delimited column values of
+    [bingo_identity, participating_tests]
+    where participating_tests is the json list of experiment names from the
+    identity's GAEBingoIdentityRecord.
+
+Side file (-a):
+    The alternatives of the experiments to assign, with tab or \\x01
+    delimited column values of
+    [canonical_name, hashable_name, alternative_name, alternative_weight,
+     alternative_number]
+    as in bingo_alternative_infop.
 
 Output:
-    For each experiment a user is in, emits
+    For each experiment in the side file a user is in, emits
     [bingo_identity, canonical_name, alternative_name]
     for the alternative_name that the user belongs in. Users who are not
-    participating in the test are ignored.
+    participating in an experiment are ignored for it.
+
+Identities are hashed in batches, and the hashes are reduced to
+alternatives with numpy.  The hashing and the alternative table come from
+gae_bingo's alternative_selection module, the same code gae_bingo's
+modulo_choose uses, so the two always agree.  alternative_selection.py in
+this directory is a symlink to it, so deploy.py uploads it next to this
+script, and user_experiment_info.q ships both.
 """
 
-import hashlib
+import collections
 import json
+import optparse
+import re
 import sys
 
+import numpy as np
 
-def main():
-
-    current_bingo_identity = None
-    current_user_tests = None
-    current_alternatives = None  # ordered tuples of (alt_name, weight)
+import alternative_selection
 
-    canonical_name = None
-    hashable_name = None
 
-    for line in sys.stdin:
-        (bingo_identity, participating_tests,
-                canonical_name, hashable_name, alternative_name, weight,
-                alternative_number) = (
-                        line.rstrip('\n').split('\t'))
-
-        if bingo_identity != current_bingo_identity:
-            if current_bingo_identity:
-                emit_alternative_for_user(
-                        current_bingo_identity,
-                        canonical_name,
-                        hashable_name,
-                        current_alternatives)
-
-            current_bingo_identity = bingo_identity
-
-            # participating_tests is a list of test names in the form of
-            # "some canonical name (conversion name)". We only care about the
-            # canonical name here.
-            parsed_tests = json.loads(participating_tests)
-            current_user_tests = set([t.rsplit('(', 1)[0].strip()
-                                      for t in parsed_tests])
-            current_alternatives = []
+# use a field delimiter that works in or outside of Hive
+_FIELD_SPLIT = re.compile('[\t\x01]')
 
-        if canonical_name not in current_user_tests:
-            continue
 
-        current_alternatives.append((alternative_name, long(weight),
-                                      alternative_number))
+class Experiment(object):
+    """The alternatives of one experiment, and identities waiting for them."""
 
-    if current_bingo_identity:
-        emit_alternative_for_user(
-                current_bingo_identity,
-                canonical_name,
-                hashable_name,
-                current_alternatives)
+    def __init__(self, canonical_name, hashable_name):
+        self.canonical_name = canonical_name
+        self.hashable_name = hashable_name
+        self.alternatives = []  # (number, name, weight)
+        self.table = None
+        self.pending = []
 
+    def add_alternative(self, number, name, weight):
+        self.alternatives.append((number, name, weight))
 
-def emit_alternative_for_user(
-            bingo_identity, canonical_name, hashable_name, alternatives):
-    """Determines the experiment alternative for the given user and prints it.
+    def build_table(self):
+        # gae_bingo lists alternatives by number, which also decides how
+        # equally weighted alternatives are ordered in the table.
+        self.alternatives.sort()
+        self.names = [name for (number, name, weight) in self.alternatives]
+        self.table = alternative_selection.SelectionTable(
+                [weight for (number, name, weight) in self.alternatives])
+        self.lows = np.array(self.table.lows, dtype=np.uint64)
+        self.positions = np.array(self.table.positions)
 
-    This *must* be consistent with modulo_choose in gae_bingo.py.
-    """
 
-    if not alternatives:
-        # No alternative info - user must not be participating in the test.
+def load_experiments(alternatives_file):
+    """Read the side file into a dict of canonical_name to Experiment."""
+    experiments = collections.OrderedDict()
+    for line in alternatives_file:
+        line = line.rstrip('\n')
+        if not line:
+            continue
+        (canonical_name, hashable_name, alternative_name, weight,
+                number) = _FIELD_SPLIT.split(line)
+        if canonical_name not in experiments:
+            experiments[canonical_name] = Experiment(canonical_name,
+                                                     hashable_name)
+        experiments[canonical_name].add_alternative(
+                int(number), alternative_name, long(weight))
+
+    for experiment in experiments.itervalues():
+        experiment.build_table()
+    return experiments
+
+
+def hash_indexes(table, hashable_name, identities):
+    """table.hash_index of each identity, as a numpy array."""
+    if table.total_weight >= 2 ** 32:
+        # The products below could overflow 64 bits
+        return np.array([table.hash_index(hashable_name, i)
+                         for i in identities], dtype=np.uint64)
+
+    words = np.array([alternative_selection.digest_words(hashable_name, i)
+                      for i in identities], dtype=np.uint64).reshape((-1, 2))
+    total_weight = np.uint64(table.total_weight)
+    high = words[:, 0] % total_weight
+    low = words[:, 1] % total_weight
+    return (high * np.uint64(table.high_word_multiplier) % total_weight +
+            low) % total_weight
+
+
+def assign(experiment, identities):
+    """The alternative name each of identities belongs to."""
+    indexes = hash_indexes(experiment.table, experiment.hashable_name,
+                           identities)
+    slots = np.searchsorted(experiment.lows, indexes, side='right') - 1
+    return [experiment.names[p] for p in experiment.positions[slots]]
+
+
+def flush(experiment):
+    if not experiment.pending:
         return
+    for identity, alternative_name in zip(
+            experiment.pending, assign(experiment, experiment.pending)):
+        print "\t".join([identity, experiment.canonical_name,
+                         alternative_name])
+    experiment.pending = []
 
-    alternatives_weight = sum([weight for (name, weight, num) in alternatives])
-
-    sig = hashlib.md5(hashable_name + str(bingo_identity)).hexdigest()
-    sig_num = int(sig, base=16)
-    index_weight = sig_num % alternatives_weight
 
-    current_weight = alternatives_weight
-    selected_alternative = None
-
-    # Sorting by weight and then number keeps the sort stable.
-    # We sort by name last, which keeps the sort stable for records
-    # created before the number was created.
-    for alternative, weight, num in sorted(alternatives,
-                                      key=lambda (name, weight, number):
-                                             (weight, number, name),
-                                      reverse=True):
-
-        current_weight -= weight
-        if index_weight >= current_weight:
-            selected_alternative = alternative
-            break
+def main():
+    parser = optparse.OptionParser(usage="%prog -a ALTERNATIVES_FILE",
+        description="Assign bingo identities read from stdin to the "
+                    "alternatives of the experiments in ALTERNATIVES_FILE.")
+    parser.add_option("-a", "--alternatives",
+        help="The side file of experiment alternatives (required).")
+    parser.add_option("-b", "--batch_size", type="int", default=10000,
+        help="Number of identities to hash at a time per experiment. "
+             "Defaults to 10000.")
+    options, _ = parser.parse_args()
+
+    if not options.alternatives:
+        parser.error("-a ALTERNATIVES_FILE is required")
+
+    with open(options.alternatives) as f:
+        experiments = load_experiments(f)
 
-    if selected_alternative is None:
-        # TODO(benkomalo): log error.
-        return
+    for line in sys.stdin:
+        bingo_identity, participating_tests = _FIELD_SPLIT.split(
+                line.rstrip('\n'))[:2]
 
-    print "\t".join([
-            bingo_identity,
-            canonical_name,
-            selected_alternative
-            ])
+        # participating_tests is a list of test names in the form of
+        # "some canonical name (conversion name)". We only care about the
+        # canonical name here.
+        try:
+            parsed_tests = json.loads(participating_tests)
+        except ValueError:
+            continue
+        user_tests = set([t.rsplit('(', 1)[0].strip()
+                          for t in parsed_tests or []])
+
+        for canonical_name in user_tests:
+            experiment = experiments.get(canonical_name)
+            if experiment is None or not experiment.table.total_weight:
+                continue
+            experiment.pending.append(bingo_identity)
+            if len(experiment.pending) >= options.batch_size:
+                flush(experiment)
+
+    for experiment in experiments.itervalues():
+        flush(experiment)
 
 
 if __name__ == '__main__':
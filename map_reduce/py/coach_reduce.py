@@ -3,10 +3,13 @@
 Map reduce transforms to compute values of student and teachers
 """
 
+import collections
 import sys
 import datetime
 import time
 
+import windowed_cohort
+
 date_format = '%Y-%m-%d'
 
 
@@ -74,14 +77,29 @@ def fill_counts(end_date):
     fill_value([str(current_count)], current_dt, end_date)
 
 
+# Students count as active for this many days after each day they're active
+WINDOW_DAYS = 28
+
+
+def emit_active_counts(rows, end_date, window, get_count):
+    """Emit get_count() for each day, given (key, dt) rows sorted by dt and
+    the SlidingWindow to count their keys in."""
+    day_numbers = windowed_cohort.DayNumbers(date_format)
+    windowed_cohort.emit_window_counts(
+        windowed_cohort.daily_keys(rows, day_numbers),
+        day_numbers.day(end_date), WINDOW_DAYS, window, get_count,
+        lambda day, count: emit_data_row([str(count)],
+                                         day_numbers.string(day)))
+
+
 def active_students(end_date, different_days):
     """Compute amount of active students.
     Active student is a user who performed an action
     as defined in user_daily_activity in last 28 days.
 
-    We have to keep record of last 28 days of user activities and when
-    computing number of active students for a given day make sure to count
-    each student only once.
+    Each student's number of active days in the window is kept up to date
+    as days enter and leave it, so each day takes time proportional to
+    that day's activity.
 
     Arguments:
       end_date - until which date compute the values
@@ -90,64 +108,19 @@ def active_students(end_date, different_days):
         Allows to see highly engaged users.
     """
 
-    student, current_dt = sys.stdin.readline().rstrip('\n').split('\t')
-    current_dt_obj = datetime.datetime.strptime(
-        current_dt, date_format).date()
-    last_28days = [{student: set([current_dt])}]
-    last_28dates = [current_dt_obj]
-
-    def get_active_students(dt):
-        """For given day compute number of active students.
-        Checks all dates for which there have been active
-            students in past 28 days"""
-
-        active_students = {}
-        for some_time in daterange(dt + datetime.timedelta(-28), dt):
-            if some_time in last_28dates:
-                idx = last_28dates.index(some_time)
-                active_students = dict(list(active_students.items()) +
-                    list(last_28days[idx].items()))
-        filtered_students = [student for student, days in
-            active_students.iteritems() if len(days) >= different_days]
-        emit_data_row([str(len(filtered_students))],
-            time.strftime(date_format, dt.timetuple()))
-
-    for line in sys.stdin:
-        student, dt = line.rstrip('\n').split('\t')
-        dt_obj = datetime.datetime.strptime(dt, date_format).date()
-
-        if dt_obj != current_dt_obj:
-            # Dates might not be consecutive, although they are sorted
-            [get_active_students(missing_date) for
-                missing_date in daterange(current_dt_obj, dt_obj)]
-
-            # Add placeholder for values for new date and
-            # remove oldest if there are more than 28
-            current_dt_obj = dt_obj
-            current_dt = dt
-            last_28dates.append(current_dt_obj)
-            last_28dates = last_28dates[-28:]
-            last_28days.append({})
-            last_28days = last_28days[-28:]
-
-        last_day_idx = len(last_28days) - 1
-        if student in last_28days[last_day_idx]:
-            last_28days[last_day_idx][student].add(current_dt)
-        else:
-            last_28days[last_day_idx][student] = set([current_dt])
-
-    # Fix for last date for which loop above will not do anything
-    end_date_obj = datetime.datetime.strptime(end_date, date_format).date()
-    [get_active_students(missing_date) for
-        missing_date in daterange(current_dt_obj, end_date_obj)]
+    rows = (line.rstrip('\n').split('\t') for line in sys.stdin)
+    window = windowed_cohort.SlidingWindow(different_days)
+    emit_active_counts(rows, end_date, window, lambda: window.num_active)
 
 
 def active_teachers(end_date, threshold, different_days):
     """Compute number of active teachers.
     Active teacher is a teacher with at least 10 active students.
 
-    Code is quite similiar to the one of active_student. However, it might
-    be better to keep it separate in case definition changes.
+    A (teacher, student) pair is active like a student in active_students,
+    and each teacher's number of active students, along with the number of
+    teachers with at least threshold of them, changes only as pairs start
+    and stop being active.
 
     Arguments:
       end_date - date until which values should be computed
@@ -156,73 +129,29 @@ def active_teachers(end_date, threshold, different_days):
         active in order to be counted as active
     """
 
-    for line in sys.stdin:
-        student, current_teacher, current_dt = line.rstrip('\n').split('\t')
-        if current_teacher != "":
-            break
-
-    current_dt_obj = datetime.datetime.strptime(
-        current_dt, date_format).date()
-    last_28dates = [current_dt_obj]
-    last_28days = {current_teacher: [{student: set([current_dt])}]}
-
-    def get_active_teachers(dt):
-        """For given date find all active teachers.
-        Takes into account past 28 days"""
-
-        active_teachers = 0
-        for some_teacher in last_28days:
-            active_students = {}
-            for some_time in daterange(dt + datetime.timedelta(-28), dt):
-                if some_time in last_28dates:
-                    idx = last_28dates.index(some_time)
-                    active_students = dict(list(active_students.items()) +
-                        list(last_28days[some_teacher][idx].items()))
-            filtered_students = [student for student, days in
-                active_students.iteritems() if len(days) >= different_days]
-            if len(filtered_students) >= threshold:
-                active_teachers = active_teachers + 1
-
-        emit_data_row([str(active_teachers)],
-            time.strftime(date_format, dt.timetuple()))
-
-    for line in sys.stdin:
-        student, teacher, dt = line.rstrip('\n').split('\t')
-        if teacher == "":
-            continue
-        dt_obj = datetime.datetime.strptime(dt, date_format).date()
-
-        if dt_obj != current_dt_obj:
-            [get_active_teachers(missing_date) for
-                missing_date in daterange(current_dt_obj, dt_obj)]
-
-            # Add place holder for new date and remove oldest date
-            #   if there are more than 28
-            current_dt_obj = dt_obj
-            current_dt = dt
-            last_28dates.append(current_dt_obj)
-            last_28dates = last_28dates[-28:]
-            for some_teacher in last_28days:
-                last_28days[some_teacher].append({})
-                last_28days[some_teacher] = last_28days[some_teacher][-28:]
-
-        # Add place holder for new teacher
-        if current_teacher != teacher:
-            current_teacher = teacher
-            if not current_teacher in last_28days:
-                days_in = len(last_28days[last_28days.iterkeys().next()])
-                last_28days[current_teacher] = [{} for x in range(days_in)]
-
-        last_idx = len(last_28days[current_teacher]) - 1
-        if student in last_28days[current_teacher][last_idx]:
-            last_28days[current_teacher][last_idx][student].add(current_dt)
-        else:
-            last_28days[current_teacher][last_idx][student] = set([current_dt])
-
-    # Fix for last date for which the loop above will not do anything
-    end_date_obj = datetime.datetime.strptime(end_date, date_format).date()
-    [get_active_teachers(missing_date) for
-        missing_date in daterange(current_dt_obj, end_date_obj)]
+    active_students = collections.defaultdict(int)
+    counts = {'active_teachers': 0}
+
+    def on_activate((teacher, student)):
+        active_students[teacher] += 1
+        if active_students[teacher] == threshold:
+            counts['active_teachers'] += 1
+
+    def on_deactivate((teacher, student)):
+        if active_students[teacher] == threshold:
+            counts['active_teachers'] -= 1
+        active_students[teacher] -= 1
+
+    def rows():
+        for line in sys.stdin:
+            student, teacher, dt = line.rstrip('\n').split('\t')
+            if teacher != "":
+                yield (teacher, student), dt
+
+    window = windowed_cohort.SlidingWindow(different_days, on_activate,
+                                           on_deactivate)
+    emit_active_counts(rows(), end_date, window,
+                       lambda: counts['active_teachers'])
 
 
 def main():
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+import StringIO
+import collections
+import datetime
+import random
+import sys
+import unittest
+
+import coach_reduce
+
+
+class ActiveCountsTest(unittest.TestCase):
+    def setUp(self):
+        self.orig = sys.stdin, sys.stdout
+
+    def tearDown(self):
+        sys.stdin, sys.stdout = self.orig
+
+    def run_reduce(self, f, rows, *args):
+        sys.stdin = StringIO.StringIO(
+            ''.join('\t'.join(row) + '\n' for row in rows))
+        sys.stdout = StringIO.StringIO()
+        f(*args)
+        return [tuple(line.split('\t'))
+                for line in sys.stdout.getvalue().splitlines()]
+
+    def test_active_students_different_days(self):
+        rows = [('s1', '2013-01-01'), ('s2', '2013-01-01'),
+                ('s1', '2013-01-02'), ('s2', '2013-01-04'),
+                ('s3', '2013-01-04')]
+        self.assertEqual(
+            [('0', '2013-01-01'), ('0', '2013-01-02'), ('1', '2013-01-03'),
+             ('1', '2013-01-04'), ('2', '2013-01-05')],
+            self.run_reduce(coach_reduce.active_students, rows,
+                            '2013-01-06', 2))
+
+    def test_active_teachers_different_days(self):
+        rows = [('s1', 't1', '2013-01-01'), ('s2', 't1', '2013-01-01'),
+                ('s3', 't2', '2013-01-01'), ('s1', 't1', '2013-01-02'),
+                ('s3', 't2', '2013-01-02'), ('s2', 't1', '2013-01-03')]
+        self.assertEqual(
+            [('0', '2013-01-01'), ('0', '2013-01-02'), ('0', '2013-01-03'),
+             ('1', '2013-01-04')],
+            self.run_reduce(coach_reduce.active_teachers, rows,
+                            '2013-01-05', 2, 2))
+
+    def test_matches_brute_force(self):
+        rng = random.Random(0)
+        start = datetime.date(2013, 1, 1)
+        days = sorted(rng.sample(xrange(90), 60))
+        activity = [(start + datetime.timedelta(day),
+                     set((rng.randint(0, 20), rng.randint(0, 3))
+                         for _ in xrange(rng.randint(1, 15))))
+                    for day in days]
+        end = start + datetime.timedelta(100)
+
+        def expected(different_days, threshold=None):
+            counts = []
+            date = activity[0][0]
+            while date < end:
+                active_days = collections.Counter()
+                for day, pairs in activity:
+                    if date - datetime.timedelta(28) <= day < date:
+                        if threshold is None:
+                            pairs = set(student for student, _ in pairs)
+                        active_days.update(pairs)
+                active = [key for key, num_days in active_days.iteritems()
+                          if num_days >= different_days]
+                if threshold is not None:
+                    students = collections.Counter(
+                        teacher for _, teacher in active)
+                    active = [teacher for teacher, num in students.iteritems()
+                              if num >= threshold]
+                counts.append((str(len(active)), str(date)))
+                date += datetime.timedelta(1)
+            return counts
+
+        student_rows = [('s%d' % student, str(day))
+                        for day, pairs in activity
+                        for student in sorted(set(s for s, _ in pairs))]
+        teacher_rows = [('s%d' % student, 't%d' % teacher, str(day))
+                        for day, pairs in activity
+                        for student, teacher in sorted(pairs,
+                                                       key=lambda p: p[1])]
+        for different_days in (1, 4):
+            self.assertEqual(
+                expected(different_days),
+                self.run_reduce(coach_reduce.active_students, student_rows,
+                                str(end), different_days))
+            for threshold in (1, 3):
+                self.assertEqual(
+                    expected(different_days, threshold),
+                    self.run_reduce(coach_reduce.active_teachers,
+                                    teacher_rows, str(end), threshold,
+                                    different_days))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,24 @@
 #!/usr/bin/env python
 
-"""Hive reducer script to compute daily exercise stats."""
+"""Hive reducer script to compute daily exercise stats.
+
+Each reducer sums the stats of all of the user-days it sees per
+(super_mode, sub_mode, exercise) before writing them out, so it outputs one
+row per combination it saw rather than one per user-day, and
+daily_ex_stats.q sums the reducers' rows.
+"""
 
-import collections
 import datetime
-import json
 import sys
 
+import numpy as np
+
+import json_fields
+
 # global string var representing the date partition we're working with
 g_dt = None
+# ...and the datetime it starts at
+g_as_of_date = None
 
 """Declare the filter modes which can be used to cross-section the data.
 
@@ -35,50 +45,116 @@ super_modes = everything_mode + user_modes
 sub_modes = everything_mode + topic_modes + topic_user_modes + user_modes
 
 
-def compute(sub_mode, plogs):
-    # dict of dicts, keyed by exercise name, then stat name
-    ex_stats = collections.defaultdict(lambda: collections.defaultdict(int))
+STAT_NAMES = ['users', 'user_exercises', 'problems', 'correct', 'profs',
+              'prof_prob_count', 'first_attempts', 'hint_probs', 'time_taken']
+
+# Stats are summed over all of a user's plogs for the day, or only those in
+# or not in topic_mode, depending on the sub_mode. These are the indexes of
+# those three variants.
+ALL_PLOGS, TOPIC_PLOGS, NON_TOPIC_PLOGS = range(3)
+sub_mode_variants = [
+    TOPIC_PLOGS if sub_mode == 'true' else
+    NON_TOPIC_PLOGS if sub_mode == 'false' else
+    ALL_PLOGS
+    for sub_mode in sub_modes]
+
+# The only fields of the ProblemLog and UserData blobs we look at
+plog_fields = json_fields.FieldExtractor(
+    ['exercise', 'topic_mode', 'earned_proficiency', 'correct',
+     'problem_number', 'hint_used', 'time_taken'])
+user_info_fields = json_fields.FieldExtractor(
+    ['joined', 'coaches', 'proficient_exercises', 'user_id'])
+
+# Exercise ids, index 0 being the 'ALL' pseudo-exercise
+g_exercise_ids = {'ALL': 0}
+g_exercises = ['ALL']
+
+# The stats summed over every user-day so far, indexed by
+# [super_mode, sub_mode, exercise id, stat]
+g_totals = np.zeros((len(super_modes), len(sub_modes), 64, len(STAT_NAMES)),
+                    dtype=np.int64)
+
+
+def exercise_id(ex):
+    global g_totals
+    if ex not in g_exercise_ids:
+        g_exercise_ids[ex] = len(g_exercises)
+        g_exercises.append(ex)
+        if len(g_exercises) > g_totals.shape[2]:
+            grown = np.zeros(g_totals.shape[:2] + (2 * g_totals.shape[2],
+                                                   g_totals.shape[3]),
+                             dtype=np.int64)
+            grown[:, :, :g_totals.shape[2], :] = g_totals
+            g_totals = grown
+    return g_exercise_ids[ex]
+
+
+def compute(plogs):
+    """Sum the stats of plogs per exercise, for all three plog variants.
+
+    Returns (exercise ids, stats), stats being an array indexed by
+    [variant, exercise, stat] and the first exercise being 'ALL'.
+    """
+    ex_ids = [0]
+    ex_index = {0: 0}
+    rows = []  # (exercise index, variant mask, plog stats)
 
     for plog in plogs:
-        ex = plog['exercise']
-
-        if sub_mode in topic_modes:
-            # this type of filter is decided on a per-problem basis
-            if plog.get('topic_mode') != (sub_mode == 'true'):
-                continue
-
-        if ex not in ex_stats:
-            ex_stats[ex]['users'] = 1
-
-        stats = ex_stats[ex]
-        stats['user_exercises'] = stats['users']
-        stats['problems'] += 1
-        stats['correct'] += plog['correct']
-        stats['profs'] += plog['earned_proficiency']
-        if plog['earned_proficiency']:
-            stats['prof_prob_count'] += int(plog['problem_number'])
-        stats['first_attempts'] += (plog['problem_number'] == 1)
-        stats['hint_probs'] += plog['hint_used']
-        stats['time_taken'] += max(0, min(600, int(plog['time_taken'])))
-
-    # merge all individual exercise stats into the global/aggregated stat set
-    if ex_stats:
-        for ex in ex_stats.keys():
-            for stat in ex_stats[ex]:
-                ex_stats['ALL'][stat] += ex_stats[ex][stat]
-        # but we need to correct the user count-- de-dupe it
-        ex_stats['ALL']['users'] = 1
-
-    return ex_stats
-
-
-def output(super_mode, sub_mode, ex_stats):
-    for ex, stats in ex_stats.iteritems():
-        stat_names = ['users', 'user_exercises', 'problems', 'correct',
-                'profs', 'prof_prob_count', 'first_attempts', 'hint_probs',
-                'time_taken']
-        output_str = "\t".join([super_mode, sub_mode, ex]) + "\t"
-        output_str += "\t".join([str(stats[s]) for s in stat_names]) + "\n"
+        ex = exercise_id(plog['exercise'])
+        if ex not in ex_index:
+            ex_index[ex] = len(ex_ids)
+            ex_ids.append(ex)
+
+        topic_mode = plog.get('topic_mode')
+        earned_proficiency = plog['earned_proficiency']
+        rows.append((
+            ex_index[ex],
+            (True, topic_mode is True, topic_mode is False),
+            (1,
+             plog['correct'],
+             earned_proficiency,
+             int(plog['problem_number']) if earned_proficiency else 0,
+             plog['problem_number'] == 1,
+             plog['hint_used'],
+             max(0, min(600, int(plog['time_taken']))))))
+
+    stats = np.zeros((3, len(ex_ids), len(STAT_NAMES)), dtype=np.int64)
+    if not rows:
+        return ex_ids, stats
+
+    ex_indexes, masks, plog_stats = zip(*rows)
+    ex_indexes = np.array(ex_indexes)
+    masks = np.array(masks, dtype=bool)
+    plog_stats = np.array(plog_stats, dtype=np.int64)
+
+    for variant in (ALL_PLOGS, TOPIC_PLOGS, NON_TOPIC_PLOGS):
+        mask = masks[:, variant]
+        np.add.at(stats[variant, :, 2:], ex_indexes[mask], plog_stats[mask])
+
+    # every exercise with a problem counts the user once
+    done = stats[:, :, 2] > 0
+    stats[:, :, 0] = done
+    stats[:, :, 1] = done
+
+    # 'ALL' sums the exercises, but de-dupes the user count
+    stats[:, 0, :] = stats[:, 1:, :].sum(axis=1)
+    stats[:, 0, 0] = stats[:, 0, 1] > 0
+
+    return ex_ids, stats
+
+
+def output():
+    """Write the totals of every (super_mode, sub_mode, exercise) any user
+    contributed to."""
+    num_exercises = len(g_exercises)
+    totals = g_totals[:, :, :num_exercises, :]
+    for super_index, sub_index, ex in zip(*np.nonzero(totals[:, :, :, 0])):
+        output_str = "\t".join([super_modes[super_index],
+                                sub_modes[sub_index],
+                                g_exercises[ex]]) + "\t"
+        output_str += "\t".join(
+            [str(stat) for stat in
+             totals[super_index, sub_index, ex].tolist()]) + "\n"
         sys.stdout.write(output_str)
 
 
@@ -92,6 +168,9 @@ def num_topic_plogs(plogs):
 
 
 def user_day_matches_mode(plog_stats, user_info, mode):
+    """Whether a user-day matches mode. user_info is the user's parsed
+    user_info JSON, or None if there was none.
+    """
     num_plogs, num_topic_plogs = plog_stats
 
     if mode in topic_user_modes:
@@ -109,16 +188,13 @@ def user_day_matches_mode(plog_stats, user_info, mode):
 
     elif mode in user_modes:
 
-        as_of_date = datetime.datetime.strptime(g_dt, '%Y-%m-%d')
+        as_of_date = g_as_of_date
 
         if user_info is None:
             # if we don't have user_info, don't pretend we can decide on
             # modes other than 'unknown'
             return mode == 'unknown'
 
-        # we've delayed as long as possible.. it's time to parse the json
-        user_info = json.loads(user_info[1])
-
         if mode == 'unknown':
             return user_info is None  # always False, due to preceeding lines
         elif mode == 'old':
@@ -163,37 +239,39 @@ def user_day_matches_mode(plog_stats, user_info, mode):
 
 
 def process_user_day(user_info, plogs):
-    """Compute statistics over plogs for each comination of filter modes."""
+    """Add the statistics over plogs to the totals of each combination of
+    filter modes the user-day matches."""
+
+    if not plogs:
+        return
 
     plog_stats = (len(plogs), num_topic_plogs(plogs))
 
-    # The stats will only differ based on whether the sub_mode is
-    # 'true', 'false', or some other value (in which case all plogs) are
-    # counted.  So for performance, pre-compute those three summaries.
-    ex_stats = {}
-    ex_stats['true'] = compute(sub_mode='true', plogs=plogs)
-    ex_stats['false'] = compute(sub_mode='false', plogs=plogs)
-    ex_stats[None] = compute(sub_mode='everything', plogs=plogs)
-
-    # Now, as we iterate through pair of filter modes, we only have to pick
-    # 1 of the 3 pre-computed options to output.
-    for super_mode in super_modes:
-        for sub_mode in sub_modes:
-            if (user_day_matches_mode(plog_stats, user_info, super_mode) and
-                    user_day_matches_mode(plog_stats, user_info, sub_mode)):
-                # Choose the right pre-computed stats for this mode pair
-                if sub_mode in topic_modes:
-                    output(super_mode, sub_mode, ex_stats[sub_mode])
-                else:
-                    output(super_mode, sub_mode, ex_stats[None])
+    # we've delayed as long as possible.. it's time to parse the json
+    if user_info is not None:
+        user_info = user_info_fields.extract(user_info[1])
+
+    super_indexes = [i for i, mode in enumerate(super_modes)
+                     if user_day_matches_mode(plog_stats, user_info, mode)]
+    sub_indexes = [i for i, mode in enumerate(sub_modes)
+                   if user_day_matches_mode(plog_stats, user_info, mode)]
+    if not super_indexes or not sub_indexes:
+        return
+
+    # The stats only differ by which plogs the sub_mode counts, so each
+    # matching sub_mode just picks one of the three variants.
+    ex_ids, stats = compute(plogs)
+    sub_stats = stats[[sub_mode_variants[i] for i in sub_indexes]]
+    g_totals[np.ix_(super_indexes, sub_indexes, ex_ids)] += sub_stats
 
 
 def main():
     if len(sys.argv) <= 1:
         print >> sys.stderr, "Usage: %s <dt>" % sys.argv[0]
         exit(1)
-    global g_dt
+    global g_dt, g_as_of_date
     g_dt = sys.argv[1]
+    g_as_of_date = datetime.datetime.strptime(g_dt, '%Y-%m-%d')
 
     user_info = None
     prev_user = None
@@ -222,13 +300,17 @@ def main():
         # have all of the ProblemLogs for this user
         prev_user = user
         try:
-            plog = json.loads(json_str)
+            plog = plog_fields.extract(json_str)
             plogs.append(plog)
         except ValueError:
             value_errors += 1
 
     process_user_day(user_info, plogs)
 
+    # Emit each mode and exercise's totals over all the users we've seen,
+    # rather than a row per user-day, for the Hive query to sum
+    output()
+
     print >>sys.stderr, "Finished main with %d ValueErrors " % value_errors
     print >>sys.stderr, "and %d join errors." % join_errors
 
@@ -4,14 +4,28 @@
 This expects two columns: a key and json blob.
 This looks at a 'backup_timestamp' property in each record, and emits the
 record with the latest timestamp for all records that match a given key.
+
+Records are read from stdin, clustered by key. Only the key and
+backup_timestamp of each are decoded, and only the raw line of the latest
+record so far for the current key is kept.
+
+To backfill locally, pass files of json records instead, optionally
+gzipped, and --workers to reduce several at once. The files must be
+partitioned by key, no key being in more than one, and each clustered by
+key, like the part files of a CLUSTER BY query's output:
+
+  find_latest_record.py --workers 8 snapshots/part-* > latest.txt
 """
 
 import codecs
-import json
+import gzip
+import multiprocessing
 import optparse
 import re
 import sys
 
+import json_fields
+
 
 # The following is needed for printing out char var > 128
 sys.stdout = codecs.getwriter('utf8')(sys.stdout)
@@ -26,40 +40,107 @@ def replace_surrogates(sample):
     return surrogate.sub("#S\g<1>", sample)
 
 
-def main(key_prop='key'):
+def latest_records(lines, key_prop='key'):
+    """Yield (key, json) for the latest of each run of records with the
+    same key in lines.
+
+    Records without a backup_timestamp count as older than any with one,
+    and of records with the same timestamp the first wins.
+    """
+    extractor = json_fields.FieldExtractor([key_prop, 'backup_timestamp'])
     key = None
     timestamp = None
     json_str = None
 
-    for line in sys.stdin:
+    for line in lines:
 
         try:
-            json_object = json.loads(line)
+            json_object = extractor.extract(line)
         except ValueError:
             # Try one more time, in case binary data is the problem.
             print >>sys.stderr, "Warning: Trouble parsing json '%s'." % line
-            json_object = json.loads(replace_surrogates(line))
+            json_object = extractor.extract(replace_surrogates(line))
 
         current_key = json_object[key_prop]
+        current_timestamp = json_object.get('backup_timestamp')
+        if current_timestamp is None:
+            current_timestamp = -1
+        current_timestamp = float(current_timestamp)
         if current_key != key:
             if json_str:
-                print "%s\t%s" % (key, json_str)
+                yield key, json_str
             key = current_key
-            timestamp = None
-            json_str = None
-        current_timestamp = -1
-        if 'backup_timestamp' in json_object:
-            current_timestamp = json_object['backup_timestamp']
-        if timestamp is None or current_timestamp > timestamp:
-            timestamp = current_timestamp
-            json_str = line.rstrip()
-    print "%s\t%s" % (key, json_str)
+        elif current_timestamp <= timestamp:
+            continue
+        timestamp = current_timestamp
+        json_str = line.rstrip()
+
+    if json_str:
+        yield key, json_str
+
+
+def _open(path):
+    if path.endswith('.gz'):
+        return gzip.open(path)
+    return open(path)
+
+
+def _latest_records_in_file(args):
+    """The latest records of one input file; run in a worker process."""
+    path, key_prop = args
+    f = _open(path)
+    try:
+        return list(latest_records(f, key_prop))
+    finally:
+        f.close()
+
+
+def iter_latest_records(paths, key_prop='key', workers=1):
+    """Yield (key, json) for the latest record of each key in the files
+    paths, which must be partitioned by key.
+
+    With workers > 1 the files are reduced by a pool of processes. Records
+    still come out in the order of paths.
+    """
+    if workers <= 1:
+        for path in paths:
+            f = _open(path)
+            try:
+                for record in latest_records(f, key_prop):
+                    yield record
+            finally:
+                f.close()
+        return
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        for records in pool.imap(_latest_records_in_file,
+                                 [(path, key_prop) for path in paths]):
+            for record in records:
+                yield record
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def main(key_prop='key', paths=None, workers=1):
+    if paths:
+        records = iter_latest_records(paths, key_prop, workers)
+    else:
+        records = latest_records(sys.stdin, key_prop)
+    for key, json_str in records:
+        print "%s\t%s" % (key, json_str)
 
 
 if __name__ == '__main__':
-    parser = optparse.OptionParser()
+    parser = optparse.OptionParser(usage="%prog [options] [file ...]")
     parser.add_option(
             '--k', '--key', dest='key', default='key',
             help="The property name in the JSON to use as the key")
-    options, _ = parser.parse_args()
-    main(options.key)
+    parser.add_option(
+            '-w', '--workers', default=1, type='int',
+            help="Number of processes reducing the given files at once; "
+                 "output order is preserved")
+    options, args = parser.parse_args()
+    main(options.key, args, options.workers)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import find_latest_record
+
+
+def record(key, timestamp=None, **props):
+    if timestamp is not None:
+        props['backup_timestamp'] = timestamp
+    props['key'] = key
+    return json.dumps(props) + '\n'
+
+
+class LatestRecordsTest(unittest.TestCase):
+    def test_latest_of_each_key(self):
+        lines = [record('a', 1.5, v=1), record('a', 10, v=2),
+                 record('a', 2, v=3), record('b', v=4),
+                 record('b', 0, v=5), record('b', 0, v=6),
+                 record('c', v=7)]
+        self.assertEqual(
+            [('a', lines[1].rstrip()), ('b', lines[4].rstrip()),
+             ('c', lines[6].rstrip())],
+            list(find_latest_record.latest_records(lines)))
+
+    def test_null_timestamp(self):
+        lines = [json.dumps({'key': 'a', 'backup_timestamp': None}) + '\n',
+                 record('a', 0, v=1),
+                 json.dumps({'key': 'a', 'backup_timestamp': None}) + '\n']
+        self.assertEqual(
+            [('a', lines[1].rstrip())],
+            list(find_latest_record.latest_records(lines)))
+
+    def test_other_key(self):
+        lines = [record('a', 1, user='x'), record('b', 2, user='x')]
+        self.assertEqual(
+            [('x', lines[1].rstrip())],
+            list(find_latest_record.latest_records(lines, 'user')))
+
+    def test_no_records(self):
+        self.assertEqual([], list(find_latest_record.latest_records([])))
+
+
+class FilesTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_workers_preserve_order(self):
+        paths = []
+        expected = []
+        for i in xrange(6):
+            path = os.path.join(self.dir, 'part-%d' % i)
+            if i % 2:
+                path += '.gz'
+            f = gzip.open(path, 'w') if i % 2 else open(path, 'w')
+            for j in xrange(3):
+                key = 'k%d_%d' % (i, j)
+                f.write(record(key, 2, v=0))
+                f.write(record(key, 3, v=1))
+                expected.append((key, record(key, 3, v=1).rstrip()))
+            f.close()
+            paths.append(path)
+
+        for workers in (1, 3):
+            self.assertEqual(expected, list(
+                find_latest_record.iter_latest_records(paths,
+                                                       workers=workers)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+"""Reads a few top-level fields out of a JSON object without parsing all of it.
+
+Our streaming scripts (find_latest_record.py, daily_ex_stats.py,
+stacklog_cards_mapper.py, ka_udf.py) get whole datastore entities as JSON
+blobs but only look at a handful of their fields. Parsing a blob builds
+every list, dict and string in it, so instead FieldExtractor finds just the
+fields it's asked for with one precompiled regex, checks that each match is
+a key of the outermost object (not text inside a string, or a key of some
+nested object), and decodes only that key's value.
+
+    extractor = json_fields.FieldExtractor(['key', 'backup_timestamp'])
+    fields = extractor.extract(line)
+    # {'key': u'ag5...', 'backup_timestamp': 1370044800.0}
+
+Fields the object doesn't have are left out of the result, like they'd be
+missing from the parsed dict. Anything that isn't a single JSON object
+falls back to a full parse, which raises ValueError like json.loads if the
+line isn't JSON at all. Only the extracted values are validated though, so
+an object that is malformed elsewhere may still extract cleanly.
+
+Keys are matched as json.dumps writes them, so a field whose name is
+spelled with other escapes in the blob won't be found. That doesn't come
+up for our field names, which are plain ASCII.
+
+loads() is the fastest full parser available: simplejson's C speedups when
+it's installed, otherwise the standard library's json.
+
+coach_summary.q, student_teacher_current.q, bulkdata_update.q,
+userdata_update.q, insert_topic_attempts.q, daily_ex_stats.q,
+accuracy_deltas.q and ka_hive_init.q ADD FILE this module for their
+scripts. json_fields_benchmark.py times it against json.loads on rows
+shaped like ours.
+"""
+
+import json
+import re
+
+try:
+    import simplejson as _json
+except ImportError:
+    _json = json
+
+
+loads = _json.loads
+
+# Decodes the JSON value at an index of a string, returning it and the index
+# it ends at, or raising StopIteration if there's no value there
+_scan_once = _json.JSONDecoder().scan_once
+
+# Complete JSON strings, to blank out of the text between matches
+_STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+
+_WHITESPACE = ' \t\n\r'
+
+
+class FieldExtractor(object):
+    """Extracts the given top-level fields from JSON objects."""
+
+    def __init__(self, fields):
+        self.fields = list(fields)
+        self._num_fields = len(set(self.fields))
+        # Each field's name as json.dumps writes it
+        self._written = dict((json.dumps(field)[1:-1], field)
+                             for field in self.fields)
+        self._keys = re.compile(r'"(%s)"[ \t\n\r]*:[ \t\n\r]*' %
+                                '|'.join(re.escape(written)
+                                         for written in self._written))
+
+    def extract(self, s):
+        """A dict of the fields of the JSON object s that it has."""
+        start = len(s) - len(s.lstrip(_WHITESPACE))
+        if (not s.startswith('{', start) or
+                not s.rstrip(_WHITESPACE).endswith('}')):
+            return self.extract_parsed(loads(s))
+
+        found = {}
+        # Everything before scanned, which is never inside a string, has been
+        # accounted for in depth
+        scanned = start + 1
+        depth = 1
+        match = self._keys.search(s, scanned)
+        while match:
+            key_start = match.start()
+            if s[key_start - 1] == '\\':
+                # Inside a string
+                match = self._keys.search(s, match.end())
+                continue
+
+            # No object opening before the key means it's one of ours, since
+            # in valid JSON keys don't appear in lists or strings
+            if depth != 1 or s.find('{', scanned, key_start) != -1:
+                between = _STRING.sub('', s[scanned:key_start])
+                if '"' in between:
+                    # An unterminated string, so this match is inside a
+                    # string. Leave scanned where it was for the next match.
+                    match = self._keys.search(s, match.end())
+                    continue
+                depth += (between.count('{') + between.count('[') -
+                          between.count('}') - between.count(']'))
+                scanned = key_start
+                if depth != 1:
+                    match = self._keys.search(s, match.end())
+                    continue
+
+            try:
+                value, scanned = _scan_once(s, match.end())
+            except StopIteration:
+                return self.extract_parsed(loads(s))
+            field = self._written[match.group(1)]
+            if field not in found:
+                found[field] = value
+                if len(found) == self._num_fields:
+                    break
+            # Carry on after the value
+            match = self._keys.search(s, scanned)
+
+        return found
+
+    def extract_parsed(self, doc):
+        """The fields of an already parsed JSON document that it has."""
+        if not isinstance(doc, dict):
+            return {}
+        return dict((field, doc[field]) for field in self.fields
+                    if field in doc)
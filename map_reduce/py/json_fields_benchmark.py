@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""Benchmark json_fields.FieldExtractor against json.loads.
+
+Builds JSON rows shaped like the entities our streaming scripts read, and
+for each, times pulling out the fields a script uses:
+
+  userdata - key and backup_timestamp of a UserData snapshot, as
+      find_latest_record.py reads them
+  problemlog - the ProblemLog fields daily_ex_stats.py sums
+  stacklog - topic_mode and the other StackLog fields
+      stacklog_cards_mapper.py reads, on a stack done in practice mode
+      (which it skips) and one done in topic mode
+
+both by parsing the whole row with json.loads and with json_fields,
+checking that the two agree. Run it from this directory:
+
+  python json_fields_benchmark.py --rows 5000
+"""
+
+import json
+import optparse
+import random
+import time
+
+import json_fields
+
+
+_EXERCISES = ["addition_1", "subtraction_2", "multiplying_fractions",
+              "solving_quadratics_by_factoring", "derivative_intuition",
+              "graphing_linear_equations", "adding_decimals"]
+
+
+def userdata_row(rng, i):
+    exercises = rng.sample(_EXERCISES * 30, rng.randint(0, 200))
+    return json.dumps({
+        "key": "ag5zfmtoYW4tYWNhZGVteXIQCxIIVXNlckRhdGEY%08d" % i,
+        "user": "http://id.khanacademy.org/%032x" % rng.getrandbits(128),
+        "user_id": "http://id.khanacademy.org/%032x" % rng.getrandbits(128),
+        "user_email": "student%d@gmail.com" % i,
+        "user_nickname": u"Student \u00e9l\u00e8ve %d" % i,
+        "joined": 1300000000.0 + rng.randint(0, 10 ** 8),
+        "last_login": 1370000000.0 + rng.randint(0, 10 ** 6),
+        "coaches": ["coach%d@gmail.com" % rng.randint(0, 1000)
+                    for _ in xrange(rng.randint(0, 3))],
+        "student_lists": [],
+        "proficient_exercises": exercises,
+        "all_proficient_exercises": exercises,
+        "suggested_exercises": rng.sample(_EXERCISES, 3),
+        "badges": ["badge_%d" % rng.randint(0, 300)
+                   for _ in xrange(rng.randint(0, 100))],
+        "points": rng.randint(0, 10 ** 6),
+        "total_seconds_watched": rng.randint(0, 10 ** 6),
+        "uservideocss_version": rng.randint(0, 100),
+        "conversion_test_hard_exercises": False,
+        "gae_bingo_identity": "%032x" % rng.getrandbits(128),
+        "backup_timestamp": 1370044800.0 + rng.randint(0, 86400),
+    })
+
+
+def problemlog_row(rng, i):
+    return json.dumps({
+        "key": "ag5zfmtoYW4tYWNhZGVteXISCxIKUHJvYmxlbUxvZxj%08d" % i,
+        "user": "student%d@gmail.com" % (i % 1000),
+        "exercise": rng.choice(_EXERCISES),
+        "correct": rng.random() < 0.7,
+        "time_done": 1370044800.0 + i,
+        "time_taken": rng.randint(1, 600),
+        "problem_number": rng.randint(1, 40),
+        "hint_used": rng.random() < 0.2,
+        "count_hints": rng.randint(0, 4),
+        "count_attempts": rng.randint(1, 3),
+        "attempts": [str(rng.randint(0, 100)) for _ in xrange(3)],
+        "time_taken_attempts": [rng.randint(1, 60) for _ in xrange(3)],
+        "hint_time_taken_list": [],
+        "ip_address": "10.0.%d.%d" % (rng.randint(0, 255),
+                                      rng.randint(0, 255)),
+        "seed": "%x" % rng.getrandbits(64),
+        "sha1": "%x" % rng.getrandbits(160),
+        "earned_proficiency": rng.random() < 0.05,
+        "suggested": rng.random() < 0.5,
+        "review_mode": False,
+        "topic_mode": rng.random() < 0.5,
+        "backup_timestamp": 1370044800.0 + i,
+    })
+
+
+def stacklog_row(rng, i, topic_mode):
+    cards = [{
+        "card": {"scheduler_info": {"mode": "randomized",
+                                    "num_correct": rng.randint(0, 10)},
+                 "exercise_name": rng.choice(_EXERCISES)},
+        "associated_log": {"ProblemLog": "ag5zfmtoYW4tYWNhZGVteX%08d" % n},
+    } for n in xrange(8)]
+    return json.dumps({
+        "user": "student%d@gmail.com" % (i % 1000),
+        "time_last_done": 1370044800.0 + i,
+        "topic_mode": topic_mode,
+        "topic_id": "%x" % rng.getrandbits(32),
+        "extra_data": json.dumps({"segment": rng.choice(["control", "a"]),
+                                  "hints": rng.randint(0, 10)}),
+        "cards_list": json.dumps(cards),
+        "backup_timestamp": 1370044800.0 + i,
+    })
+
+
+def parse_all(rows, fields):
+    out = []
+    for row in rows:
+        doc = json.loads(row)
+        out.append(dict((field, doc[field]) for field in fields
+                        if field in doc))
+    return out
+
+
+def extract_all(rows, fields):
+    extractor = json_fields.FieldExtractor(fields)
+    return [extractor.extract(row) for row in rows]
+
+
+def timed(name, rows, f, *args):
+    start = time.time()
+    result = f(rows, *args)
+    elapsed = time.time() - start
+    print "%-24s %8.3fs %8.2f us/row" % (name, elapsed,
+                                          elapsed * 1e6 / len(rows))
+    return result
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-r", "--rows", type="int", default=5000,
+        help="Number of rows of each shape. Defaults to 5000.")
+    parser.add_option("-s", "--seed", type="int", default=0,
+        help="Random seed. Defaults to 0.")
+    options, _ = parser.parse_args()
+
+    rng = random.Random(options.seed)
+    shapes = [
+        ("userdata", [userdata_row(rng, i) for i in xrange(options.rows)],
+         ["key", "backup_timestamp"]),
+        ("problemlog", [problemlog_row(rng, i) for i in xrange(options.rows)],
+         ["exercise", "topic_mode", "earned_proficiency", "correct",
+          "problem_number", "hint_used", "time_taken"]),
+        ("stacklog practice",
+         [stacklog_row(rng, i, False) for i in xrange(options.rows)],
+         ["topic_mode"]),
+        ("stacklog topic",
+         [stacklog_row(rng, i, True) for i in xrange(options.rows)],
+         ["topic_mode", "topic_id", "extra_data", "cards_list"]),
+    ]
+
+    print "json_fields.loads is %s.loads" % json_fields.loads.__module__
+    for name, rows, fields in shapes:
+        print "%s: %d rows, %d bytes/row" % (
+            name, len(rows), sum(len(row) for row in rows) / len(rows))
+        parsed = timed("  json.loads", rows, parse_all, fields)
+        extracted = timed("  json_fields", rows, extract_all, fields)
+        assert parsed == extracted, "%s fields disagree" % name
+
+
+if __name__ == '__main__':
+    main()
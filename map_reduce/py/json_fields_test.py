@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+import json
+import random
+import unittest
+
+import json_fields
+
+
+class FieldExtractorTest(unittest.TestCase):
+    def test_top_level_fields(self):
+        extractor = json_fields.FieldExtractor(['key', 'backup_timestamp'])
+        self.assertEqual({'key': u'abc', 'backup_timestamp': 1370044800.5},
+                         extractor.extract(
+                             '{"user": "x", "key": "abc", "coaches": [],'
+                             ' "backup_timestamp": 1370044800.5}\n'))
+        self.assertEqual({'key': u'abc'},
+                         extractor.extract('{"key":"abc","points":3}'))
+
+    def test_ignores_nested_and_quoted_keys(self):
+        extractor = json_fields.FieldExtractor(['segment', 'topic_mode'])
+        line = json.dumps({
+            'extra_data': json.dumps({'segment': 'a', 'topic_mode': True}),
+            'cards': [{'segment': 'b'}, '"topic_mode": 1'],
+            'other': {'topic_mode': False, 'x': '{"segment": "c"'},
+            'segment': 'control'})
+        self.assertEqual({'segment': u'control'}, extractor.extract(line))
+
+    def test_falls_back_to_parsing(self):
+        extractor = json_fields.FieldExtractor(['a'])
+        self.assertEqual({}, extractor.extract('[{"a": 1}]'))
+        self.assertEqual({'a': 1}, extractor.extract(' {"a": 1}\n'))
+        self.assertRaises(ValueError, extractor.extract, '{"a": 1} {')
+        self.assertRaises(ValueError, extractor.extract, '{"a": nope}')
+        self.assertRaises(ValueError, extractor.extract, '{"a": 1, "b"')
+
+    def test_matches_json_loads(self):
+        rng = random.Random(0)
+        names = ['a', 'ab', 'b\\c', 'd"e']
+
+        def value(depth):
+            r = rng.random()
+            if depth > 3 or r < 0.4:
+                return rng.choice([1, -2.5e10, True, None, u'a', u'"a": 1',
+                                   u'\\', u'{"ab": [', u'x\xe9'])
+            elif r < 0.7:
+                return [value(depth + 1) for _ in xrange(rng.randint(0, 3))]
+            return dict((rng.choice(names), value(depth + 1))
+                        for _ in xrange(rng.randint(0, 3)))
+
+        for _ in xrange(2000):
+            doc = value(3) if rng.random() < 0.05 else dict(
+                (rng.choice(names), value(1))
+                for _ in xrange(rng.randint(0, 5)))
+            separators = rng.choice([(',', ':'), (', ', ': ')])
+            line = json.dumps(doc, ensure_ascii=rng.random() < 0.5,
+                              separators=separators)
+            fields = rng.sample(names, rng.randint(1, 3))
+            expected = dict((field, doc[field]) for field in fields
+                            if isinstance(doc, dict) and field in doc)
+            self.assertEqual(
+                expected, json_fields.FieldExtractor(fields).extract(line))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,10 +6,12 @@
        python ka_udf.py split topic_string_keys "<tab>" key,title 0
 """
 import codecs
-import json
 import sys
 import os
 from subprocess import call
+
+import json_fields
+
 sys.stdout = codecs.getwriter('utf8')(sys.stdout)
 
 
@@ -27,9 +29,11 @@ def split(split_field, delimiter, selected,
     if delimiter == '<tab>':
         # Have to do this to get around hive oddness
         delimiter = '\t'
+    extractor = json_fields.FieldExtractor(
+        [split_field] + selected.split(","))
     for line in sys.stdin:
         line = line.strip()
-        doc = json.loads(line)
+        doc = extractor.extract(line)
 
         if split_field not in doc and not split_field_required:
             continue
@@ -62,9 +66,11 @@ def explode(key_fields, explode_field):
             def\tghi\t2
             def\tghi\t3
     """
+    extractor = json_fields.FieldExtractor(
+        key_fields.split(",") + [explode_field])
     for line in sys.stdin:
         line = line.strip()
-        doc = json.loads(line)
+        doc = extractor.extract(line)
         exploded = None
         if explode_field in doc:
             exploded = doc[explode_field]
@@ -3,9 +3,10 @@
 The point of this script is to convert the protocol buffers downloaded
 from GAE to json encoded datastore hosted on Amazon S3. The data on S3 can then
  be queried using the elastic mapreduce framework.
-Input is a collection of protocol buffers taken from stdin. Each protocol
-buffer is an entity from GAE such as an entity from UserData, ProblemLog,
-VideoLog and etc.
+Input is a collection of protocol buffers taken from stdin, either as one
+pickled list or as a stream of length-prefixed records (see
+write_pb_record()). Each protocol buffer is an entity from GAE such as an
+entity from UserData, ProblemLog, VideoLog and etc.
 Output is a series of lines piped to stdout:
 username<tab>json_encoded_entities
 Check out https://sites.google.com/a/khanacademy.org/forge/technical/data_n/running-emr-elastic-mapreduce-on-the-khan-academy-data
@@ -15,10 +16,14 @@ TODO(yunfang): Consider moving the primary functions here to a library
                as the pb_to_dict process doesn't really happen in hive
 """
 
+import base64
+import collections
 import datetime
 import json
+import multiprocessing
 import optparse
 import pickle
+import struct
 import sys
 import time
 
@@ -28,12 +33,40 @@ from google.appengine.api import datastore
 from google.appengine.api import datastore_types
 from google.appengine.api import users
 from google.appengine.datastore import entity_pb
+from google.net.proto import ProtocolBuffer
 
 
 _serialize_blacklists = {
         "Scratchpad": ['latest_revision_cache'],
         "ScratchpadRevision": ['image_url']}
 
+# Property meanings pb_to_dict_fast knows how to decode.  Properties with any
+# other meaning (geo points, IMs, ratings, links, blob keys, ...) are rare in
+# our data, and send the whole entity down the datastore.Entity path.
+_FAST_PATH_MEANINGS = frozenset([
+        entity_pb.Property.NO_MEANING,
+        entity_pb.Property.GD_WHEN,
+        entity_pb.Property.TEXT,
+        entity_pb.Property.BLOB,
+        entity_pb.Property.BYTESTRING,
+        entity_pb.Property.EMPTY_LIST])
+
+# Meanings whose string values are raw bytes rather than utf-8 text.
+_BYTE_MEANINGS = frozenset([
+        entity_pb.Property.BLOB,
+        entity_pb.Property.BYTESTRING])
+
+# GD_WHEN values from here on don't fit in a datetime.datetime.
+_MAX_WHEN_MICROSECONDS = 253402300800 * 1000000
+
+# Kinds whose entity dicts need pre_process_entity_dict beyond dropping
+# blacklisted properties.
+_SLOW_PATH_KINDS = frozenset(["_GAEBingoIdentityRecord"])
+
+# Each record of a protobuf stream is the serialized protobuf prefixed with
+# its length as a big-endian unsigned 32-bit int.
+_RECORD_HEADER = struct.Struct(">I")
+
 
 def get_cmd_line_args():
     parser = optparse.OptionParser(
@@ -44,6 +77,14 @@ def get_cmd_line_args():
                      help="field corresponding to the reducer key")
     parser.add_option("-p", "--parent", default=None,
                      help="including parent key in the json dump")
+    parser.add_option("-f", "--format", default="pickle",
+                     choices=["pickle", "pbstream"],
+                     help=("input format: a single pickled list of protobufs "
+                           "(pickle) or length-prefixed protobuf records "
+                           "(pbstream)"))
+    parser.add_option("-w", "--workers", default=1, type="int",
+                     help=("number of processes converting protobufs to json; "
+                           "output order is preserved"))
     # TODO(yunfang): Output a warning with unknown args
     options, _ = parser.parse_args()
     return options
@@ -73,8 +114,375 @@ def apply_transform(doc):
     return doc
 
 
+class _FastPathUnsupported(Exception):
+    """Raised when pb_to_dict_fast can't decode an entity by itself."""
+    pass
+
+
 def pb_to_dict(pb, parent=None):
     """Convert a protocol buffer to a json-serializable dictionary"""
+    try:
+        return pb_to_dict_fast(pb, parent)
+    except _FastPathUnsupported:
+        return pb_to_dict_via_entity(pb, parent)
+
+
+def _reference_to_str(reference):
+    """Equivalent of str(datastore_types.Key) for an entity_pb.Reference."""
+    return base64.urlsafe_b64encode(reference.Encode()).replace('=', '')
+
+
+# The fast path reads the protocol buffer wire format directly, rather than
+# going through the (pure python) entity_pb parser, which dominates the cost
+# of a conversion.  Tags are (field_number << 3) | wire_type, and the field
+# numbers are the ones in entity_pb.EntityProto, Property and PropertyValue.
+_WIRE_VARINT = 0
+_WIRE_FIXED64 = 1
+_WIRE_LENGTH_DELIMITED = 2
+_WIRE_FIXED32 = 5
+
+_ENTITY_KEY = 106
+_ENTITY_PROPERTY = 114
+_ENTITY_RAW_PROPERTY = 122
+
+_PROPERTY_MEANING = 8
+_PROPERTY_NAME = 26
+_PROPERTY_MULTIPLE = 32
+_PROPERTY_VALUE = 42
+
+_VALUE_INT64 = 8
+_VALUE_BOOLEAN = 16
+_VALUE_STRING = 26
+_VALUE_DOUBLE = 33
+_VALUE_POINT_GROUP = 43
+_VALUE_USER_GROUP = 67
+_VALUE_REFERENCE_GROUP = 99
+
+_USER_EMAIL = 74
+_USER_AUTH_DOMAIN = 82
+_USER_FEDERATED_IDENTITY = 170
+_USER_GROUP_END = 68
+
+_REFERENCE_APP = 106
+_REFERENCE_PATH_ELEMENT_GROUP = 115
+_REFERENCE_NAME_SPACE = 162
+_REFERENCE_GROUP_END = 100
+
+_PATH_ELEMENT_TYPE = 122
+_PATH_ELEMENT_ID = 128
+_PATH_ELEMENT_NAME = 138
+_PATH_ELEMENT_GROUP_END = 116
+
+_DOUBLE = struct.Struct("<d")
+
+
+def _read_varint(buf, pos):
+    """Read an unsigned varint from buf at pos; returns (value, new pos)."""
+    b = ord(buf[pos])
+    if b < 0x80:
+        return b, pos + 1
+    result = b & 0x7f
+    shift = 7
+    pos += 1
+    while True:
+        b = ord(buf[pos])
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+        if shift >= 64:
+            raise _FastPathUnsupported()
+
+
+def _read_bytes(buf, pos):
+    """Read a length-delimited string; returns (value, new pos)."""
+    length, pos = _read_varint(buf, pos)
+    end = pos + length
+    if end > len(buf):
+        raise _FastPathUnsupported()
+    return buf[pos:end], end
+
+
+def _skip_field(buf, pos, tag):
+    """Skip over the value of a field we don't care about."""
+    wire_type = tag & 7
+    if wire_type == _WIRE_VARINT:
+        return _read_varint(buf, pos)[1]
+    elif wire_type == _WIRE_FIXED64:
+        return pos + 8
+    elif wire_type == _WIRE_LENGTH_DELIMITED:
+        return _read_bytes(buf, pos)[1]
+    elif wire_type == _WIRE_FIXED32:
+        return pos + 4
+    # Unknown groups and malformed input are left to entity_pb.
+    raise _FastPathUnsupported()
+
+
+def _read_user_group(buf, pos):
+    """Read a PropertyValue.UserValue; returns (str(users.User), new pos)."""
+    email = auth_domain = ''
+    federated_identity = None
+    while True:
+        tag, pos = _read_varint(buf, pos)
+        if tag == _USER_GROUP_END:
+            break
+        elif tag == _USER_EMAIL:
+            email, pos = _read_bytes(buf, pos)
+        elif tag == _USER_AUTH_DOMAIN:
+            auth_domain, pos = _read_bytes(buf, pos)
+        elif tag == _USER_FEDERATED_IDENTITY:
+            federated_identity, pos = _read_bytes(buf, pos)
+        else:
+            pos = _skip_field(buf, pos, tag)
+
+    # This mirrors users.User.nickname().
+    email = unicode(email, 'utf-8')
+    auth_domain = unicode(auth_domain, 'utf-8')
+    if not auth_domain:
+        raise _FastPathUnsupported()
+    if email and email.endswith('@' + auth_domain):
+        return str(email[:-(len(auth_domain) + 1)]), pos
+    if federated_identity:
+        return str(unicode(federated_identity, 'utf-8')), pos
+    return str(email), pos
+
+
+def _read_path_element_group(buf, pos, reference):
+    """Read a ReferenceValue path element into reference's path."""
+    element = reference.mutable_path().add_element()
+    while True:
+        tag, pos = _read_varint(buf, pos)
+        if tag == _PATH_ELEMENT_GROUP_END:
+            return pos
+        elif tag == _PATH_ELEMENT_TYPE:
+            value, pos = _read_bytes(buf, pos)
+            element.set_type(value)
+        elif tag == _PATH_ELEMENT_ID:
+            value, pos = _read_varint(buf, pos)
+            if value >= 1 << 63:
+                value -= 1 << 64
+            element.set_id(value)
+        elif tag == _PATH_ELEMENT_NAME:
+            value, pos = _read_bytes(buf, pos)
+            element.set_name(value)
+        else:
+            pos = _skip_field(buf, pos, tag)
+
+
+def _read_reference_group(buf, pos):
+    """Read a PropertyValue.ReferenceValue; returns (str(Key), new pos)."""
+    reference = entity_pb.Reference()
+    while True:
+        tag, pos = _read_varint(buf, pos)
+        if tag == _REFERENCE_GROUP_END:
+            break
+        elif tag == _REFERENCE_APP:
+            value, pos = _read_bytes(buf, pos)
+            reference.set_app(value)
+        elif tag == _REFERENCE_NAME_SPACE:
+            value, pos = _read_bytes(buf, pos)
+            # Like datastore_types.SetNamespace, drop the empty namespace.
+            if value:
+                reference.set_name_space(value)
+            else:
+                reference.clear_name_space()
+        elif tag == _REFERENCE_PATH_ELEMENT_GROUP:
+            pos = _read_path_element_group(buf, pos, reference)
+        else:
+            pos = _skip_field(buf, pos, tag)
+    return _reference_to_str(reference), pos
+
+
+def _when_to_timestamp(microseconds):
+    """Equivalent of apply_transform() on a GD_WHEN datetime value."""
+    if microseconds < 0:
+        return 0
+    if microseconds >= _MAX_WHEN_MICROSECONDS:
+        # datastore_types turns these into _OverflowDateTime longs.
+        raise _FastPathUnsupported()
+    # datetime.timetuple() leaves tm_isdst as -1, which we must match for
+    # time.mktime() to give the same answer.
+    return time.mktime(time.gmtime(microseconds // 1000000)[:8] + (-1,))
+
+
+def _read_property_value(buf, pos, end, meaning):
+    """Read a PropertyValue and convert it straight to a json-ready value.
+
+    This matches datastore_types.FromPropertyPb() followed by
+    apply_transform() for the meanings in _FAST_PATH_MEANINGS.
+    """
+    string_value = int_value = bool_value = double_value = None
+    other_value = None
+    while pos < end:
+        tag, pos = _read_varint(buf, pos)
+        if tag == _VALUE_STRING:
+            string_value, pos = _read_bytes(buf, pos)
+        elif tag == _VALUE_INT64:
+            int_value, pos = _read_varint(buf, pos)
+            if int_value >= 1 << 63:
+                int_value -= 1 << 64
+        elif tag == _VALUE_BOOLEAN:
+            bool_value, pos = _read_varint(buf, pos)
+        elif tag == _VALUE_DOUBLE:
+            (double_value,) = _DOUBLE.unpack_from(buf, pos)
+            pos += 8
+        elif tag == _VALUE_REFERENCE_GROUP:
+            other_value, pos = _read_reference_group(buf, pos)
+        elif tag == _VALUE_USER_GROUP:
+            other_value, pos = _read_user_group(buf, pos)
+        elif tag == _VALUE_POINT_GROUP:
+            # GeoPts aren't json-serializable anyway.
+            raise _FastPathUnsupported()
+        else:
+            pos = _skip_field(buf, pos, tag)
+
+    if string_value is not None:
+        if meaning in _BYTE_MEANINGS:
+            decoded = unicode(string_value, errors='replace')
+        elif meaning in (entity_pb.Property.NO_MEANING,
+                         entity_pb.Property.TEXT):
+            decoded = unicode(string_value, 'utf-8')
+        else:
+            raise _FastPathUnsupported()
+        return decoded.replace("\n", "\\n")
+
+    if meaning == entity_pb.Property.GD_WHEN:
+        if int_value is None:
+            raise _FastPathUnsupported()
+        return _when_to_timestamp(int_value)
+    elif meaning == entity_pb.Property.EMPTY_LIST:
+        if (int_value is not None or bool_value is not None or
+                double_value is not None or other_value is not None):
+            raise _FastPathUnsupported()
+        return []
+    elif meaning != entity_pb.Property.NO_MEANING:
+        raise _FastPathUnsupported()
+
+    if int_value is not None:
+        return long(int_value)
+    elif bool_value is not None:
+        return bool(bool_value)
+    elif double_value is not None:
+        return double_value
+    return other_value
+
+
+def _read_property(buf, pos, end):
+    """Read a Property's header.
+
+    Returns (name, multiple, meaning, value_start, value_end), where the
+    last two delimit the serialized PropertyValue in buf.
+    """
+    meaning = entity_pb.Property.NO_MEANING
+    name = None
+    multiple = False
+    value_start = value_end = None
+    while pos < end:
+        tag, pos = _read_varint(buf, pos)
+        if tag == _PROPERTY_NAME:
+            name, pos = _read_bytes(buf, pos)
+        elif tag == _PROPERTY_VALUE:
+            length, value_start = _read_varint(buf, pos)
+            value_end = pos = value_start + length
+        elif tag == _PROPERTY_MEANING:
+            meaning, pos = _read_varint(buf, pos)
+        elif tag == _PROPERTY_MULTIPLE:
+            multiple, pos = _read_varint(buf, pos)
+        else:
+            pos = _skip_field(buf, pos, tag)
+
+    if (name is None or value_start is None or
+            meaning not in _FAST_PATH_MEANINGS):
+        raise _FastPathUnsupported()
+    return name, multiple, meaning, value_start, value_end
+
+
+def pb_to_dict_fast(pb, parent=None):
+    """Convert a protocol buffer to a json-serializable dictionary.
+
+    This gives the same result as pb_to_dict_via_entity(), but reads the
+    serialized EntityProto's properties once and converts each value
+    directly, instead of building a datastore.Entity and then running
+    apply_transform() over a copy of it.  Raises _FastPathUnsupported for
+    entities it can't handle; pb_to_dict() falls back to the slow path for
+    those.
+    """
+    try:
+        key = None
+        properties = []
+        pos = 0
+        end = len(pb)
+        while pos < end:
+            tag, pos = _read_varint(pb, pos)
+            if tag == _ENTITY_PROPERTY or tag == _ENTITY_RAW_PROPERTY:
+                length, pos = _read_varint(pb, pos)
+                properties.append((tag, pos, pos + length))
+                pos += length
+            elif tag == _ENTITY_KEY:
+                key, pos = _read_bytes(pb, pos)
+            else:
+                pos = _skip_field(pb, pos, tag)
+        if pos != end or key is None:
+            raise _FastPathUnsupported()
+
+        key = entity_pb.Reference(key)
+        path_elements = key.path().element_list()
+        if not path_elements:
+            raise _FastPathUnsupported()
+        last_element = path_elements[-1]
+        if not (last_element.has_id() ^ last_element.has_name()):
+            raise _FastPathUnsupported()
+        kind = last_element.type()
+        if kind in _SLOW_PATH_KINDS:
+            raise _FastPathUnsupported()
+        blacklist = _serialize_blacklists.get(kind, ())
+
+        # Indexed properties come before unindexed ones, as in _FromPb.
+        properties.sort(key=lambda prop: prop[0])
+
+        document = {}
+        for _, prop_start, prop_end in properties:
+            name, multiple, meaning, value_start, value_end = (
+                _read_property(pb, prop_start, prop_end))
+            if name in blacklist:
+                continue
+            value = _read_property_value(pb, value_start, value_end, meaning)
+            if multiple:
+                values = document.get(name)
+                if values is None:
+                    document[name] = [value]
+                elif isinstance(values, list):
+                    values.append(value)
+                else:
+                    raise _FastPathUnsupported()
+            elif name in document:
+                raise _FastPathUnsupported()
+            else:
+                document[name] = value
+
+        document = dict((unicode(name, 'utf-8'), value)
+                        for name, value in document.iteritems())
+    except (IndexError, UnicodeError, struct.error,
+            ProtocolBuffer.ProtocolBufferDecodeError):
+        # Let the slow path deal with (and report) malformed entities.
+        raise _FastPathUnsupported()
+
+    document['key'] = unicode(_reference_to_str(key))
+    if parent and len(path_elements) > 1:
+        parent_key = entity_pb.Reference()
+        parent_key.CopyFrom(key)
+        del parent_key.mutable_path().element_list()[-1]
+        document['parent'] = unicode(_reference_to_str(parent_key))
+    return document
+
+
+def pb_to_dict_via_entity(pb, parent=None):
+    """Convert a protocol buffer to a json-serializable dictionary.
+
+    This is the reference implementation of pb_to_dict(): it builds a full
+    datastore.Entity and transforms a copy of it.
+    """
     entity = datastore.Entity._FromPb(entity_pb.EntityProto(pb))
 
     # Create a json serializable dictionary from entity
@@ -113,14 +521,96 @@ def pre_process_entity_dict(kind, document):
                 del document[prop]
 
 
+def pb_to_json_line(pb, key="key", parent=None):
+    """Convert a protocol buffer to a "<key>\\t<json>" output line."""
+    document = pb_to_dict(pb, parent)
+    return "%s\t%s" % (document[key], json.dumps(document))
+
+
+def _pb_batch_to_json_lines(pbs, key, parent):
+    """Convert a batch of protocol buffers; run in a worker process."""
+    return [pb_to_json_line(pb, key, parent) for pb in pbs]
+
+
+def _iter_batches(iterable, batch_size):
+    """Yield lists of up to batch_size consecutive items of iterable."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iter_json_lines(pbs, key="key", parent=None, workers=1, batch_size=500):
+    """Yield the "<key>\\t<json>" line for each protocol buffer in pbs.
+
+    With workers > 1 the conversion is fanned out in batches of batch_size
+    to a pool of processes.  Lines still come out in the same order as pbs,
+    and at most a couple of batches per worker are in flight at any time,
+    so pbs can be a stream larger than memory.
+    """
+    if workers <= 1:
+        for pb in pbs:
+            yield pb_to_json_line(pb, key, parent)
+        return
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        pending = collections.deque()
+        for batch in _iter_batches(pbs, batch_size):
+            pending.append(pool.apply_async(_pb_batch_to_json_lines,
+                                            (batch, key, parent)))
+            if len(pending) >= 2 * workers:
+                for line in pending.popleft().get():
+                    yield line
+        while pending:
+            for line in pending.popleft().get():
+                yield line
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def write_pb_record(f, pb):
+    """Append a serialized protocol buffer to a length-prefixed stream."""
+    f.write(_RECORD_HEADER.pack(len(pb)))
+    f.write(pb)
+
+
+def read_pb_records(f):
+    """Yield the serialized protocol buffers of a length-prefixed stream.
+
+    Records are read one at a time, so memory use does not depend on the
+    size of the stream.
+    """
+    while True:
+        header = f.read(_RECORD_HEADER.size)
+        if not header:
+            return
+        if len(header) < _RECORD_HEADER.size:
+            raise IOError("Truncated protobuf record header")
+        (length,) = _RECORD_HEADER.unpack(header)
+        pb = f.read(length)
+        if len(pb) < length:
+            raise IOError("Truncated protobuf record: expected %d bytes, "
+                          "got %d" % (length, len(pb)))
+        yield pb
+
+
 def main():
     """Map step for the protobuf loading. Input is read from stdin."""
     options = get_cmd_line_args()
-    entity_list = pickle.load(sys.stdin)
-    for pb in entity_list:
-        document = pb_to_dict(pb, options.parent)
-        json_str = json.dumps(document)
-        print "%s\t%s" % (document[options.key], json_str)
+    if options.format == "pbstream":
+        entity_list = read_pb_records(sys.stdin)
+    else:
+        entity_list = pickle.load(sys.stdin)
+    for line in iter_json_lines(entity_list, options.key, options.parent,
+                                options.workers):
+        print line
 
 
 if __name__ == '__main__':
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""Benchmark load_pbufs_to_hive.pb_to_dict_fast against the Entity path.
+
+Builds protocol buffers shaped like our ProblemLog and UserData entities,
+checks that both converters produce the same dictionaries, and reports how
+long each takes per entity.  Run it from this directory with the appengine
+SDK importable, e.g.:
+
+  PYTHONPATH=/path/to/google_appengine python pb_to_dict_benchmark.py
+"""
+
+import datetime
+import optparse
+import random
+import timeit
+
+import load_pbufs_to_hive
+
+from google.appengine.api import datastore
+from google.appengine.api import datastore_types
+from google.appengine.api import users
+
+
+_APP = "s~khan-academy"
+_EXERCISES = ["addition_1", "subtraction_2", "multiplying_fractions",
+              "solving_quadratics_by_factoring", "derivative_intuition",
+              "graphing_linear_equations", "adding_decimals"]
+
+
+def _user(i):
+    return users.User(email="student%d@gmail.com" % i,
+                      _auth_domain="gmail.com", _strict_mode=False)
+
+
+def _user_data_key(i):
+    return datastore_types.Key.from_path("UserData", "user_id_key_%d" % i,
+                                         _app=_APP)
+
+
+def problem_log_pb(i):
+    """A serialized protobuf shaped like a ProblemLog."""
+    now = datetime.datetime(2013, 6, 1) + datetime.timedelta(seconds=i)
+    entity = datastore.Entity("ProblemLog", _app=_APP,
+        name="problem_log_%d" % i)
+    entity.update({
+        "user": _user(i % 1000),
+        "exercise": random.choice(_EXERCISES),
+        "correct": bool(i % 3),
+        "time_done": now,
+        "backup_timestamp": now,
+        "time_taken": random.randint(1, 600),
+        "problem_number": i % 40,
+        "hint_used": not i % 5,
+        "count_hints": i % 4,
+        "count_attempts": 1 + i % 3,
+        "attempts": ["%d" % random.randint(0, 100) for _ in range(3)],
+        "time_taken_attempts": [random.randint(1, 60) for _ in range(3)],
+        "hint_time_taken_list": [],
+        "seed": "%x" % random.getrandbits(64),
+        "sha1": "%x" % random.getrandbits(160),
+        "ip_address": "10.0.%d.%d" % (i % 256, (i // 256) % 256),
+        "review_mode": False,
+        "topic_mode": bool(i % 2),
+        "earned_proficiency": not i % 17,
+        "points_earned": random.randint(0, 225),
+        "exercise_non_summative": random.choice(_EXERCISES),
+        "suggested": bool(i % 2),
+        "random_float": random.random(),
+    })
+    entity.set_unindexed_properties(["attempts", "time_taken_attempts"])
+    return entity.ToPb().Encode()
+
+
+def user_data_pb(i):
+    """A serialized protobuf shaped like a UserData."""
+    joined = datetime.datetime(2012, 1, 1) + datetime.timedelta(hours=i)
+    entity = datastore.Entity("UserData", _app=_APP,
+        name="user_id_key_%d" % i)
+    entity.update({
+        "user": _user(i),
+        "current_user": _user(i),
+        "user_id": "http://googleid.khanacademy.org/%d" % i,
+        "user_email": "student%d@gmail.com" % i,
+        "user_nickname": "Student Number %d" % i,
+        "joined": joined,
+        "last_login": joined + datetime.timedelta(days=30),
+        "last_activity": joined + datetime.timedelta(days=31),
+        "backup_timestamp": joined + datetime.timedelta(days=31),
+        "birthdate": datetime.datetime(1990 + i % 15, 1 + i % 12, 1),
+        "points": random.randint(0, 10 ** 6),
+        "total_seconds_watched": random.randint(0, 10 ** 5),
+        "coaches": ["coach%d@gmail.com" % c for c in range(i % 3)],
+        "student_lists": [datastore_types.Key.from_path("StudentList",
+                                                        c + 1, _app=_APP)
+                          for c in range(i % 3)],
+        "proficient_exercises": random.sample(_EXERCISES, 4),
+        "all_proficient_exercises": _EXERCISES,
+        "suggested_exercises": random.sample(_EXERCISES, 2),
+        "badges": ["badge_%d" % b for b in range(i % 20)],
+        "gae_bingo_identity": "_gae_bingo_random:%x" % random.getrandbits(64),
+        "is_phantom": False,
+        "is_profile_public": bool(i % 2),
+        "has_current_goals": bool(i % 3),
+        "uservideocss_version": i % 7,
+        "developer": False,
+        "moderator": False,
+        "question": datastore_types.Text(
+            "Some long\nmulti-line text for student %d" % i),
+    })
+    if i % 4:
+        entity["parent_key"] = _user_data_key(i + 1)
+    return entity.ToPb().Encode()
+
+
+def time_converter(converter, pbs, repeat):
+    """Best per-entity time, in microseconds, of converting all of pbs."""
+    timer = timeit.Timer(lambda: [converter(pb, parent=True) for pb in pbs])
+    return min(timer.repeat(repeat=repeat, number=1)) * 1e6 / len(pbs)
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]",
+        description="Benchmark pb_to_dict_fast vs. pb_to_dict_via_entity.")
+    parser.add_option("-n", "--num_entities", default=2000, type="int",
+        help="Number of entities of each kind to convert. Defaults to 2000.")
+    parser.add_option("-r", "--repeat", default=3, type="int",
+        help="Number of timing runs; the best is reported. Defaults to 3.")
+    options, _ = parser.parse_args()
+
+    random.seed(0)
+    samples = [("ProblemLog", problem_log_pb), ("UserData", user_data_pb)]
+    for kind, make_pb in samples:
+        pbs = [make_pb(i) for i in xrange(options.num_entities)]
+
+        for pb in pbs:
+            slow = load_pbufs_to_hive.pb_to_dict_via_entity(pb, parent=True)
+            fast = load_pbufs_to_hive.pb_to_dict_fast(pb, parent=True)
+            assert slow == fast, "Mismatch for %s:\n%r\n%r" % (
+                kind, slow, fast)
+
+        slow_us = time_converter(load_pbufs_to_hive.pb_to_dict_via_entity,
+                                 pbs, options.repeat)
+        fast_us = time_converter(load_pbufs_to_hive.pb_to_dict_fast,
+                                 pbs, options.repeat)
+        print "%-12s via Entity: %7.1f us/entity  fast: %7.1f us/entity  " \
+              "(%.1fx)" % (kind, slow_us, fast_us, slow_us / fast_us)
+
+
+if __name__ == '__main__':
+    main()
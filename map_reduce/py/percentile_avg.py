@@ -64,8 +64,34 @@ Use two additional columns as a key:
                   get_json_object(json, '$.live' )
    ) t;
 
+Streaming:
+ With -s (--streaming), rows with the same key must be adjacent, as they
+ are after CLUSTER BY (DISTRIBUTE BY alone isn't enough). Each key's values
+ are then averaged as soon as the key changes, so only one key's values
+ are held in memory at a time, rather than all of the input. Keys are
+ output in input order rather than sorted.
+
+ ADD FILE s3://ka-mapreduce/code/[BRANCH]/py/percentile_avg.py;
+ SELECT TRANSFORM (t.seconds, t.author)
+     USING 'python percentile_avg.py -s -l 0.1 -u 0.9'
+     AS avg, key
+ FROM
+   (SELECT get_json_object(exercise.json, '$.seconds_per_fast_problem')
+             AS seconds,
+           get_json_object(exercise.json, '$.author') AS author
+    FROM exercise
+    CLUSTER BY author
+   ) t;
+
+ With -a (--approximate), keys are streamed the same way, but a key with
+ more values than fit in a buffer is summarized in a t-digest with about
+ --compression centroids, so memory is bounded however big the key is.
+ Keys that fit in the buffer are averaged exactly.
+
 """
 
+import array
+import math
 import numpy as np
 import optparse
 import re
@@ -76,8 +102,19 @@ def get_cmd_line_options():
     parser = optparse.OptionParser()
     parser.add_option("-l", "--lower_bound", type=float, default=0.1)
     parser.add_option("-u", "--upper_bound", type=float, default=0.9)
+    parser.add_option("-s", "--streaming", action="store_true",
+                      default=False,
+                      help="Average each key as soon as the next key starts; "
+                           "requires input clustered by key.")
+    parser.add_option("-a", "--approximate", action="store_true",
+                      default=False,
+                      help="Like --streaming, but with bounded memory: keys "
+                           "with many values are summarized in a t-digest.")
+    parser.add_option("-c", "--compression", type=int, default=100,
+                      help="t-digest compression for --approximate; more is "
+                           "more accurate. Defaults to 100.")
     options, _ = parser.parse_args()
-    return options.lower_bound, options.upper_bound
+    return options
 
 
 NAN_REGEX = re.compile(r'(^$|\\N)')
@@ -101,8 +138,184 @@ def decompose_line(line):
     return val, key
 
 
+def trimmed_mean(x, lower_bound, upper_bound):
+    """The mean of the sorted values x between the lower_bound and
+    upper_bound percentiles, or NaN if there are none.
+    """
+    # average the data only between the appropriate percentiles.  the
+    # "if" statements deal with insufficient data.  The behavior if
+    # there are only one or two valid rows is inconsistent with that
+    # if there's more data, but I think it's better than returning
+    # NaNs if there's not enough data
+    percentiles = np.arange(x.shape[0], dtype=float)
+    if x.shape[0] > 2:
+        percentiles = percentiles / np.max(percentiles)
+    elif x.shape[0] == 2:
+        percentiles[0] = 0.49999
+        percentiles[1] = 0.50001
+    elif x.shape[0] == 1:
+        percentiles[0] = 0.5
+    # x_gd holds the elements in x which fall within the allowed percentile
+    # range
+    x_gd = x[(percentiles >= lower_bound) & (percentiles <= upper_bound)]
+    # if there are any elements in the allowed percentile range, average
+    # over them, otherwise NaN
+    if x_gd.shape[0] > 0:
+        return np.mean(x_gd)
+    else:
+        return np.nan
+
+
+def print_average(avg, key):
+    if not np.isfinite(avg):
+        # use Hive's NaN string
+        print r'\N',
+    else:
+        # display the average within the selected percentile range
+        print avg,
+    # and print out the current key
+    print "\t%s" % key
+
+
+class TDigest(object):
+    """A merging t-digest (Dunning & Ertl, "Computing Extremely Accurate
+    Quantiles Using t-Digests"): weighted centroids that are small near the
+    extreme quantiles and bigger in the middle.
+
+    Values are buffered, and the buffer is merged into the centroids with
+    the k1 scale function whenever it fills. Until then, the buffer holds
+    every value, so small digests are exact.
+    """
+
+    def __init__(self, compression=100, buffer_size=None):
+        self.compression = compression
+        self.buffer_size = buffer_size or 10 * compression
+        self.buffer = array.array('d')
+        self.means = np.zeros(0)
+        self.weights = np.zeros(0)
+
+    def __len__(self):
+        """The number of values added."""
+        return len(self.buffer) + int(self.weights.sum())
+
+    def add(self, value):
+        self.buffer.append(value)
+        if len(self.buffer) >= self.buffer_size:
+            self.merge_buffer()
+
+    def is_exact(self):
+        return not len(self.weights)
+
+    def values(self):
+        """The sorted values added, while the digest is still exact."""
+        return np.sort(np.frombuffer(self.buffer, dtype=float))
+
+    def merge_buffer(self):
+        if not len(self.buffer):
+            return
+        means = np.concatenate([self.means,
+                                np.frombuffer(self.buffer, dtype=float)])
+        weights = np.concatenate([self.weights, np.ones(len(self.buffer))])
+        self.buffer = array.array('d')
+
+        order = np.argsort(means, kind='mergesort')
+        means = means[order]
+        weights = weights[order]
+
+        # Give every centroid the k1 scale of the middle of its quantile
+        # range, and merge the centroids within each unit of scale.
+        cumulative = np.cumsum(weights)
+        q = (cumulative - weights / 2.) / cumulative[-1]
+        k = np.floor(self.compression / (2 * math.pi) *
+                     np.arcsin(2 * q - 1))
+        starts = np.flatnonzero(np.concatenate([[True], k[1:] != k[:-1]]))
+
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+
+    def trimmed_mean(self, lower_bound, upper_bound):
+        """The mean of the values between the lower_bound and upper_bound
+        quantiles, taking the fraction of each centroid that's in range.
+        """
+        if self.is_exact():
+            return trimmed_mean(self.values(), lower_bound, upper_bound)
+
+        self.merge_buffer()
+        rank_end = np.cumsum(self.weights)
+        rank_start = rank_end - self.weights
+        total = rank_end[-1]
+        in_range = np.clip(np.minimum(rank_end, upper_bound * total) -
+                           np.maximum(rank_start, lower_bound * total),
+                           0, None)
+        if not in_range.sum():
+            return np.nan
+        return np.dot(in_range, self.means) / in_range.sum()
+
+
+def parse_value(val):
+    """val as a float, or None if it isn't finite.
+
+    Raises ValueError if val isn't a number at all.
+    """
+    val = float(val)
+    if not np.isfinite(val):
+        return None
+    return val
+
+
+def main_streaming(options):
+    """Average each run of adjacent rows with the same key."""
+
+    def new_group():
+        if options.approximate:
+            return TDigest(options.compression)
+        # A digest that never fills its buffer stays exact
+        return TDigest(buffer_size=float('inf'))
+
+    any_valid = False
+    last_key = None
+    group = new_group()
+
+    for line in sys.stdin:
+        val, key = decompose_line(line)
+        if key != last_key:
+            if len(group):
+                print_average(group.trimmed_mean(options.lower_bound,
+                                                 options.upper_bound),
+                              last_key)
+            group = new_group()
+            last_key = key
+
+        try:
+            val = parse_value(val)
+        except ValueError:
+            print >>sys.stderr, ("percentile_avg.py could not convert first "
+                                 "input column to float")
+            # and return NaN to Hive
+            print r'\N'
+            return
+
+        # throw out any rows with non-finite values
+        if val is not None:
+            any_valid = True
+            group.add(val)
+
+    if not any_valid:
+        # if there was no valid data, output Hive's NaN
+        print r'\N'
+    elif len(group):
+        print_average(group.trimmed_mean(options.lower_bound,
+                                         options.upper_bound),
+                      last_key)
+
+
 def main():
-    lower_bound, upper_bound = get_cmd_line_options()
+    options = get_cmd_line_options()
+    if options.streaming or options.approximate:
+        main_streaming(options)
+        return
+
+    lower_bound, upper_bound = options.lower_bound, options.upper_bound
 
     # load in the data, stripping linefeeds, and converting empty
     # lines and \N to nan
@@ -160,37 +373,7 @@ def main():
         # sort it
         x = np.sort(x)
 
-        # average the data only between the appropriate percentiles.  the
-        # "if" statements deal with insufficient data.  The behavior if
-        # there are only one or two valid rows is inconsistent with that
-        # if there's more data, but I think it's better than returning
-        # NaNs if there's not enough data
-        percentiles = np.arange(x.shape[0], dtype=float)
-        if x.shape[0] > 2:
-            percentiles = percentiles / np.max(percentiles)
-        elif x.shape[0] == 2:
-            percentiles[0] = 0.49999
-            percentiles[1] = 0.50001
-        elif x.shape[0] == 1:
-            percentiles[0] = 0.5
-        # x_gd holds the elements in x which fall within the allowed percentile
-        # range
-        x_gd = x[(percentiles >= lower_bound) & (percentiles <= upper_bound)]
-        # if there are any elements in the allowed percentile range, average
-        # over them, otherwise NaN
-        if x_gd.shape[0] > 0:
-            avg = np.mean(x_gd)
-        else:
-            avg = np.nan
-
-        if not np.isfinite(avg):
-            # use Hive's NaN string
-            print r'\N',
-        else:
-            # display the average within the selected percentile range
-            print avg,
-        # and print out the current key
-        print "\t%s" % key
+        print_average(trimmed_mean(x, lower_bound, upper_bound), key)
 
 if __name__ == '__main__':
     main()
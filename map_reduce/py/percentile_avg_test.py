@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+import StringIO
+import random
+import sys
+import unittest
+
+import numpy as np
+
+import percentile_avg
+
+
+class PercentileAvgTest(unittest.TestCase):
+    def setUp(self):
+        self.orig = sys.argv, sys.stdin, sys.stdout
+
+    def tearDown(self):
+        sys.argv, sys.stdin, sys.stdout = self.orig
+
+    def run_main(self, lines, args=()):
+        sys.argv = ['percentile_avg.py'] + list(args)
+        sys.stdin = StringIO.StringIO(''.join(lines))
+        sys.stdout = StringIO.StringIO()
+        percentile_avg.main()
+        return sys.stdout.getvalue().splitlines()
+
+    def clustered_lines(self):
+        rng = random.Random(0)
+        lines = []
+        for key in ['a', 'b\tx', 'c', 'd']:
+            for _ in xrange(rng.randint(1, 50)):
+                lines.append('%s\t%s\n' % (rng.expovariate(0.1), key))
+        # Values that are thrown out, and a key with only one value
+        lines += ['\\N\te\n', 'nan\te\n', '3.5\te\n', 'inf\tf\n']
+        return lines
+
+    def test_streaming_matches_default(self):
+        lines = self.clustered_lines()
+        bounds = ['-l', '0.2', '-u', '0.8']
+        default = self.run_main(lines, bounds)
+        self.assertEqual(5, len(default))
+        self.assertEqual(default, self.run_main(lines, ['-s'] + bounds))
+        # Groups that fit in the buffer are averaged exactly
+        self.assertEqual(default, self.run_main(lines, ['-a'] + bounds))
+
+    def test_no_valid_values(self):
+        for args in ([], ['-s'], ['-a']):
+            self.assertEqual(['\\N'], self.run_main(['\\N\n', '\n'], args))
+
+    def test_approximate_overflowing_buffer(self):
+        rng = random.Random(1)
+        values = [rng.lognormvariate(3, 1) for _ in xrange(20000)]
+        lines = ['%r\tkey\n' % value for value in values]
+        expected = percentile_avg.trimmed_mean(np.sort(values), 0.1, 0.9)
+
+        [line] = self.run_main(lines, ['-a', '-c', '100'])
+        approximate, key = line.split('\t')
+        self.assertEqual('key', key)
+        self.assertTrue(abs(float(approximate) - expected) / expected < 0.005)
+
+
+class TDigestTest(unittest.TestCase):
+    def test_exact_until_buffer_fills(self):
+        # A buffer of 100 values
+        digest = percentile_avg.TDigest(compression=10)
+        for value in xrange(99, 0, -1):
+            digest.add(value)
+        self.assertTrue(digest.is_exact())
+        self.assertEqual(99, len(digest))
+        self.assertEqual(range(1, 100), list(digest.values()))
+
+        digest.add(0)
+        self.assertFalse(digest.is_exact())
+        self.assertEqual(100, len(digest))
+
+    def test_merged_centroids_keep_weight_and_mean(self):
+        rng = random.Random(2)
+        values = [rng.random() for _ in xrange(5000)]
+        digest = percentile_avg.TDigest(compression=50)
+        for value in values:
+            digest.add(value)
+        digest.merge_buffer()
+        self.assertEqual(5000, digest.weights.sum())
+        self.assertTrue(len(digest.weights) < 100)
+        self.assertAlmostEqual(np.mean(values), digest.trimmed_mean(0, 1))
+        self.assertTrue(np.all(np.diff(digest.means) >= 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
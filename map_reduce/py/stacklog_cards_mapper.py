@@ -12,21 +12,26 @@ done in topic mode.
 import json
 import sys
 
+import json_fields
+
 
 def main():
+    stack_fields = json_fields.FieldExtractor(
+        ['topic_mode', 'topic_id', 'extra_data', 'cards_list'])
+    extra_data_fields = json_fields.FieldExtractor(['segment'])
 
     for line in sys.stdin:
 
         user_id, data_json, date = line.strip().split('\t')
-        data = json.loads(data_json)
+        data = stack_fields.extract(data_json)
 
         # TODO(david): Get stacks from practice mode as well.
         if not data['topic_mode']:
             continue
 
         topic_id = data['topic_id']
-        extra_data = json.loads(data['extra_data'])
-        cards_list = json.loads(data['cards_list'])
+        extra_data = extra_data_fields.extract(data['extra_data'])
+        cards_list = json_fields.loads(data['cards_list'])
 
         for card in cards_list:
 
@@ -5,9 +5,10 @@ and group and normalize for custom reducer functions.
 # TODO(david): Tests. Really. This is very testable.
 
 
-import json
 import sys
 
+import json_fields
+
 
 def parse_user_topic_input(callback):
     """Takes input from stdin -- exercise attempts done in topic mode clustered
@@ -55,7 +56,7 @@ def parse_user_topic_input(callback):
 
         correct = correct == 'true'
         problem_number = int(problem_number)
-        scheduler_info = json.loads(scheduler_info)
+        scheduler_info = json_fields.loads(scheduler_info)
         attempts.append((correct, problem_number, scheduler_info))
 
         prev_user_topic = user_topic
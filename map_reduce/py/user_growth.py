@@ -12,15 +12,20 @@ emits time series of the account state changes.  Currently, the logic
 computes three time series:  joins, deactivations, and reactivations.
 """
 
-import datetime
+import array
 import sys
 
+import windowed_cohort
+
 g_err_late_join = 0
 # start_dt and end_dt define the date range for which to output data.
 # end_dt defines the as-of date of the ouput, which is necessary to
 # detect when a user history ends in deactivation.
 g_start_dt = None
 g_end_dt = None
+g_end_day = None
+
+g_day_numbers = windowed_cohort.DayNumbers()
 
 # The following constant parameterizes our definition of an "active" user.
 # We define an active user as a user with at least one active visit in the last
@@ -36,41 +41,28 @@ def emit_data_point(dt, series, value):
         print "%s\t%s\t%s" % (dt, series, str(value))
 
 
-def emit_deactivation(last_date):
-    deactivation_date = last_date + datetime.timedelta(days=WINDOW_LEN)
-    deactivation_dt = deactivation_date.strftime('%Y-%m-%d')
-    emit_data_point(deactivation_dt, 'deactivations', 1)
-
-
 def emit_delta_series(activity):
     global g_err_late_join
 
     # Loop through daily activity (assume it's sorted by dt)
-    last_date = None
+    days = array.array('i')
     for act in activity:
         user, dt, joined = act
 
         if joined == 'true':
             emit_data_point(dt, 'joins', 1)
-            if last_date:
+            if days:
                 # I would not expect the join to be set on any but the
                 # first day of activity.  Double check that.
                 g_err_late_join += 1
 
-        curr_date = datetime.datetime.strptime(dt, '%Y-%m-%d')
-
-        if last_date and (curr_date - last_date).days > WINDOW_LEN:
-            # emit a deactivation and a re-activation
-            emit_deactivation(last_date)
-
-            emit_data_point(dt, 'reactivations', 1)
-
-        last_date = curr_date
+        days.append(g_day_numbers.day(dt))
 
-    # make sure to emit a deactivation if the stream ends with inactivity
-    end_date = datetime.datetime.strptime(g_end_dt, '%Y-%m-%d')
-    if last_date and (end_date - last_date).days > WINDOW_LEN:
-        emit_deactivation(last_date)
+    # Deactivations after more than WINDOW_LEN days without activity,
+    # including at the end of the stream, and reactivations after them
+    for series, day in windowed_cohort.activity_changes(days, g_end_day,
+                                                        WINDOW_LEN):
+        emit_data_point(g_day_numbers.string(day), series, 1)
 
 
 def main():
@@ -79,31 +71,16 @@ def main():
         print >>sys.stderr, "Incorrect usage.  Supply start_dt and end_dt."
         exit(1)
 
-    global g_start_dt, g_end_dt
+    global g_start_dt, g_end_dt, g_end_day
     g_start_dt, g_end_dt = sys.argv[1:3]
+    g_end_day = g_day_numbers.day(g_end_dt)
 
-    prev_user = None
-    activity = []
-
-    for line in sys.stdin:
-        day_activity = tuple(line.rstrip('\n').split('\t'))
-
-        user = day_activity[0]
-
-        if not user:
-            continue  # blank user
-
-        if user != prev_user:
-            # We're getting a new user, so perform the reduce operation
-            # on the current user's activity sequence
-            emit_delta_series(activity)
-            activity = []
-
-        prev_user = user
-
-        activity.append(day_activity)
+    rows = (tuple(line.rstrip('\n').split('\t')) for line in sys.stdin)
+    rows = (row for row in rows if row[0])  # skip blank users
 
-    emit_delta_series(activity)
+    # Perform the reduce operation on each user's activity sequence
+    for user, activity in windowed_cohort.entity_runs(rows):
+        emit_delta_series(activity)
 
     print >>sys.stderr, "Finished main. %d late join errors." % g_err_late_join
 
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+"""Computes video recommendations on one machine, in place of the Hive
+pipeline in video_recommendation.q (video_recommendation_reducer.py, the
+co-occurrence count join and video_recommendation_pruner.py).
+
+Takes from stdin lines of
+    (user, video, timestamp)
+meaning user completed video at UNIX time timestamp, tab or \\x01 delimited.
+Rows of the user_vid_completion table, with its video title third, work
+too. If a user completed a video more than once, the earliest time counts.
+
+The users' completions make a sparse user x video matrix A, so A^T A holds
+how many users completed both video i and video j (preceed_count +
+succeed_count in the pipeline), with each video's completion count on its
+diagonal. Every pair is scored with
+video_recommendation_pruner.compute_score, and only pairs at least
+--min_cooccurrence users completed both of are kept.
+
+Outputs, like video_recommendation_pruner.py, the NUM_BEST best scoring
+(video_i, video_j, score)
+for each video_i. With --ordered, each line also has the preceed_count and
+succeed_count of the pair: how many users completed video_i first, and how
+many video_j first. (Users who completed both at the same time count as
+completing the one that first appeared in the input first.)
+
+Example:
+    hive -e "SELECT user, vid_key, completion_time
+             FROM user_vid_completion_${suffix}" |
+        video_recommendation_engine.py --ordered > video_suggestions.txt
+"""
+
+import optparse
+import sys
+
+import numpy as np
+import scipy.sparse
+
+import video_recommendation_pruner
+
+
+_IN = sys.stdin  # For unit testing.
+_OUT = sys.stdout
+
+
+# Most (user, pair) lookups made at once when counting ordered pairs
+ORDERED_CHUNK_SIZE = 10000000
+
+
+class Completions(object):
+    """The earliest completion time of each video by each user, with users
+    and videos numbered in the order they first appear.
+    """
+
+    def __init__(self, lines):
+        user_numbers = {}
+        video_numbers = {}
+        self.video_names = []
+        users = []
+        videos = []
+        times = []
+
+        for line in lines:
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            parts = line.split('\x01' if '\x01' in line else '\t')
+            if len(parts) == 4:
+                # user, vid_key, vid_title, completion_time
+                parts = [parts[0], parts[1], parts[3]]
+            if len(parts) != 3:
+                sys.stderr.write("Malformed input: '%s'!\n" % line)
+                continue
+
+            user, video, timestamp = parts
+            try:
+                timestamp = float(timestamp)
+            except ValueError:
+                sys.stderr.write("Malformed input: '%s'!\n" % line)
+                continue
+
+            if video not in video_numbers:
+                video_numbers[video] = len(self.video_names)
+                self.video_names.append(video)
+            users.append(user_numbers.setdefault(user, len(user_numbers)))
+            videos.append(video_numbers[video])
+            times.append(timestamp)
+
+        self.num_users = len(user_numbers)
+        self.num_videos = len(self.video_names)
+
+        # Sort by (user, video, time) and keep the first of each (user, video)
+        users = np.array(users, dtype=np.int64)
+        videos = np.array(videos, dtype=np.int64)
+        times = np.array(times, dtype=np.float64)
+        order = np.lexsort((times, videos, users))
+        keys = users[order] * self.num_videos + videos[order]
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = keys[1:] != keys[:-1]
+
+        # Sorted, so (user, video)'s time can be found by binary search
+        self.keys = keys[first]
+        self.users = users[order][first]
+        self.videos = videos[order][first]
+        self.times = times[order][first]
+
+    def matrix(self):
+        """The user x video matrix of completions, in CSR form."""
+        return scipy.sparse.csr_matrix(
+            (np.ones(len(self.keys), dtype=np.int64),
+             (self.users, self.videos)),
+            shape=(self.num_users, self.num_videos))
+
+
+def cooccurrence(completion_matrix):
+    """The video x video matrix of how many users completed both videos,
+    in CSR form with sorted indices, and the completion count of each video.
+    """
+    counts = (completion_matrix.T * completion_matrix).tocsr()
+    video_counts = counts.diagonal()
+    counts.setdiag(0)
+    counts.eliminate_zeros()
+    counts.sort_indices()
+    return counts, video_counts
+
+
+def best_pairs(counts, video_counts, num_best, min_cooccurrence):
+    """The num_best best scoring pairs for each video.
+
+    Returns arrays (video_i, video_j, score), sorted by video_i and then
+    by descending score.
+    """
+    video_i = np.repeat(np.arange(counts.shape[0]), np.diff(counts.indptr))
+    video_j = counts.indices
+    cooccurring = counts.data
+
+    keep = cooccurring >= min_cooccurrence
+    video_i = video_i[keep]
+    video_j = video_j[keep]
+    cooccurring = cooccurring[keep]
+
+    # compute_score, for every pair at once
+    scores = cooccurring / (np.sqrt(video_counts[video_i].astype(np.float64)) *
+                            np.sqrt(video_counts[video_j].astype(np.float64)))
+
+    # Rank each video's pairs by score, ties by video_j, and cut at num_best
+    order = np.lexsort((video_j, -scores, video_i))
+    video_i = video_i[order]
+    first_of_video = np.searchsorted(video_i, video_i)
+    top = np.arange(len(video_i)) - first_of_video < num_best
+    return video_i[top], video_j[order][top], scores[order][top]
+
+
+def ordered_counts(completions, completion_matrix, video_i, video_j):
+    """How many users completed video_i before video_j, and after, for each
+    pair of the given arrays.
+    """
+    by_video = completion_matrix.tocsc()
+    by_video.sort_indices()
+    starts = by_video.indptr[video_i]
+    lengths = by_video.indptr[video_i + 1] - starts
+
+    preceed = np.zeros(len(video_i), dtype=np.int64)
+    succeed = np.zeros(len(video_i), dtype=np.int64)
+
+    # A chunk of pairs at a time, look up video_j's time for every user who
+    # completed video_i.
+    lookups_through = np.cumsum(lengths)
+    chunk_start = 0
+    while chunk_start < len(video_i):
+        lookups_before = lookups_through[chunk_start - 1] if chunk_start else 0
+        chunk_end = max(chunk_start + 1, np.searchsorted(
+            lookups_through, lookups_before + ORDERED_CHUNK_SIZE,
+            side='right'))
+        pairs = np.arange(chunk_start, chunk_end)
+        chunk_start = chunk_end
+
+        pair_of = np.repeat(pairs, lengths[pairs])
+        offsets = np.arange(len(pair_of)) - np.repeat(
+            np.cumsum(lengths[pairs]) - lengths[pairs], lengths[pairs])
+        users = by_video.indices[starts[pair_of] + offsets].astype(np.int64)
+
+        i_keys = users * completions.num_videos + video_i[pair_of]
+        j_keys = users * completions.num_videos + video_j[pair_of]
+        j_at = np.searchsorted(completions.keys, j_keys)
+        j_at = np.minimum(j_at, len(completions.keys) - 1)
+        both = completions.keys[j_at] == j_keys
+
+        i_times = completions.times[np.searchsorted(completions.keys,
+                                                    i_keys[both])]
+        j_times = completions.times[j_at[both]]
+        pair_of = pair_of[both]
+        i_sorts_first = video_i[pair_of] < video_j[pair_of]
+        i_first = (i_times < j_times) | ((i_times == j_times) & i_sorts_first)
+
+        preceed += np.bincount(pair_of[i_first], minlength=len(video_i))
+        succeed += np.bincount(pair_of[~i_first], minlength=len(video_i))
+
+    return preceed, succeed
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(
+        description="Compute the best video recommendations for each video "
+                    "from (user, video, timestamp) completions on stdin.")
+    parser.add_option("--num_best", type="int",
+        default=video_recommendation_pruner.NUM_BEST,
+        help="Number of recommendations per video. Defaults to %d." %
+             video_recommendation_pruner.NUM_BEST)
+    parser.add_option("--min_cooccurrence", type="int", default=20,
+        help="Ignore pairs of videos fewer than this many users completed "
+             "both of. Defaults to 20, like video_recommendation.q.")
+    parser.add_option("--ordered", action="store_true", default=False,
+        help="Also output how many users completed each pair's videos in "
+             "each order.")
+    options, _ = parser.parse_args(argv)
+
+    completions = Completions(_IN)
+    completion_matrix = completions.matrix()
+    counts, video_counts = cooccurrence(completion_matrix)
+    video_i, video_j, scores = best_pairs(
+        counts, video_counts, options.num_best, options.min_cooccurrence)
+
+    columns = [[completions.video_names[i] for i in video_i.tolist()],
+               [completions.video_names[j] for j in video_j.tolist()],
+               [str(score) for score in scores.tolist()]]
+    if options.ordered:
+        preceed, succeed = ordered_counts(completions, completion_matrix,
+                                          video_i, video_j)
+        columns += [map(str, preceed.tolist()), map(str, succeed.tolist())]
+
+    delimiter = video_recommendation_pruner.DELIMITER
+    for row in zip(*columns):
+        _OUT.write(delimiter.join(row) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import StringIO
+import random
+import unittest
+
+import video_recommendation_engine
+import video_recommendation_pruner
+import video_recommendation_reducer
+
+
+class EngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.orig_in = video_recommendation_engine._IN
+        self.orig_out = video_recommendation_engine._OUT
+        video_recommendation_engine._OUT = StringIO.StringIO()
+
+    def tearDown(self):
+        video_recommendation_engine._IN = self.orig_in
+        video_recommendation_engine._OUT = self.orig_out
+
+    def random_completions(self, num_users, num_videos):
+        rng = random.Random(2)
+        lines = []
+        for user in xrange(num_users):
+            for video in rng.sample(xrange(num_videos),
+                                    rng.randint(1, num_videos)):
+                # Distinct times, so the order of any two is clear
+                lines.append("user%d\tvideo%d\t%d.25\n" % (
+                    user, video, user * num_videos + rng.randint(0, 1000)))
+        return lines
+
+    def run_engine(self, lines, args=()):
+        video_recommendation_engine._IN = lines
+        video_recommendation_engine.main(list(args))
+        output = video_recommendation_engine._OUT.getvalue()
+        return [line.split("\t") for line in output.splitlines()]
+
+    def pipeline_counts(self, lines):
+        """The video_cooccurrence_cnt table video_recommendation.q builds."""
+        old_in = video_recommendation_reducer._in
+        old_out = video_recommendation_reducer._out
+        video_recommendation_reducer._in = lines
+        video_recommendation_reducer._out = out = StringIO.StringIO()
+        try:
+            video_recommendation_reducer.main([])
+        finally:
+            video_recommendation_reducer._in = old_in
+            video_recommendation_reducer._out = old_out
+
+        pairs = {}
+        for line in out.getvalue().splitlines():
+            vid1, vid2, preceed, succeed = line.split("\t")
+            sums = pairs.get((vid1, vid2), (0, 0))
+            pairs[(vid1, vid2)] = (sums[0] + int(preceed),
+                                   sums[1] + int(succeed))
+
+        video_counts = {}
+        for line in lines:
+            video = line.split("\t")[1]
+            video_counts[video] = video_counts.get(video, 0) + 1
+        return pairs, video_counts
+
+    def test_matches_pipeline(self):
+        lines = self.random_completions(60, 15)
+        pairs, video_counts = self.pipeline_counts(lines)
+        output = self.run_engine(lines, ["--min_cooccurrence", "5",
+                                         "--num_best", "4", "--ordered"])
+
+        best = {}
+        for vid1, vid2, score, preceed, succeed in output:
+            self.assertEqual(pairs[(vid1, vid2)],
+                             (int(preceed), int(succeed)))
+            self.assertTrue(int(preceed) + int(succeed) >= 5)
+            self.assertAlmostEqual(
+                video_recommendation_pruner.compute_score(
+                    int(preceed), int(succeed),
+                    video_counts[vid1], video_counts[vid2]),
+                float(score))
+            best.setdefault(vid1, []).append(float(score))
+
+        # Each video gets its 4 best scores
+        for vid1, scores in best.iteritems():
+            expected = sorted([
+                video_recommendation_pruner.compute_score(
+                    p, s, video_counts[v1], video_counts[v2])
+                for ((v1, v2), (p, s)) in pairs.iteritems()
+                if v1 == vid1 and p + s >= 5], reverse=True)[:4]
+            for e, a in zip(expected, scores):
+                self.assertAlmostEqual(e, a)
+            self.assertEqual(len(expected), len(scores))
+
+    def test_earliest_completion_counts(self):
+        lines = ["u1\tv1\t5\n", "u1\tv2\t3\n", "u1\tv1\t1\n",
+                 "u2\x01v1\x01Video one\x016\n",
+                 "u2\x01v2\x01Video two\x012\n"]
+        output = self.run_engine(lines, ["--min_cooccurrence", "1",
+                                         "--ordered"])
+        self.assertEqual([["v1", "v2", "1.0", "1", "1"],
+                          ["v2", "v1", "1.0", "1", "1"]], output)
+
+    def test_chunks(self):
+        lines = self.random_completions(30, 10)
+        args = ["--min_cooccurrence", "1", "--ordered"]
+        expected = self.run_engine(lines, args)
+        video_recommendation_engine._OUT = StringIO.StringIO()
+        old_chunk_size = video_recommendation_engine.ORDERED_CHUNK_SIZE
+        video_recommendation_engine.ORDERED_CHUNK_SIZE = 7
+        try:
+            self.assertEqual(expected, self.run_engine(lines, args))
+        finally:
+            video_recommendation_engine.ORDERED_CHUNK_SIZE = old_chunk_size
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -24,6 +24,14 @@ where
     indicator_i is 1 iff the user watched video_i before video_j,
 and indicator_j is 1 iff the user watched video_j before video_i
 
+With --combine, pairs are instead counted across all of the users this
+reducer sees, and each pair of videos is output (twice, as above) just once
+with its summed indicators, so the output shrinks from the number of pairs
+users watched to the number of distinct pairs. The indicators are then
+counts, which the Hive GROUP BY over this reducer's output sums all the same.
+--max_videos_per_user caps the pairs a heavy user contributes by sampling
+that many of their videos.
+
 For more information on this project and a higher-level overview of what's
 happening, see:
 https://sites.google.com/a/khanacademy.org/forge/technical/data_n/collaborative-filtering-with-emr
@@ -32,8 +40,11 @@ https://sites.google.com/a/khanacademy.org/forge/technical/data_n/collaborative-
 
 
 import itertools
+import optparse
 import sys
 
+import numpy as np
+
 
 _out = sys.stdout  # For testing purposes
 _in = sys.stdin  # For testing purposes
@@ -61,11 +72,159 @@ def emit_reducer_output(videos):
         output_tab_delimited(vid_i[0], vid_j[0], i_before_j, 1 - i_before_j)
 
 
-def main():
+# Most pairs handled at once by PairCounter, to bound its memory use
+PAIR_CHUNK_SIZE = 1000000
+
+
+def ordered_pairs(n):
+    """Yield (first, second) index arrays covering every pair
+    0 <= first < second < n, in chunks of at most about PAIR_CHUNK_SIZE pairs.
+
+    """
+    if n * (n - 1) / 2 <= PAIR_CHUNK_SIZE:
+        yield np.triu_indices(n, 1)
+        return
+
+    # Too many to do at once: a row of the triangle at a time
+    for i in xrange(n - 1):
+        yield (np.repeat(i, n - 1 - i), np.arange(i + 1, n))
+
+
+class PairCounter(object):
+    """Counts ordered video pairs across users, for --combine.
+
+    Videos are numbered as they are first seen, and the pair (lo, hi) of
+    video numbers lo < hi is keyed by lo << 32 | hi, with a preceed count
+    (users who watched lo first) and a succeed count (users who watched hi
+    first). Pairs are counted with numpy a chunk at a time, and the distinct
+    pairs are emitted whenever there are more than flush_pairs of them.
+
+    """
+    def __init__(self, flush_pairs, max_videos_per_user=None, seed=0):
+        self.flush_pairs = flush_pairs
+        self.max_videos_per_user = max_videos_per_user
+        self.random_state = np.random.RandomState(seed)
+
+        self.video_numbers = {}
+        self.video_names = []
+
+        # Combined counts so far
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.preceed = np.zeros(0, dtype=np.int64)
+        self.succeed = np.zeros(0, dtype=np.int64)
+
+        # (keys, lo_first) arrays not yet combined into the counts
+        self.pending = []
+        self.pending_size = 0
+
+    def video_number(self, video):
+        number = self.video_numbers.get(video)
+        if number is None:
+            number = self.video_numbers[video] = len(self.video_names)
+            self.video_names.append(video)
+        return number
+
+    def add_user(self, videos):
+        """Count the pairs in all videos a user watched (list of tuples of
+        (video, timestamp)).
+
+        """
+        if len(videos) < 2:
+            return
+
+        numbers = np.array([self.video_number(video)
+                            for (video, _) in videos], dtype=np.int64)
+        timestamps = np.array([float(timestamp)
+                               for (_, timestamp) in videos])
+
+        # Videos by time watched. emit_reducer_output counts the later of
+        # two videos watched at the same time as watched first, so break
+        # ties by reverse input order (mergesort is stable).
+        reverse = np.arange(len(videos))[::-1]
+        order = reverse[np.argsort(timestamps[reverse], kind='mergesort')]
+
+        if (self.max_videos_per_user and
+                len(order) > self.max_videos_per_user):
+            keep = self.random_state.choice(
+                len(order), self.max_videos_per_user, replace=False)
+            order = order[np.sort(keep)]
+
+        ordered_numbers = numbers[order]
+        for (first, second) in ordered_pairs(len(ordered_numbers)):
+            first = ordered_numbers[first]
+            second = ordered_numbers[second]
+            lo = np.minimum(first, second)
+            hi = np.maximum(first, second)
+            self.pending.append(((lo << 32) | hi, first == lo))
+            self.pending_size += len(lo)
+
+            if self.pending_size >= PAIR_CHUNK_SIZE:
+                self.combine()
+
+    def combine(self):
+        """Combine pending pairs into the counts, emitting if there are too
+        many distinct pairs to hold on to.
+
+        """
+        if not self.pending:
+            return
+
+        keys = np.concatenate([self.keys] + [k for (k, _) in self.pending])
+        lo_first = np.concatenate([lo_first for (_, lo_first) in self.pending])
+        preceed = np.concatenate([self.preceed, lo_first])
+        succeed = np.concatenate([self.succeed, ~lo_first])
+        self.pending = []
+        self.pending_size = 0
+
+        self.keys, inverse = np.unique(keys, return_inverse=True)
+        self.preceed = np.bincount(inverse, weights=preceed).astype(np.int64)
+        self.succeed = np.bincount(inverse, weights=succeed).astype(np.int64)
+
+        if len(self.keys) > self.flush_pairs:
+            self.emit()
+
+    def emit(self):
+        """Output the counts of every pair so far, and start over."""
+        self.combine()
+
+        names = self.video_names
+        for (key, preceed, succeed) in itertools.izip(
+                self.keys.tolist(), self.preceed.tolist(),
+                self.succeed.tolist()):
+            output_tab_delimited(names[key >> 32], names[key & 0xffffffff],
+                                 preceed, succeed)
+
+        self.keys = self.keys[:0]
+        self.preceed = self.preceed[:0]
+        self.succeed = self.succeed[:0]
+
+
+def main(argv=None):
     """Get the input, aggregate all videos and timestamps for each user,
     and pass that to the function that emits it in correct format.
 
     """
+    parser = optparse.OptionParser()
+    parser.add_option("--combine", action="store_true", default=False,
+        help="Sum the indicators of each pair of videos over all users, "
+             "instead of outputting each user's pairs.")
+    parser.add_option("--flush_pairs", type="int", default=5000000,
+        help="With --combine, output the counts so far whenever there are "
+             "more than this many distinct pairs. Defaults to 5000000.")
+    parser.add_option("--max_videos_per_user", type="int", default=None,
+        help="With --combine, only count pairs among this many of each "
+             "user's videos, sampled at random.")
+    parser.add_option("--seed", type="int", default=0,
+        help="Random seed for --max_videos_per_user. Defaults to 0.")
+    options, _ = parser.parse_args(argv)
+
+    if options.combine:
+        counter = PairCounter(options.flush_pairs,
+                              options.max_videos_per_user, options.seed)
+        emit = counter.add_user
+    else:
+        emit = emit_reducer_output
+
     # Initialize so we can use it later
     last_user = None
     videos = []
@@ -77,6 +236,8 @@ def main():
         line = line.rstrip().split("\t")
         if len(line) != 3:
             sys.stderr.write("Malformed input: '%s'!\n" % "\t".join(line))
+            if options.combine:
+                counter.emit()
             return
 
         (user, video, timestamp) = line
@@ -84,11 +245,14 @@ def main():
         if last_user == user:
             videos.append((video, timestamp))
         else:
-            emit_reducer_output(videos)  # If len(videos) <= 1, this is no-op
+            emit(videos)  # If len(videos) <= 1, this is no-op
             videos = [(video, timestamp)]
         last_user = user
 
-    emit_reducer_output(videos)  # Make sure we emit for the last user
+    emit(videos)  # Make sure we emit for the last user
+
+    if options.combine:
+        counter.emit()
 
 if __name__ == '__main__':
     main()
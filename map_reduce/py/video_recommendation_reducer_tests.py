@@ -1,3 +1,4 @@
+import random
 import StringIO
 import unittest
 
@@ -31,11 +32,11 @@ class Utils(unittest.TestCase):
         # Clean this up; we don't need it anymore
         INPUT = []
 
-    def run_reducer(self):
+    def run_reducer(self, args=()):
         global OUTPUT
         """Make reducer use our input, output files, run it, close them."""
 
-        video_recommendation_reducer.main()
+        video_recommendation_reducer.main(list(args))
 
         OUTPUT = OUTPUT.getvalue().split("\n")
         if OUTPUT[-1] == "":
@@ -158,5 +159,68 @@ class VideoRecommenderTest(Utils):
 
         self.generic_test(to_write, expected)
 
+
+class CombineTest(Utils):
+
+    def summed_output(self):
+        """Read the output, summing the indicators of repeated pairs."""
+        sums = {}
+        for (video_i, video_j, i, j) in self.read_output():
+            (sum_i, sum_j) = sums.get((video_i, video_j), (0, 0))
+            sums[(video_i, video_j)] = (sum_i + int(i), sum_j + int(j))
+        return sums
+
+    def run_both(self, to_write, args=()):
+        """Return the summed output without and with --combine."""
+        global INPUT, OUTPUT
+        self.write_input(to_write)
+        self.run_reducer()
+        expected = self.summed_output()
+
+        video_recommendation_reducer._out = OUTPUT = StringIO.StringIO()
+        self.run_reducer(["--combine"] + list(args))
+        return expected, self.summed_output()
+
+    def random_input(self, num_users, num_videos, max_time=20):
+        rng = random.Random(4)
+        to_write = []
+        for user in xrange(num_users):
+            videos = rng.sample(xrange(num_videos),
+                                rng.randint(1, num_videos))
+            for video in videos:
+                # Small range of times, so there are ties
+                to_write.append(("user%d" % user, "video%d" % video,
+                                 "%d.5" % rng.randint(0, max_time)))
+        return to_write
+
+    def test_matches_per_user_output(self):
+        expected, combined = self.run_both(self.random_input(50, 12))
+        self.assertEqual(expected, combined)
+        # Each pair is output just once in each direction
+        self.assertEqual(len(combined), len(self.read_output()))
+
+    def test_flush(self):
+        expected, combined = self.run_both(self.random_input(30, 8),
+                                           ["--flush_pairs", "5"])
+        self.assertEqual(expected, combined)
+
+    def test_chunked_pairs(self):
+        old_chunk_size = video_recommendation_reducer.PAIR_CHUNK_SIZE
+        video_recommendation_reducer.PAIR_CHUNK_SIZE = 7
+        try:
+            expected, combined = self.run_both(self.random_input(10, 9))
+        finally:
+            video_recommendation_reducer.PAIR_CHUNK_SIZE = old_chunk_size
+        self.assertEqual(expected, combined)
+
+    def test_max_videos_per_user(self):
+        to_write = [("user1", "video%d" % i, str(i)) for i in xrange(10)]
+        _, combined = self.run_both(to_write, ["--max_videos_per_user", "4"])
+        self.assertEqual(12, len(combined))
+        for ((video_i, video_j), (i, j)) in combined.iteritems():
+            self.assertEqual(int(video_i < video_j), i)
+            self.assertEqual(int(video_i > video_j), j)
+
+
 if __name__ == "__main__":
     unittest.main()
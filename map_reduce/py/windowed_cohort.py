@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+"""Streaming building blocks for date-windowed, per-entity metrics.
+
+Our growth and engagement reducers (user_growth.py, coach_reduce.py) all
+read a sorted stream of (entity, dt, ...) rows and track each entity's
+activity over windows of days. This module holds the shared pieces:
+
+  DayNumbers - dates as integer day numbers, parsing each date string once
+  entity_runs - split a stream clustered by entity into per-entity runs
+  activity_changes - deactivations and reactivations in an entity's days
+  SlidingWindow, emit_window_counts - entities active on N of the last M
+      days, updated incrementally as days enter and leave the window
+  cohort_retention - the periods after its first one an entity was active
+
+Days are integers everywhere (days since 1970-01-01), so windows are just
+arithmetic, and per-entity state lives in arrays rather than dicts of
+date objects. user_growth.q and student_teacher_current.q (which
+student_teacher_count.q runs) ADD FILE this module for their reducers.
+
+windowed_cohort_benchmark.py times these on a synthetic year of activity.
+"""
+
+import array
+import collections
+import datetime
+import itertools
+import operator
+
+
+DATE_FORMAT = '%Y-%m-%d'
+
+_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+# Day number of the first Monday after the epoch, so weekly cohorts
+# start on Mondays
+MONDAY = 4
+
+
+class DayNumbers(object):
+    """Converts date strings to day numbers and back, remembering each
+    conversion, since the same few hundred dates repeat on every row.
+    """
+
+    def __init__(self, date_format=DATE_FORMAT):
+        self.date_format = date_format
+        self._days = {}
+        self._strings = {}
+
+    def day(self, dt):
+        """The day number of date string dt."""
+        try:
+            return self._days[dt]
+        except KeyError:
+            day = datetime.datetime.strptime(
+                dt, self.date_format).toordinal() - _EPOCH_ORDINAL
+            self._days[dt] = day
+            return day
+
+    def string(self, day):
+        """The date string of day number day."""
+        try:
+            return self._strings[day]
+        except KeyError:
+            dt = datetime.date.fromordinal(day + _EPOCH_ORDINAL).strftime(
+                self.date_format)
+            self._strings[day] = dt
+            return dt
+
+
+def entity_runs(rows, entity_index=0):
+    """Yield (entity, list of rows) for each run of consecutive rows with
+    the same entity, as Hive's DISTRIBUTE BY/SORT BY delivers them.
+    """
+    for entity, run in itertools.groupby(
+            rows, operator.itemgetter(entity_index)):
+        yield entity, list(run)
+
+
+def activity_changes(days, end_day, window):
+    """Yield ('deactivations', day) and ('reactivations', day) for an
+    entity active on the ascending day numbers days.
+
+    An entity deactivates window days after any active day followed by
+    more than window inactive days, including if end_day is more than
+    window days after its last day, and reactivates on the day it's next
+    active.
+    """
+    last_day = None
+    for day in days:
+        if last_day is not None and day - last_day > window:
+            yield 'deactivations', last_day + window
+            yield 'reactivations', day
+        last_day = day
+
+    if last_day is not None and end_day - last_day > window:
+        yield 'deactivations', last_day + window
+
+
+def cohort_retention(days, period=7, align=MONDAY):
+    """The cohort of an entity active on the ascending day numbers days,
+    and the periods it was active in.
+
+    Returns (cohort_day, offsets): cohort_day is the first day of the
+    period of the entity's first active day, periods starting on days
+    congruent to align modulo period, and offsets is the ascending list of
+    periods since then (0 being the cohort's own) with any activity.
+    """
+    if not days:
+        return None, []
+    cohort_day = days[0] - (days[0] - align) % period
+    offsets = []
+    for day in days:
+        offset = (day - cohort_day) // period
+        if not offsets or offsets[-1] != offset:
+            offsets.append(offset)
+    return cohort_day, offsets
+
+
+class SlidingWindow(object):
+    """Counts, over a sliding window of days, on how many of them each key
+    was active, and how many keys were active on at least min_days of them.
+
+    Days enter the window with add_day and leave it with expire_before, and
+    each only updates the counts of the keys active that day. Keys are
+    numbered as they're first seen, and their counts kept in an array.
+    on_activate and on_deactivate, if given, are called with a key as it
+    starts and stops counting.
+    """
+
+    def __init__(self, min_days, on_activate=None, on_deactivate=None):
+        self.min_days = min_days
+        self.on_activate = on_activate
+        self.on_deactivate = on_deactivate
+        self.days = collections.deque()  # (day, key numbers active that day)
+        self.key_numbers = {}
+        self.keys = []
+        self.day_counts = array.array('i')
+        self.num_active = 0
+
+    def key_number(self, key):
+        number = self.key_numbers.get(key)
+        if number is None:
+            number = self.key_numbers[key] = len(self.keys)
+            self.keys.append(key)
+            self.day_counts.append(0)
+        return number
+
+    def add_day(self, day, keys):
+        numbers = array.array('i', [self.key_number(key) for key in keys])
+        self.days.append((day, numbers))
+        day_counts = self.day_counts
+        for number in numbers:
+            day_counts[number] += 1
+            if day_counts[number] == self.min_days:
+                self.num_active += 1
+                if self.on_activate:
+                    self.on_activate(self.keys[number])
+
+    def expire_before(self, day):
+        """Drop the days before day from the window."""
+        day_counts = self.day_counts
+        while self.days and self.days[0][0] < day:
+            _, numbers = self.days.popleft()
+            for number in numbers:
+                day_counts[number] -= 1
+                if day_counts[number] == self.min_days - 1:
+                    self.num_active -= 1
+                    if self.on_deactivate:
+                        self.on_deactivate(self.keys[number])
+
+
+def daily_keys(rows, day_numbers):
+    """Group (key, dt) rows sorted by dt into (day, set of keys) per day."""
+    for dt, run in itertools.groupby(rows, operator.itemgetter(1)):
+        yield day_numbers.day(dt), set(key for key, _ in run)
+
+
+def emit_window_counts(days, end_day, window_days, window, get_count, emit):
+    """Call emit(day, get_count()) for every day from the first of days
+    until end_day exclusive, counting the activity of the window_days days
+    before each day (but not the day itself).
+
+    Arguments:
+      days - (day, set of keys) for each day with activity, in order
+      end_day - day number until which to emit counts
+      window_days - how many days back activity counts
+      window - the SlidingWindow to add the days to
+      get_count - function returning the count to emit for a day
+      emit - function called with each day and its count
+    """
+
+    def emit_through(day, keys, until):
+        """Emit the days from day until until, counting day's activity
+        from the day after it."""
+        if day < until:
+            window.expire_before(day - window_days)
+            emit(day, get_count())
+        window.add_day(day, keys)
+        for emit_day in xrange(day + 1, until):
+            window.expire_before(emit_day - window_days)
+            emit(emit_day, get_count())
+
+    last_day = None
+    last_keys = None
+    for day, keys in days:
+        if last_day is not None:
+            # Days might not be consecutive, although they are sorted
+            emit_through(last_day, last_keys, day)
+        last_day, last_keys = day, keys
+
+    if last_day is not None:
+        emit_through(last_day, last_keys, end_day)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+"""Benchmark windowed_cohort on a synthetic year of user activity.
+
+Generates a year of daily activity for --users users, each joining on a
+random day and then visiting with gaps drawn from a heavy-tailed
+distribution, so there are plenty of deactivations and reactivations.
+Then times, per row of activity:
+
+  growth - user_growth's joins/deactivations/reactivations, both the way
+      user_growth.py used to compute them (strptime on every row) and with
+      windowed_cohort, checking that the two agree
+  active - users active on 1 and on 3 of the last 28 days, for every day
+  retention - weekly cohort retention
+
+Run it from this directory:
+
+  python windowed_cohort_benchmark.py --users 20000
+"""
+
+import collections
+import datetime
+import optparse
+import random
+import time
+
+import windowed_cohort
+
+
+WINDOW_LEN = 28
+
+_GAPS = [1] * 12 + [2] * 5 + [3, 4, 5, 7, 7, 10, 14, 20, 30, 45, 60, 90]
+
+
+def synthetic_year(num_users, seed=0):
+    """(user, dt, joined) rows for a year, sorted by user and then dt."""
+    rng = random.Random(seed)
+    start = datetime.date(2013, 1, 1)
+    dts = [(start + datetime.timedelta(n)).strftime('%Y-%m-%d')
+           for n in xrange(365)]
+
+    rows = []
+    for user in xrange(num_users):
+        day = rng.randint(0, 364)
+        joined = 'true'
+        while day < 365:
+            rows.append(("user%d" % user, dts[day], joined))
+            joined = 'false'
+            day += rng.choice(_GAPS)
+    return rows
+
+
+def strptime_growth(rows, end_dt):
+    """user_growth's deltas as it computed them before windowed_cohort."""
+    out = []
+    end_date = datetime.datetime.strptime(end_dt, '%Y-%m-%d')
+    for _, activity in windowed_cohort.entity_runs(rows):
+        last_date = None
+        for user, dt, joined in activity:
+            if joined == 'true':
+                out.append((dt, 'joins'))
+            curr_date = datetime.datetime.strptime(dt, '%Y-%m-%d')
+            if last_date and (curr_date - last_date).days > WINDOW_LEN:
+                out.append(((last_date + datetime.timedelta(
+                    days=WINDOW_LEN)).strftime('%Y-%m-%d'), 'deactivations'))
+                out.append((dt, 'reactivations'))
+            last_date = curr_date
+        if last_date and (end_date - last_date).days > WINDOW_LEN:
+            out.append(((last_date + datetime.timedelta(
+                days=WINDOW_LEN)).strftime('%Y-%m-%d'), 'deactivations'))
+    return out
+
+
+def windowed_growth(rows, end_dt):
+    """user_growth's deltas with windowed_cohort."""
+    out = []
+    day_numbers = windowed_cohort.DayNumbers()
+    end_day = day_numbers.day(end_dt)
+    for _, activity in windowed_cohort.entity_runs(rows):
+        days = []
+        for user, dt, joined in activity:
+            if joined == 'true':
+                out.append((dt, 'joins'))
+            days.append(day_numbers.day(dt))
+        for series, day in windowed_cohort.activity_changes(
+                days, end_day, WINDOW_LEN):
+            out.append((day_numbers.string(day), series))
+    return out
+
+
+def active_counts(rows_by_date, end_dt, min_days):
+    counts = []
+    day_numbers = windowed_cohort.DayNumbers()
+    window = windowed_cohort.SlidingWindow(min_days)
+    windowed_cohort.emit_window_counts(
+        windowed_cohort.daily_keys(rows_by_date, day_numbers),
+        day_numbers.day(end_dt), WINDOW_LEN, window,
+        lambda: window.num_active,
+        lambda day, count: counts.append(count))
+    return counts
+
+
+def weekly_retention(rows):
+    retention = collections.defaultdict(int)
+    day_numbers = windowed_cohort.DayNumbers()
+    for _, activity in windowed_cohort.entity_runs(rows):
+        cohort_day, offsets = windowed_cohort.cohort_retention(
+            [day_numbers.day(dt) for _, dt, _ in activity])
+        for offset in offsets:
+            retention[(cohort_day, offset)] += 1
+    return retention
+
+
+def timed(name, num_rows, f, *args):
+    start = time.time()
+    result = f(*args)
+    elapsed = time.time() - start
+    print "%-24s %8.3fs %8.2f us/row" % (name, elapsed,
+                                          elapsed * 1e6 / num_rows)
+    return result
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-u", "--users", type="int", default=20000,
+        help="Number of synthetic users. Defaults to 20000.")
+    parser.add_option("-s", "--seed", type="int", default=0,
+        help="Random seed. Defaults to 0.")
+    options, _ = parser.parse_args()
+
+    rows = synthetic_year(options.users, options.seed)
+    end_dt = '2014-01-01'
+    print "%d users, %d rows of activity" % (options.users, len(rows))
+
+    old = timed("growth (strptime)", len(rows), strptime_growth, rows, end_dt)
+    new = timed("growth (windowed)", len(rows), windowed_growth, rows, end_dt)
+    assert sorted(old) == sorted(new), "growth series disagree"
+
+    rows_by_date = sorted(((user, dt) for user, dt, _ in rows),
+                          key=lambda row: row[1])
+    timed("active 1 of 28 days", len(rows), active_counts,
+          rows_by_date, end_dt, 1)
+    timed("active 3 of 28 days", len(rows), active_counts,
+          rows_by_date, end_dt, 3)
+    timed("weekly retention", len(rows), weekly_retention, rows)
+
+
+if __name__ == '__main__':
+    main()
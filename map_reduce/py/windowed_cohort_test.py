@@ -0,0 +1,72 @@
+import unittest
+
+import windowed_cohort
+
+
+class DayNumbersTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        day_numbers = windowed_cohort.DayNumbers()
+        self.assertEqual(0, day_numbers.day('1970-01-01'))
+        self.assertEqual(31, day_numbers.day('1970-02-01'))
+        self.assertEqual('2013-03-01', day_numbers.string(
+            day_numbers.day('2013-02-28') + 1))
+
+
+class ActivityChangesTest(unittest.TestCase):
+
+    def test_changes(self):
+        changes = list(windowed_cohort.activity_changes(
+            [10, 11, 39, 70, 75], 200, 28))
+        self.assertEqual([('deactivations', 67), ('reactivations', 70),
+                          ('deactivations', 103)], changes)
+
+    def test_active_at_end(self):
+        self.assertEqual([], list(windowed_cohort.activity_changes(
+            [10, 20], 48, 28)))
+
+
+class CohortRetentionTest(unittest.TestCase):
+
+    def test_weekly(self):
+        # Day 4 is a Monday
+        self.assertEqual((4, [0, 1, 3]), windowed_cohort.cohort_retention(
+            [6, 10, 12, 13, 25, 26]))
+        self.assertEqual((None, []), windowed_cohort.cohort_retention([]))
+
+
+class SlidingWindowTest(unittest.TestCase):
+
+    def counts(self, days, end_day, min_days):
+        window = windowed_cohort.SlidingWindow(min_days)
+        counts = []
+        windowed_cohort.emit_window_counts(
+            days, end_day, 3, window, lambda: window.num_active,
+            lambda day, count: counts.append((day, count)))
+        return counts
+
+    def test_counts_previous_days(self):
+        days = [(1, set(['a', 'b'])), (2, set(['a'])), (5, set(['c']))]
+        self.assertEqual([(1, 0), (2, 2), (3, 2), (4, 2), (5, 1), (6, 1)],
+                         self.counts(days, 7, 1))
+
+    def test_min_days(self):
+        days = [(1, set(['a', 'b'])), (2, set(['a'])), (3, set(['b']))]
+        self.assertEqual([(1, 0), (2, 0), (3, 1), (4, 2), (5, 0), (6, 0)],
+                         self.counts(days, 7, 2))
+
+    def test_callbacks(self):
+        events = []
+        window = windowed_cohort.SlidingWindow(
+            1, lambda key: events.append(('+', key)),
+            lambda key: events.append(('-', key)))
+        window.add_day(1, ['a'])
+        window.add_day(2, ['a', 'b'])
+        window.expire_before(2)
+        window.expire_before(3)
+        self.assertEqual([('+', 'a'), ('+', 'b'), ('-', 'a'), ('-', 'b')],
+                         events)
+
+
+if __name__ == '__main__':
+    unittest.main()
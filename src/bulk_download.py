@@ -137,10 +137,10 @@ def jsonify_downloaded_file(kind, config):
     cursor = sqlite_conn.cursor()
     cursor.execute(sqlstring)
     f = open(json_filename, 'wb')
-    for unused_entity_id, pb in cursor:
-        doc = load_pbufs_to_hive.pb_to_dict(pb, parent=True)
-        json_str = json.dumps(doc)
-        print >>f, "%s\t%s" % (doc['key'], json_str)
+    pbs = (pb for unused_entity_id, pb in cursor)
+    for line in load_pbufs_to_hive.iter_json_lines(
+            pbs, key='key', parent=True, workers=config['json_workers']):
+        print >>f, line
     f.close()
     sqlite_conn.close()
 
@@ -178,6 +178,7 @@ def main():
         config = json.load(f)
     config['date'] = options.date
     config['json'] = config.get('json', 0)
+    config['json_workers'] = config.get('json_workers', 1)
 
     results = {'successes': [], 'failures': []}
     path = os.path.join(config['result_directory'], config['date'])
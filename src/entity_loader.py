@@ -32,12 +32,476 @@ Usage:
     for log in loader.entities("ProblemLog"):
         data = log.get('json')
         # Do stuff with problem logs
+
+Filters:
+    entities() takes a dict of filters mapping a field name to the values
+    it must have.  Field names are looked up in the schema columns (e.g.
+    'user') first and then among the top-level fields of the json.  A
+    filter value can be a single value, a list/tuple/set of allowed values,
+    a Range, or a function of the field value returning a bool:
+
+    for log in loader.entities("ProblemLog", filters={
+            'exercise': ['addition_1', 'subtraction_1'],
+            'time_done': Range(1376006400, 1376092800),
+            'correct': True}):
+        # Do stuff with a fraction of the problem logs
+
+    entities() indexes each file the first time it reads all of it
+    without filters, in a sidecar index in the file's directory (run this
+    module as a script, or call build_index(), to index a range of days
+    ahead of time).  Filters are checked against indexed files' summaries
+    so that files which can't contain a match are never opened.  Lines are
+    also tested for the raw json of string and boolean values before being
+    decoded, so non-matching rows are mostly skipped without a json.loads.
+
+Parallel scans:
+    entities_parallel() takes the same arguments as entities(), plus the
+    number of worker processes to decompress and decode files with:
+
+    for log in loader.entities_parallel("ProblemLog", end_date, begin_date,
+                                        limit=None, workers=8):
+        # Same logs, same order as entities()
+
+    Pass unordered=True to get entities as soon as any worker has them.
+
+Column cache:
+    Constructing the loader with a column_cache_prefix makes entities()
+    save the column_cache_fields of each file it scans without filters as
+    numpy arrays under that directory.  (If the limit is reached partway
+    through such a file, the rest of it is still decoded for the cache.)
+    Later calls that only need those fields pass them as fields=[...] and
+    read the memory-mapped arrays instead of decoding json:
+
+    loader = EntityLoader(column_cache_prefix="/ebs/kadata2/columns")
+    for log in loader.entities("ProblemLog", end_date, begin_date,
+                               limit=None, fields=['exercise', 'correct']):
+        # log['json'] only has 'exercise' and 'correct'
+
+    column_arrays() returns the cached columns of each file as Columns of
+    memory-mapped numpy arrays, for vectorized work without any decoding:
+
+    for filename, columns in loader.column_arrays(
+            "ProblemLog", ['correct', 'time_taken'], end_date, begin_date):
+        correct = columns['correct'].values == 1
+        time_taken = columns['time_taken'].values[correct]
 """
 
+import base64
+import collections
 import datetime
-import json
 import gzip
+import hashlib
+import itertools
+import json
+import multiprocessing
+import optparse
 import os
+import struct
+import sys
+import traceback
+
+import numpy as np
+
+
+# Name of the sidecar index written in each day's entity directory.  It
+# must not contain an encoding name ("json") or entity_filenames() would
+# pick it up as a data file.
+INDEX_FILENAME = "_entity_index"
+
+# entities_parallel() workers send entities back in chunks of this many,
+# and each worker can have this many chunks waiting to be consumed.
+_PARALLEL_CHUNK_SIZE = 1000
+_PARALLEL_QUEUED_CHUNKS = 4
+
+# Per-file metadata of the column cache, next to the column files.
+COLUMN_CACHE_META = "_meta.json"
+
+# Caches written with another version are rebuilt.
+COLUMN_CACHE_VERSION = 2
+
+# Stands for a field an entity doesn't have in cached columns.
+_MISSING = object()
+
+# Largest integer a float64 column holds exactly.
+_MAX_EXACT_FLOAT_INT = 2 ** 53
+
+# Bits of bloom filter per distinct value, and hashes per value, giving
+# roughly a 1% false positive rate.
+_BLOOM_BITS_PER_VALUE = 10
+_BLOOM_NUM_HASHES = 7
+
+
+class Range(object):
+    """Filter value matching min_value <= value <= max_value.
+
+    Either bound may be None, meaning unbounded.
+    """
+    def __init__(self, min_value=None, max_value=None):
+        self.min_value = min_value
+        self.max_value = max_value
+
+    def __contains__(self, value):
+        if value is None:
+            return False
+        if self.min_value is not None and value < self.min_value:
+            return False
+        if self.max_value is not None and value > self.max_value:
+            return False
+        return True
+
+    def __repr__(self):
+        return "Range(%r, %r)" % (self.min_value, self.max_value)
+
+
+def _value_class(value):
+    """The class of values min/max summaries can compare against."""
+    if isinstance(value, basestring):
+        return 's'
+    elif isinstance(value, (int, long, float)):
+        return 'n'
+    return None
+
+
+def _bloom_token(value):
+    """A byte string identifying value for the bloom filters.
+
+    Numbers are normalized to floats so that e.g. 1 and 1.0 (which compare
+    equal) map to the same token.
+    """
+    if isinstance(value, basestring):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return 's' + value
+    return 'n' + repr(float(value))
+
+
+def _bloom_positions(value, num_bits):
+    digest = hashlib.md5(_bloom_token(value)).digest()
+    h1, h2 = struct.unpack("<QQ", digest)
+    return [(h1 + i * h2) % num_bits for i in xrange(_BLOOM_NUM_HASHES)]
+
+
+def _make_bloom(values):
+    """Returns a base64-encoded bloom filter over the given set of values."""
+    num_bits = max(64, len(values) * _BLOOM_BITS_PER_VALUE)
+    num_bits += -num_bits % 8
+    bits = bytearray(num_bits // 8)
+    for value in values:
+        for pos in _bloom_positions(value, num_bits):
+            bits[pos >> 3] |= 1 << (pos & 7)
+    return base64.b64encode(str(bits))
+
+
+def _bloom_may_contain(bloom, value):
+    bits = bytearray(base64.b64decode(bloom))
+    num_bits = len(bits) * 8
+    return all(bits[pos >> 3] & (1 << (pos & 7))
+               for pos in _bloom_positions(value, num_bits))
+
+
+class _FieldSummary(object):
+    """Accumulates the min/max and distinct values of one field of a file."""
+    def __init__(self, keep_values):
+        self.value_class = None
+        self.mixed = False
+        self.min_value = self.max_value = None
+        self.values = set() if keep_values else None
+
+    def add(self, value):
+        value_class = _value_class(value)
+        if value_class is None:
+            return
+        if self.value_class is None:
+            self.value_class = value_class
+            self.min_value = self.max_value = value
+        elif value_class != self.value_class:
+            self.mixed = True
+        else:
+            self.min_value = min(self.min_value, value)
+            self.max_value = max(self.max_value, value)
+        if self.values is not None:
+            self.values.add(value)
+
+    def to_json(self):
+        if self.value_class is None or self.mixed:
+            return None
+        summary = {"class": self.value_class,
+                   "min": self.min_value,
+                   "max": self.max_value}
+        if self.values is not None:
+            summary["bloom"] = _make_bloom(self.values)
+        return summary
+
+
+class _FileSummarizer(object):
+    """Accumulates the index summary (see EntityLoader.index_file) of the
+    entities of one file.
+    """
+    def __init__(self, schema, bloom_fields):
+        self.schema = schema
+        self.bloom_fields = bloom_fields
+        self.summaries = {}
+        self.rows = 0
+
+    def _add(self, field, value):
+        summary = self.summaries.get(field)
+        if summary is None:
+            summary = self.summaries[field] = _FieldSummary(
+                field in self.bloom_fields)
+        summary.add(value)
+
+    def add(self, entity):
+        self.rows += 1
+        for column in self.schema:
+            if column != 'json':
+                self._add(column, entity[column])
+        data = entity.get('json')
+        if isinstance(data, dict):
+            for field, value in data.iteritems():
+                if field not in self.schema:
+                    self._add(field, value)
+
+    def to_json(self, filename):
+        stat = os.stat(filename)
+        fields = {}
+        for field, summary in self.summaries.iteritems():
+            summary_json = summary.to_json()
+            if summary_json is not None:
+                fields[field] = summary_json
+        return {"size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "rows": self.rows,
+                "fields": fields}
+
+
+def _column_kind(value):
+    """The kind of column value can be stored in, or None for null."""
+    if value is None:
+        return None
+    elif isinstance(value, bool):
+        return 'bool'
+    elif isinstance(value, (int, long)):
+        if abs(value) > _MAX_EXACT_FLOAT_INT:
+            return 'other'
+        return 'int'
+    elif isinstance(value, float):
+        return 'float'
+    elif isinstance(value, basestring):
+        return 'str'
+    return 'other'
+
+
+class _ColumnBuilder(object):
+    """Accumulates one field of a file as a compact column.
+
+    Numbers are stored as float64 (NaN for null), bools as int8 (-1 for
+    null) and strings as int32 codes (-1 for null) into a vocabulary.  A
+    field with lists, dicts, or a mix of the above can't be stored, and
+    gets dropped from the cache.  The rows of entities without the field
+    at all are remembered separately, so they don't come back as null.
+    """
+    def __init__(self):
+        self.kind = None
+        self.valid = True
+        self.leading_nulls = 0
+        self.values = None
+        self.vocab = {}
+        self.num_rows = 0
+        self.missing_rows = []
+
+    def add_missing(self):
+        self.missing_rows.append(self.num_rows)
+        self.add(None)
+
+    def add(self, value):
+        self.num_rows += 1
+        if not self.valid:
+            return
+        kind = _column_kind(value)
+        if kind is None:
+            if self.values is None:
+                self.leading_nulls += 1
+            else:
+                self.values.append(self._null())
+            return
+        if kind == 'other':
+            self.valid = False
+            self.values = None
+            return
+
+        if self.kind is None:
+            self.kind = kind
+            self.values = []
+            self.values.extend([self._null()] * self.leading_nulls)
+        elif kind != self.kind:
+            if set([kind, self.kind]) == set(['int', 'float']):
+                self.kind = 'float'
+            else:
+                self.valid = False
+                self.values = None
+                return
+
+        if kind == 'str':
+            value = self.vocab.setdefault(value, len(self.vocab))
+        self.values.append(value)
+
+    def _null(self):
+        if self.kind in ('int', 'float'):
+            return float('nan')
+        return -1
+
+    def save(self, path_prefix):
+        """Write the column; returns its kind, or None if not storable."""
+        if not self.valid:
+            return None
+        if self.kind is None:
+            # Every value was null
+            self.kind = 'float'
+            self.values = [float('nan')] * self.leading_nulls
+        dtype = {'int': np.float64, 'float': np.float64,
+                 'bool': np.int8, 'str': np.int32}[self.kind]
+        np.save(path_prefix + ".npy", np.array(self.values, dtype=dtype))
+        np.save(path_prefix + ".missing.npy",
+                np.array(self.missing_rows, dtype=np.int64))
+        if self.kind == 'str':
+            vocab = [None] * len(self.vocab)
+            for value, code in self.vocab.iteritems():
+                vocab[code] = value
+            with open(path_prefix + ".vocab.json", 'wb') as f:
+                json.dump(vocab, f)
+        return self.kind
+
+
+class Column(collections.namedtuple(
+        'Column', ['kind', 'values', 'missing', 'vocab'])):
+    """One cached field of a file, as column_arrays() yields it.
+
+    values is the memory-mapped array _ColumnBuilder saved: float64 with
+    NaN for null for kind 'int' or 'float', int8 with -1 for null for
+    'bool', and int32 codes into the vocab list with -1 for null for 'str'
+    (vocab is None for the other kinds).  missing is a bool array, true
+    for the rows of entities without the field at all.
+    """
+    __slots__ = ()
+
+
+def _load_column(path_prefix, kind):
+    """Read a column saved by _ColumnBuilder, memory-mapping its values."""
+    values = np.load(path_prefix + ".npy", mmap_mode='r')
+    missing = np.zeros(len(values), dtype=bool)
+    missing[np.load(path_prefix + ".missing.npy")] = True
+    vocab = None
+    if kind == 'str':
+        with open(path_prefix + ".vocab.json", 'rb') as f:
+            vocab = json.load(f)
+    return Column(kind, values, missing, vocab)
+
+
+def _column_to_values(column, missing=None):
+    """Convert a Column back to the python values json gave us.
+
+    Returns a numpy object array; null values are None, and so are those of
+    entities without the field, unless missing is given to stand for them.
+    """
+    array = column.values
+    if column.kind == 'str':
+        # Code -1 picks the trailing None.
+        lookup = np.array(column.vocab + [None], dtype=object)
+        values = lookup[array]
+    else:
+        values = np.empty(len(array), dtype=object)
+        if column.kind == 'bool':
+            values[:] = array.astype(bool)
+            values[array < 0] = None
+        else:
+            null = np.isnan(array)
+            if column.kind == 'int':
+                values[:] = array.astype(np.int64).tolist()
+            else:
+                values[:] = array.tolist()
+            values[null] = None
+    if missing is not None:
+        values[column.missing] = missing
+    return values
+
+
+def _add_to_builders(builders, entity):
+    """Add an entity's fields to the _ColumnBuilders of a file."""
+    data = entity.get('json')
+    if not isinstance(data, dict):
+        data = {}
+    for field, builder in builders.iteritems():
+        if field in entity and field != 'json':
+            builder.add(entity[field])
+        elif field in data:
+            builder.add(data[field])
+        else:
+            builder.add_missing()
+
+
+def _normalize_filter(spec):
+    """Turns a filter value into a Range, a frozenset, or a callable."""
+    if isinstance(spec, Range) or callable(spec):
+        return spec
+    if isinstance(spec, (list, tuple, set, frozenset)):
+        return frozenset(spec)
+    return frozenset([spec])
+
+
+def _filter_matches(spec, value):
+    if isinstance(spec, (Range, frozenset)):
+        try:
+            return value in spec
+        except TypeError:
+            # Unhashable values (lists, dicts) can't equal a filter value.
+            return False
+    return spec(value)
+
+
+def _summary_may_match(spec, summary):
+    """Could any value summarized by summary (see _FieldSummary) match spec?
+    """
+    if callable(spec) and not isinstance(spec, Range):
+        return True
+
+    if isinstance(spec, Range):
+        if (_value_class(spec.min_value) not in (None, summary["class"]) or
+                _value_class(spec.max_value) not in (None, summary["class"])):
+            return True
+        return not ((spec.min_value is not None and
+                     summary["max"] < spec.min_value) or
+                    (spec.max_value is not None and
+                     summary["min"] > spec.max_value))
+
+    for value in spec:
+        if _value_class(value) != summary["class"]:
+            # We only summarize values of one class (e.g. a filter on
+            # None can match rows the summary knows nothing about).
+            return True
+        if not summary["min"] <= value <= summary["max"]:
+            continue
+        if "bloom" in summary and not _bloom_may_contain(
+                summary["bloom"], value):
+            continue
+        return True
+    return False
+
+
+def _raw_tokens(spec):
+    """The json snippets one of which must occur in a matching raw line.
+
+    Returns None if no such cheap pre-test is possible for this filter.
+    Only strings and booleans are used: they have a single json encoding,
+    while e.g. 1 may have been written as 1.0.
+    """
+    if not isinstance(spec, frozenset) or not spec:
+        return None
+    tokens = []
+    for value in spec:
+        if not isinstance(value, (basestring, bool)):
+            return None
+        tokens.append(json.dumps(value))
+    return tokens
 
 
 class EntityLoader(object):
@@ -69,13 +533,47 @@ class EntityLoader(object):
         'BaseUserMission':        ['key', 'json'],
     }
 
+    # Fields that get a bloom filter (on top of the min/max every top-level
+    # scalar field gets) in the index, for fast equality filtering.  The
+    # schema's key column always gets one.
+    bloom_fields = {
+        'ProblemLog':             ['exercise'],
+        'StackLog':               ['user_id'],
+        'UserBadge':              ['badge_name'],
+        'UserData':               ['user_id', 'user_email'],
+        'VideoLog':               ['video'],
+    }
+
+    # Fields saved in the column cache, when it's enabled.
+    column_cache_fields = {
+        'ProblemLog':   ['exercise', 'correct', 'time_done', 'time_taken',
+                         'problem_number', 'count_hints', 'count_attempts',
+                         'hint_used', 'seed', 'sha1', 'topic_mode',
+                         'review_mode', 'backup_timestamp'],
+        'VideoLog':     ['video', 'youtube_id', 'seconds_watched',
+                         'last_second_watched', 'time_watched',
+                         'is_video_completed', 'points_earned',
+                         'backup_timestamp'],
+        'UserData':     ['user_id', 'user_email', 'joined', 'last_login',
+                         'points', 'total_seconds_watched',
+                         'backup_timestamp'],
+        'UserVideo':    ['video', 'seconds_watched', 'last_second_watched',
+                         'completed', 'duration', 'backup_timestamp'],
+        'StackLog':     ['user_id', 'time_last_done', 'backup_timestamp'],
+    }
+
     def __init__(self,
                  data_prefix="/ebs/kadata2/daily_new",
                  encoding="json",
-                 schemas={}):
+                 schemas={},
+                 column_cache_prefix=None):
         self.data_prefix = data_prefix
         self.encoding = encoding
         self.schemas.update(schemas)
+        # Where to keep the column cache; None disables it.
+        self.column_cache_prefix = column_cache_prefix
+        # Loaded indexes, by entity directory name
+        self._indexes = {}
 
     def today(self):
         return datetime.date.today()
@@ -146,14 +644,133 @@ class EntityLoader(object):
             yield entity_file
             entity_file.close()
 
+    def index_filename(self, type, date=None):
+        return "%s/%s" % (self.entity_dirname(type, date), INDEX_FILENAME)
+
+    def _summarizer(self, type):
+        schema = self.schemas[type]
+        bloom_fields = set(self.bloom_fields.get(type, []))
+        bloom_fields.add(schema[0])
+        return _FileSummarizer(schema, bloom_fields)
+
+    def index_file(self, type, filename):
+        """Returns the index summary of a single entity file.
+
+        The summary records the number of rows, and the min/max (plus a
+        bloom filter for the key column and bloom_fields) of every
+        top-level scalar field, along with the file's size and mtime so
+        stale summaries can be detected.
+        """
+        summarizer = self._summarizer(type)
+        with gzip.open(filename, 'rb') as entity_file:
+            for entity in self.entities_in_file(type, entity_file):
+                summarizer.add(entity)
+        return summarizer.to_json(filename)
+
+    def _write_index(self, dirname, index):
+        index_filename = "%s/%s" % (dirname, INDEX_FILENAME)
+        tmp_filename = "%s.%d.tmp" % (index_filename, os.getpid())
+        with open(tmp_filename, 'wb') as f:
+            json.dump(index, f)
+        os.rename(tmp_filename, index_filename)
+        self._indexes[dirname] = index
+
+    def build_index(self, type, date=None):
+        """Index every entity file of type for date, and write the index.
+
+        Returns the index, a dict of file basename to index_file() summary.
+        """
+        dirname = self.entity_dirname(type, date)
+        index = {}
+        for filename in sorted(os.listdir(dirname)):
+            if self.encoding in filename:
+                index[filename] = self.index_file(
+                    type, "%s/%s" % (dirname, filename))
+        self._write_index(dirname, index)
+        return index
+
+    def _add_to_index(self, filename, summary):
+        """Merge the summary of one file into its directory's index."""
+        dirname, basename = os.path.split(filename)
+        # Reread it, as another loader may have indexed other files since.
+        self._indexes.pop(dirname, None)
+        index = dict(self.load_index(dirname))
+        index[basename] = summary
+        try:
+            self._write_index(dirname, index)
+        except (IOError, OSError), e:
+            print >> sys.stderr, "Couldn't index %s: %s" % (filename, e)
+
+    def load_index(self, dirname):
+        """Returns the index of an entity directory, or {} if it has none."""
+        if dirname not in self._indexes:
+            index = {}
+            index_filename = "%s/%s" % (dirname, INDEX_FILENAME)
+            if os.path.exists(index_filename):
+                with open(index_filename, 'rb') as f:
+                    index = json.load(f)
+            self._indexes[dirname] = index
+        return self._indexes[dirname]
+
+    def _file_summary(self, filename):
+        """The index summary of filename, or None if missing or stale."""
+        dirname, basename = os.path.split(filename)
+        summary = self.load_index(dirname).get(basename)
+        if summary is None:
+            return None
+        stat = os.stat(filename)
+        if (summary["size"] != stat.st_size or
+                summary["mtime"] != stat.st_mtime):
+            return None
+        return summary
+
+    def file_may_match(self, filename, filters):
+        """Whether the index says filename may contain rows matching filters.
+
+        Files without an up to date index summary may always match.
+        """
+        if not filters:
+            return True
+        summary = self._file_summary(filename)
+        if summary is None:
+            return True
+        if summary["rows"] == 0:
+            return False
+
+        for field, spec in filters.iteritems():
+            field_summary = summary["fields"].get(field)
+            if field_summary and not _summary_may_match(spec, field_summary):
+                return False
+        return True
+
     def entities_in_file(self, type, entity_file, filters=None):
         if type not in self.schemas:
             raise ValueError('Invalid type %s' % type)
         schema = self.schemas[type]
 
+        filters = dict((field, _normalize_filter(spec))
+                       for field, spec in (filters or {}).iteritems())
+        column_filters = [(schema.index(field), spec)
+                          for field, spec in filters.iteritems()
+                          if field in schema]
+        json_filters = [(field, spec) for field, spec in filters.iteritems()
+                        if field not in schema]
+        raw_tokens = [tokens for tokens in
+                      (_raw_tokens(spec) for _, spec in json_filters)
+                      if tokens is not None]
+
         for entity_string in entity_file:
             if self.encoding == 'json':
                 data = entity_string.split("\t")
+
+                # Cheap checks before paying for the json decode.
+                if not all(_filter_matches(spec, data[i])
+                           for i, spec in column_filters):
+                    continue
+                if not all(any(token in entity_string for token in tokens)
+                           for tokens in raw_tokens):
+                    continue
+
                 entity = {}
 
                 for i in xrange(len(schema)):
@@ -163,7 +780,14 @@ class EntityLoader(object):
                         value = json.loads(value)
                     entity[key] = value
 
-                # TODO(Bieber): Handle filters
+                if json_filters:
+                    doc = entity.get('json')
+                    if not isinstance(doc, dict):
+                        continue
+                    if not all(_filter_matches(spec, doc.get(field))
+                               for field, spec in json_filters):
+                        continue
+
                 yield entity
 
             elif self.encoding == 'pickle':
@@ -172,22 +796,334 @@ class EntityLoader(object):
             else:
                 raise ValueError('Invalid encoding %s' % self.encoding)
 
+    def column_cache_dirname(self, filename):
+        """The column cache directory for an entity file."""
+        return os.path.join(self.column_cache_prefix,
+                            os.path.relpath(filename, self.data_prefix))
+
+    def _column_cache_meta(self, filename):
+        """The column cache metadata for filename, or None if not cached.
+
+        Caches of files which have changed since are ignored.
+        """
+        if self.column_cache_prefix is None:
+            return None
+        meta_filename = os.path.join(self.column_cache_dirname(filename),
+                                     COLUMN_CACHE_META)
+        if not os.path.exists(meta_filename):
+            return None
+        with open(meta_filename, 'rb') as f:
+            meta = json.load(f)
+        if meta.get("version") != COLUMN_CACHE_VERSION:
+            return None
+        stat = os.stat(filename)
+        if meta["size"] != stat.st_size or meta["mtime"] != stat.st_mtime:
+            return None
+        return meta
+
+    def _write_column_cache(self, filename, builders):
+        dirname = self.column_cache_dirname(filename)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        kinds = {}
+        for field, builder in builders.iteritems():
+            kind = builder.save(os.path.join(dirname, field))
+            if kind is not None:
+                kinds[field] = kind
+        stat = os.stat(filename)
+        meta = {"version": COLUMN_CACHE_VERSION,
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "fields": kinds}
+        # The metadata goes last, and marks the cache as complete.
+        tmp_filename = os.path.join(dirname, COLUMN_CACHE_META + ".tmp")
+        with open(tmp_filename, 'wb') as f:
+            json.dump(meta, f)
+        os.rename(tmp_filename, os.path.join(dirname, COLUMN_CACHE_META))
+
+    def _cached_columns(self, filename, fields):
+        """Cached Columns of fields in filename, or None if not all cached.
+        """
+        meta = self._column_cache_meta(filename)
+        if meta is None or not all(f in meta["fields"] for f in fields):
+            return None
+        dirname = self.column_cache_dirname(filename)
+        columns = {}
+        for field in fields:
+            columns[field] = _load_column(os.path.join(dirname, field),
+                                          meta["fields"][field])
+        return columns
+
+    def _entities_from_columns(self, type, columns, fields, filters):
+        """Rebuild (partial) entities from cached Columns.
+
+        They're just like the ones entities_in_file() decodes, but for the
+        json fields that weren't asked for.
+        """
+        schema = self.schemas[type]
+        key_columns = [c for c in schema if c != 'json' and c in columns]
+        json_fields = [f for f in fields if f not in schema]
+        values = dict((field, _column_to_values(column, _MISSING).tolist())
+                      for field, column in columns.iteritems())
+        for c in key_columns:
+            # Schema columns are split out of the file as byte strings,
+            # but come back from the vocabulary's json as unicode.
+            values[c] = [v.encode('utf-8') if isinstance(v, unicode) else v
+                         for v in values[c]]
+        num_rows = len(values.values()[0]) if values else 0
+        for i in xrange(num_rows):
+            entity = dict((c, values[c][i]) for c in key_columns)
+            entity['json'] = dict((f, values[f][i]) for f in json_fields
+                                  if values[f][i] is not _MISSING)
+            if filters and not all(
+                    _filter_matches(spec, entity[field] if field in schema
+                                    else entity['json'].get(field))
+                    for field, spec in filters.iteritems()):
+                continue
+            yield entity
+
+    def column_arrays(self, type, fields, end_date=None, begin_date=None):
+        """Yield (filename, {field: Column}) for each cached file.
+
+        The Columns' values are the memory-mapped arrays of the cache, so
+        nothing is decoded into python objects.  Files whose cache doesn't
+        cover every field are skipped; read them with entities() first to
+        populate the cache.
+        """
+        filenames = self.entity_filenames(
+            type=type,
+            end_date=end_date,
+            begin_date=begin_date)
+        for filename in filenames:
+            columns = self._cached_columns(filename, fields)
+            if columns is not None:
+                yield filename, columns
+
     def entities(self,
                  type,
                  end_date=None,
                  begin_date=None,
                  limit=1000,
-                 filters=None):
+                 filters=None,
+                 fields=None):
+        """Yield entities of type between the given dates (see module doc).
+
+        If fields is given, the caller only needs those columns/json
+        fields, and files with a column cache covering them (and the
+        filters) are read from it; 'json' then only holds those fields.
+        """
         count = 0
-        entity_files = self.entity_files(
+        filters = dict((field, _normalize_filter(spec))
+                       for field, spec in (filters or {}).iteritems())
+        cache_fields = self.column_cache_fields.get(type, [])
+        filenames = self.entity_filenames(
             type=type,
             end_date=end_date,
             begin_date=begin_date)
-        for entity_file in entity_files:
-            ents = self.entities_in_file(type, entity_file, filters=filters)
+        for filename in filenames:
+            if not self.file_may_match(filename, filters):
+                continue
+
+            ents = None
+            entity_file = None
+            builders = None
+            summarizer = None
+            if fields is not None and self.column_cache_prefix is not None:
+                needed = (set(fields) | set(filters) |
+                          set(self.schemas[type]))
+                needed.discard('json')
+                columns = self._cached_columns(filename, needed)
+                if columns is not None:
+                    ents = self._entities_from_columns(
+                        type, columns, needed, filters)
+            if ents is None:
+                entity_file = gzip.open(filename, 'rb')
+                ents = self.entities_in_file(type, entity_file,
+                                             filters=filters)
+                if (self.column_cache_prefix is not None and cache_fields
+                        and not filters and
+                        self._column_cache_meta(filename) is None):
+                    builders = dict(
+                        (field, _ColumnBuilder()) for field in
+                        [c for c in self.schemas[type] if c != 'json'] +
+                        cache_fields)
+                if not filters and self._file_summary(filename) is None:
+                    summarizer = self._summarizer(type)
+
             for entity in ents:
                 if limit is not None and count >= limit:
+                    if builders is not None:
+                        # Finish the file for the cache (and the index),
+                        # so it's written the first time the file is
+                        # scanned.
+                        for entity in itertools.chain([entity], ents):
+                            _add_to_builders(builders, entity)
+                            if summarizer is not None:
+                                summarizer.add(entity)
+                        self._write_column_cache(filename, builders)
+                        if summarizer is not None:
+                            self._add_to_index(
+                                filename, summarizer.to_json(filename))
+                    if entity_file is not None:
+                        entity_file.close()
                     raise StopIteration
 
+                if builders is not None:
+                    _add_to_builders(builders, entity)
+                if summarizer is not None:
+                    summarizer.add(entity)
+
                 count += 1
                 yield entity
+
+            if entity_file is not None:
+                entity_file.close()
+            if builders is not None:
+                self._write_column_cache(filename, builders)
+            if summarizer is not None:
+                self._add_to_index(filename, summarizer.to_json(filename))
+
+    def entities_parallel(self,
+                          type,
+                          end_date=None,
+                          begin_date=None,
+                          limit=1000,
+                          filters=None,
+                          workers=None,
+                          unordered=False):
+        """Like entities(), but decodes files in a pool of processes.
+
+        Up to workers (the number of cpus by default) files are scanned at
+        once, each in its own process.  Entities are sent back in chunks
+        through bounded queues, so memory use doesn't depend on the size of
+        the files.  By default entities come out in the same order as from
+        entities(); with unordered=True they come out as soon as any worker
+        has decoded them, which keeps every worker busy.
+        """
+        if type not in self.schemas:
+            raise ValueError('Invalid type %s' % type)
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+
+        count = 0
+        filters = dict((field, _normalize_filter(spec))
+                       for field, spec in (filters or {}).iteritems())
+        filenames = (filename for filename in self.entity_filenames(
+                         type=type,
+                         end_date=end_date,
+                         begin_date=begin_date)
+                     if self.file_may_match(filename, filters))
+
+        for entity in self._scan_files_parallel(type, filenames, filters,
+                                                max(1, workers), unordered):
+            if limit is not None and count >= limit:
+                return
+            count += 1
+            yield entity
+
+    def _scan_files_parallel(self, type, filenames, filters, workers,
+                             unordered):
+        # In-flight files, in the order they were started, and their
+        # (process, queue).  Unordered scans share one queue.
+        order = collections.deque()
+        scans = {}
+        shared_queue = None
+        if unordered:
+            shared_queue = multiprocessing.Queue(
+                workers * _PARALLEL_QUEUED_CHUNKS)
+
+        def _start_scans():
+            while len(scans) < workers:
+                filename = next(filenames, None)
+                if filename is None:
+                    return
+                queue = shared_queue or multiprocessing.Queue(
+                    _PARALLEL_QUEUED_CHUNKS)
+                # Processes are forked, so filters may hold lambdas.
+                process = multiprocessing.Process(
+                    target=_scan_file_into_queue,
+                    args=(self, type, filename, filters, queue))
+                process.daemon = True
+                process.start()
+                order.append(filename)
+                scans[filename] = (process, queue)
+
+        try:
+            _start_scans()
+            while scans:
+                queue = shared_queue or scans[order[0]][1]
+                message, filename, payload = queue.get()
+                if message == 'entities':
+                    for entity in payload:
+                        yield entity
+                elif message == 'error':
+                    raise RuntimeError("Failed to scan %s:\n%s" % (
+                        filename, payload))
+                else:
+                    process, _ = scans.pop(filename)
+                    process.join()
+                    order.remove(filename)
+                    _start_scans()
+        finally:
+            for process, _ in scans.itervalues():
+                process.terminate()
+                process.join()
+
+
+def _scan_file_into_queue(loader, type, filename, filters, queue):
+    """entities_parallel() worker: decode one file into queue.
+
+    Puts ('entities', filename, [entity, ...]) chunks, then either
+    ('done', filename, None) or ('error', filename, traceback).
+    """
+    try:
+        chunk = []
+        with gzip.open(filename, 'rb') as entity_file:
+            for entity in loader.entities_in_file(type, entity_file,
+                                                  filters=filters):
+                chunk.append(entity)
+                if len(chunk) >= _PARALLEL_CHUNK_SIZE:
+                    queue.put(('entities', filename, chunk))
+                    chunk = []
+        if chunk:
+            queue.put(('entities', filename, chunk))
+        queue.put(('done', filename, None))
+    except Exception:
+        queue.put(('error', filename, traceback.format_exc()))
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]",
+        description="Builds the sidecar indexes EntityLoader uses to skip "
+                    "files when filtering, for each day in a date range.")
+    parser.add_option("-t", "--type", help="Entity type to index.")
+    parser.add_option("-s", "--start_date",
+        help="First date to index, YYYY-MM-DD. Defaults to the end date.")
+    parser.add_option("-e", "--end_date",
+        help="Last date to index, YYYY-MM-DD. Defaults to today.")
+    parser.add_option("-d", "--data_prefix", default="/ebs/kadata2/daily_new",
+        help="Directory holding the per-day entity directories.")
+    options, _ = parser.parse_args()
+
+    if not options.type:
+        print >> sys.stderr, 'Please specify an entity type to index'
+        exit(1)
+
+    def _parse_date(s):
+        return datetime.datetime.strptime(s, "%Y-%m-%d").date()
+
+    loader = EntityLoader(data_prefix=options.data_prefix)
+    end_date = _parse_date(options.end_date) if options.end_date else (
+        loader.today())
+    begin_date = _parse_date(options.start_date) if options.start_date else (
+        end_date)
+    for date in loader.dates(end_date=end_date, begin_date=begin_date):
+        if not os.path.exists(loader.entity_dirname(options.type, date)):
+            continue
+        index = loader.build_index(options.type, date)
+        print >> sys.stderr, "Indexed %d %s files for %s." % (
+            len(index), options.type, date)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+
+import datetime
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import entity_loader
+
+
+DATE = datetime.date(2013, 8, 1)
+
+
+class EntityLoaderTestBase(unittest.TestCase):
+    def setUp(self):
+        self.data_prefix = tempfile.mkdtemp()
+        self.loader = entity_loader.EntityLoader(data_prefix=self.data_prefix)
+
+    def tearDown(self):
+        shutil.rmtree(self.data_prefix)
+
+    def write_logs(self, filename, logs, date=DATE):
+        """Write ProblemLog-like dicts as a gzipped key\\tjson file."""
+        dirname = self.loader.entity_dirname("ProblemLog", date)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        path = os.path.join(dirname, filename)
+        with gzip.open(path, 'wb') as f:
+            for log in logs:
+                print >> f, "%s\t%s" % (log['user'], json.dumps(log))
+        return path
+
+    def make_logs(self, users, exercises, start_time):
+        logs = []
+        for i, user in enumerate(users):
+            for j, exercise in enumerate(exercises):
+                logs.append({'user': user,
+                             'exercise': exercise,
+                             'correct': bool((i + j) % 2),
+                             'time_done': start_time + i * 10 + j})
+        return logs
+
+    def load(self, **filters):
+        return list(self.loader.entities("ProblemLog", end_date=DATE,
+                                         begin_date=DATE, limit=None,
+                                         filters=filters))
+
+
+class FilterTest(EntityLoaderTestBase):
+    def setUp(self):
+        super(FilterTest, self).setUp()
+        self.write_logs("a.json.gz", self.make_logs(
+            ["alice", "bob"], ["addition_1", "subtraction_1"], 1000))
+        self.write_logs("b.json.gz", self.make_logs(
+            ["carol"], [u"division_\xe9", "addition_1"], 2000))
+
+    def assert_filtered(self, expected_count, **filters):
+        # Same results before and after the index is built
+        unindexed = self.load(**filters)
+        self.loader.build_index("ProblemLog", DATE)
+        indexed = self.load(**filters)
+        self.assertEqual(expected_count, len(unindexed))
+        self.assertEqual(unindexed, indexed)
+        return indexed
+
+    def test_no_filters(self):
+        self.assert_filtered(6)
+
+    def test_equality(self):
+        logs = self.assert_filtered(3, exercise="addition_1")
+        self.assertTrue(all(log['json']['exercise'] == "addition_1"
+                            for log in logs))
+
+    def test_unicode_equality(self):
+        self.assert_filtered(1, exercise=u"division_\xe9")
+
+    def test_membership(self):
+        self.assert_filtered(5, exercise=["subtraction_1", "addition_1"])
+
+    def test_column(self):
+        self.assert_filtered(2, user="carol")
+
+    def test_boolean(self):
+        self.assert_filtered(3, correct=True)
+
+    def test_range(self):
+        self.assert_filtered(2, time_done=entity_loader.Range(1005, 1011))
+
+    def test_callable(self):
+        self.assert_filtered(2, time_done=lambda t: t >= 2000)
+
+    def test_missing_field(self):
+        self.assert_filtered(0, problem_type="1")
+
+    def test_combined(self):
+        self.assert_filtered(1, user="bob", exercise="subtraction_1")
+
+    def test_full_read_indexes(self):
+        dirname = self.loader.entity_dirname("ProblemLog", DATE)
+        self.load()
+        loader = entity_loader.EntityLoader(data_prefix=self.data_prefix)
+        index = loader.load_index(dirname)
+        self.assertEqual(["a.json.gz", "b.json.gz"], sorted(index))
+        self.assertEqual(self.loader.build_index("ProblemLog", DATE), index)
+
+    def test_partial_read_does_not_index(self):
+        dirname = self.loader.entity_dirname("ProblemLog", DATE)
+        self.assertEqual(1, len(list(self.loader.entities(
+            "ProblemLog", end_date=DATE, begin_date=DATE, limit=1))))
+        self.load(user="bob")
+        loader = entity_loader.EntityLoader(data_prefix=self.data_prefix)
+        self.assertEqual({}, loader.load_index(dirname))
+
+
+class IndexTest(EntityLoaderTestBase):
+    def setUp(self):
+        super(IndexTest, self).setUp()
+        self.path_a = self.write_logs("a.json.gz", self.make_logs(
+            ["alice", "bob"], ["addition_1"], 1000))
+        self.path_b = self.write_logs("b.json.gz", self.make_logs(
+            ["carol"], ["subtraction_1"], 2000))
+        self.loader.build_index("ProblemLog", DATE)
+
+    def may_match(self, path, **filters):
+        filters = dict((field, entity_loader._normalize_filter(spec))
+                       for field, spec in filters.iteritems())
+        return self.loader.file_may_match(path, filters)
+
+    def test_index_contents(self):
+        index = self.loader.load_index(
+            self.loader.entity_dirname("ProblemLog", DATE))
+        self.assertEqual(2, index["a.json.gz"]["rows"])
+        time_done = index["a.json.gz"]["fields"]["time_done"]
+        self.assertEqual((1000, 1010), (time_done["min"], time_done["max"]))
+
+    def test_skips_files_by_bloom(self):
+        self.assertTrue(self.may_match(self.path_a, exercise="addition_1"))
+        self.assertFalse(self.may_match(self.path_b, exercise="addition_1"))
+        self.assertFalse(self.may_match(self.path_a, user="carol"))
+
+    def test_skips_files_by_range(self):
+        self.assertTrue(self.may_match(self.path_b,
+            time_done=entity_loader.Range(1500, None)))
+        self.assertFalse(self.may_match(self.path_a,
+            time_done=entity_loader.Range(1500, None)))
+
+    def test_does_not_skip_on_other_types(self):
+        self.assertTrue(self.may_match(self.path_a, time_done=None))
+        self.assertTrue(self.may_match(self.path_a, exercise=1))
+
+    def test_stale_index_is_ignored(self):
+        self.write_logs("b.json.gz", self.make_logs(
+            ["carol"], ["addition_1", "addition_1", "addition_1"], 2000))
+        self.assertTrue(self.may_match(self.path_b, exercise="addition_1"))
+
+
+class ParallelTest(EntityLoaderTestBase):
+    def setUp(self):
+        super(ParallelTest, self).setUp()
+        # Enough rows for several chunks per file
+        for i in xrange(4):
+            self.write_logs("%d.json.gz" % i, self.make_logs(
+                ["user%d_%d" % (i, u) for u in xrange(300)],
+                ["addition_1", "subtraction_1", "division_1"], i * 10000))
+
+    def load_parallel(self, limit=None, unordered=False, **filters):
+        return list(self.loader.entities_parallel(
+            "ProblemLog", end_date=DATE, begin_date=DATE, limit=limit,
+            filters=filters, workers=3, unordered=unordered))
+
+    def test_ordered_matches_serial(self):
+        self.assertEqual(self.load(), self.load_parallel())
+
+    def test_unordered_has_same_entities(self):
+        key = lambda e: (e['user'], e['json']['exercise'])
+        self.assertEqual(sorted(self.load(), key=key),
+                         sorted(self.load_parallel(unordered=True), key=key))
+
+    def test_filters(self):
+        serial = self.load(exercise="division_1",
+                           time_done=lambda t: t % 2 == 0)
+        self.assertEqual(serial, self.load_parallel(
+            exercise="division_1", time_done=lambda t: t % 2 == 0))
+
+    def test_limit(self):
+        self.assertEqual(self.load()[:1500], self.load_parallel(limit=1500))
+
+
+class ColumnCacheTest(EntityLoaderTestBase):
+    def setUp(self):
+        super(ColumnCacheTest, self).setUp()
+        self.cache_prefix = tempfile.mkdtemp()
+        self.loader = entity_loader.EntityLoader(
+            data_prefix=self.data_prefix,
+            column_cache_prefix=self.cache_prefix)
+        logs = self.make_logs(["alice", "bob"], ["addition_1", "mult"], 1000)
+        logs[0]['time_taken'] = 1.5
+        logs[1]['time_taken'] = 7
+        logs[2]['exercise'] = None
+        self.path = self.write_logs("a.json.gz", logs)
+
+    def tearDown(self):
+        super(ColumnCacheTest, self).tearDown()
+        shutil.rmtree(self.cache_prefix)
+
+    def load_fields(self, fields, **filters):
+        return list(self.loader.entities("ProblemLog", end_date=DATE,
+                                         begin_date=DATE, limit=None,
+                                         filters=filters, fields=fields))
+
+    def test_cache_matches_json(self):
+        fields = ['exercise', 'correct', 'time_done', 'time_taken']
+        uncached = self.load_fields(fields)
+        self.assertTrue(self.loader._cached_columns(self.path, fields))
+        cached = self.load_fields(fields)
+        self.assertEqual(4, len(cached))
+        for full, partial in zip(uncached, cached):
+            full['json'] = dict((field, full['json'][field])
+                                for field in fields if field in full['json'])
+            self.assertEqual(full, partial)
+            self.assertEqual(str, type(partial['user']))
+        # Not in the last two logs, rather than None
+        self.assertEqual([True, True, False, False],
+                         ['time_taken' in e['json'] for e in cached])
+        self.assertEqual(1000, cached[0]['json']['time_done'])
+        self.assertTrue(isinstance(cached[0]['json']['time_done'], int))
+
+    def test_filters_on_cache(self):
+        self.load()
+        self.assertEqual(self.load(correct=True),
+                         [e for e in self.load() if e['json']['correct']])
+        cached = self.load_fields(['exercise'], correct=True, user="bob")
+        self.assertEqual([None], [e['json']['exercise'] for e in cached])
+
+    def test_default_read_caches(self):
+        logs = self.make_logs(["user%d" % i for i in xrange(600)],
+                              ["addition_1", "mult"], 1000)
+        self.path = self.write_logs("a.json.gz", logs)
+        # Stops at the default limit of 1000, partway through the file
+        self.assertEqual(1000, len(list(self.loader.entities(
+            "ProblemLog", end_date=DATE, begin_date=DATE))))
+        self.assertTrue(self.loader._column_cache_meta(self.path))
+        cached = self.load_fields(['exercise'])
+        self.assertEqual([log['exercise'] for log in logs],
+                         [e['json']['exercise'] for e in cached])
+
+    def test_filtered_read_does_not_cache(self):
+        self.load(user="bob")
+        self.assertEqual(None, self.loader._column_cache_meta(self.path))
+
+    def test_stale_cache_is_ignored(self):
+        self.load()
+        self.write_logs("a.json.gz", self.make_logs(["carol"], ["x"], 5))
+        self.assertEqual(["carol"],
+                         [e['user'] for e in self.load_fields(['exercise'])])
+
+    def test_column_arrays(self):
+        self.load()
+        arrays = list(self.loader.column_arrays(
+            "ProblemLog", ['correct', 'exercise', 'time_taken'], DATE, DATE))
+        self.assertEqual(1, len(arrays))
+        correct = arrays[0][1]['correct']
+        self.assertTrue(isinstance(correct.values, np.memmap))
+        self.assertEqual('bool', correct.kind)
+        self.assertEqual([0, 1, 1, 0], correct.values.tolist())
+        exercise = arrays[0][1]['exercise']
+        self.assertEqual(["addition_1", "mult", None, "mult"],
+                         [exercise.vocab[code] if code >= 0 else None
+                          for code in exercise.values])
+        time_taken = arrays[0][1]['time_taken']
+        self.assertEqual([False, False, True, True],
+                         time_taken.missing.tolist())
+        self.assertEqual([1.5, 7], time_taken.values[:2].tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
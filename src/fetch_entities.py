@@ -6,13 +6,19 @@ by backup_model.BackupModel.
 """
 
 import datetime as dt
+import gzip
+import multiprocessing.pool
 import optparse
+import os
 import pickle
+import shutil
 import sys
 import time
 import urllib
 import urllib2
 
+import pymongo
+
 import gae_util
 gae_util.fix_sys_path()
 
@@ -20,13 +26,23 @@ from google.appengine.api import datastore
 from google.appengine.datastore import entity_pb
 
 import date_util
+import ka_download_coordinator
+from ka_download_coordinator import DownloadStatus
 import notify
 import oauth_util.fetch_url
-from util import get_logger
+from util import get_logger, load_unstripped_json
+
+sys.path.append(os.path.dirname(__file__) + "/../map_reduce/py")
+import load_pbufs_to_hive
 
 g_logger = get_logger()
 
 
+class TooManyMatchingTimestampsError(UserWarning):
+    """More entities share one timestamp than can be fetched in one call."""
+    pass
+
+
 # TODO(benkomalo): rename "max_logs" to max_results or something.
 def fetch_entities(entity_type, is_ndb, start_date=None, end_date=None,
                    max_logs=None, index_name=None):
@@ -107,30 +123,60 @@ def attempt_fetch_entities(kind,
     return response
 
 
-def download_entities(kind,
-                      is_ndb,
-                      start_dt, end_dt,
-                      fetch_interval_seconds,
-                      max_entities_per_fetch,
-                      max_attempts_per_fetch,
-                      index_name,
-                      verbose=True):
-    """Downloads all entities between start_dt and end_dt  by
-    repeatedly calling attempt_fetch_entities if necessary.  Multiple calls
-    are only necessary if there are more entities in the time interval
-    than max_entities_per_fecth.
+def adapt_fetch_interval(interval_seconds, num_fetched,
+                         max_entities_per_fetch,
+                         min_interval_seconds, max_interval_seconds):
+    """Returns the width of the next fetch interval given the last fetch.
+
+    We aim for fetches that come back roughly half full: the interval is
+    halved when a fetch hit max_entities_per_fetch (so we had to page
+    within it) and doubled when a fetch came back less than a quarter
+    full.  The result is clamped to [min_interval_seconds,
+    max_interval_seconds].
+    """
+    if num_fetched >= max_entities_per_fetch:
+        interval_seconds /= 2.0
+    elif num_fetched < max_entities_per_fetch / 4.0:
+        interval_seconds *= 2.0
+    return max(min_interval_seconds,
+               min(interval_seconds, max_interval_seconds))
+
+
+def iter_entity_batches(kind,
+                        is_ndb,
+                        start_dt, end_dt,
+                        fetch_interval_seconds,
+                        max_entities_per_fetch,
+                        max_attempts_per_fetch,
+                        index_name,
+                        verbose=True,
+                        adaptive=False,
+                        min_interval_seconds=1,
+                        max_interval_seconds=3600):
+    """Yields the entities between start_dt and end_dt one fetch at a time.
+
+    Each item is the list of protocol buffers returned by a single call to
+    attempt_fetch_entities, so callers can process (or write out) every
+    batch as soon as it arrives instead of holding the whole range in
+    memory.  Multiple calls are only necessary if there are more entities
+    in the time interval than max_entities_per_fetch.
+
+    If adaptive is True, the fetch interval starts at fetch_interval_seconds
+    and is then resized after every fetch according to the observed entity
+    density (see adapt_fetch_interval), so quiet periods are covered in a
+    few large requests and busy ones don't page through the same interval.
 
     WARNING: because the API call returns entities in [start_dt, end_dt),
     this, function may return some duplicates in its result.  The caller should
     de-dupe by .key() of the entities if needed.
 
-    Returns a list of Entities in protocol buffer format.
+    Raises TooManyMatchingTimestampsError if a single timestamp has more
+    than max_entities_per_fetch entities, after notifying about it.
     """
-
-    entity_list = []
     interval_start = start_dt
-    time_delta = dt.timedelta(seconds=fetch_interval_seconds)
+    interval_seconds = fetch_interval_seconds
     while interval_start < end_dt:
+        time_delta = dt.timedelta(seconds=interval_seconds)
         interval_end = min(interval_start + time_delta, end_dt)
         response = attempt_fetch_entities(kind,
                                           is_ndb,
@@ -140,7 +186,12 @@ def download_entities(kind,
                                           index_name,
                                           verbose)
         response_list = pickle.loads(response)
-        entity_list += response_list
+        yield response_list
+
+        if adaptive:
+            interval_seconds = adapt_fetch_interval(
+                interval_seconds, len(response_list), max_entities_per_fetch,
+                min_interval_seconds, max_interval_seconds)
 
         if len(response_list) == max_entities_per_fetch:
             # if we maxed out the number of entities for the fetch, there
@@ -182,12 +233,207 @@ def download_entities(kind,
                 g_logger.error(msg)
                 notify.send_hipchat(msg)
                 notify.send_email(subject, msg)
-                return []
+                raise TooManyMatchingTimestampsError(msg)
             else:
                 interval_start = timestamp_last
         else:
             interval_start = interval_end
-    return entity_list
+
+
+class PickleEntityWriter(object):
+    """Writes all entities as one pickled list when closed.
+
+    This is the original output format; it has to hold every entity in
+    memory until the download is done.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.entity_list = []
+        self.count = 0
+
+    def write_batch(self, pbs):
+        self.entity_list += pbs
+        self.count += len(pbs)
+
+    def close(self):
+        with open(self.filename, 'wb') as f:
+            pickle.dump(self.entity_list, f)
+        self.entity_list = []
+
+
+class PbStreamEntityWriter(object):
+    """Writes entities as length-prefixed protobuf records as they arrive.
+
+    The output can be read back a record at a time with
+    load_pbufs_to_hive.read_pb_records.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.f = open(filename, 'wb')
+        self.count = 0
+
+    def write_batch(self, pbs):
+        for pb in pbs:
+            load_pbufs_to_hive.write_pb_record(self.f, pb)
+        self.count += len(pbs)
+
+    def close(self):
+        self.f.close()
+
+
+class JsonEntityWriter(object):
+    """Writes entities as gzipped "<key>\\t<json>" lines as they arrive.
+
+    This is the same format load_pbufs_to_hive.py produces, so the output
+    can be loaded into Hive directly.
+    """
+    def __init__(self, filename, key="key"):
+        self.filename = filename
+        self.key = key
+        self.f = gzip.open(filename, 'wb')
+        self.count = 0
+
+    def write_batch(self, pbs):
+        for pb in pbs:
+            print >> self.f, load_pbufs_to_hive.pb_to_json_line(
+                pb, self.key, parent=True)
+        self.count += len(pbs)
+
+    def close(self):
+        self.f.close()
+
+
+def open_entity_writer(filename, output_format, json_key="key"):
+    """Returns an entity writer for the given output format."""
+    if output_format == "pbstream":
+        return PbStreamEntityWriter(filename)
+    elif output_format == "json":
+        return JsonEntityWriter(filename, json_key)
+    return PickleEntityWriter(filename)
+
+
+def split_time_range(start_dt, end_dt, num_shards):
+    """Splits [start_dt, end_dt) into up to num_shards contiguous ranges.
+
+    Shard boundaries fall on whole seconds, so very short ranges may yield
+    fewer than num_shards shards.  Returns a list of (start, end) tuples.
+    """
+    total_seconds = int((end_dt - start_dt).total_seconds())
+    num_shards = max(1, min(num_shards, total_seconds))
+    boundaries = [start_dt + dt.timedelta(seconds=total_seconds * i //
+                                          num_shards)
+                  for i in xrange(num_shards)]
+    boundaries.append(end_dt)
+    return zip(boundaries[:-1], boundaries[1:])
+
+
+def shard_filename(output_file, kind, shard_start, shard_end):
+    """The file a single shard of a sharded download is checkpointed to."""
+    return "%s.%s.shard" % (output_file,
+        ka_download_coordinator.get_key(kind, shard_start, shard_end))
+
+
+def download_entities_sharded(kind,
+                              is_ndb,
+                              start_dt, end_dt,
+                              num_shards,
+                              num_workers,
+                              output_file,
+                              fetch_interval_seconds,
+                              max_entities_per_fetch,
+                              max_attempts_per_fetch,
+                              index_name,
+                              mongo=None,
+                              coordinator_cfg=None,
+                              adaptive=True,
+                              output_format="pickle",
+                              json_key="key",
+                              verbose=True):
+    """Downloads [start_dt, end_dt) as independent shards in parallel.
+
+    The time range is split into num_shards sub-ranges which are fetched
+    by iter_entity_batches() through a pool of num_workers threads (the work
+    is dominated by waiting on the network).  Each shard is written in
+    output_format (see open_entity_writer) to its own file next to
+    output_file.
+
+    If a mongo connection and coordinator_cfg are given, every shard's
+    progress is recorded with ka_download_coordinator.record_progress(), and
+    shards already marked as SAVED by a previous run are not fetched again.
+    Shards are recorded as such, so gae_reprocess doesn't take unfinished
+    ones for failed jobs.
+    Without a coordinator, an existing shard file is taken as proof that the
+    shard is complete (shard files are only renamed into place once fully
+    written).
+
+    Raises UserWarning if any shard could not be downloaded; the shards
+    that did succeed are kept so that re-running only fetches the rest.
+
+    Returns the list of shard files, in time order.
+    """
+    use_coordinator = mongo is not None and coordinator_cfg is not None
+
+    def _shard_done(shard_start, shard_end, shard_file):
+        if not os.path.exists(shard_file):
+            return False
+        if not use_coordinator:
+            return True
+        status = ka_download_coordinator.get_progress(
+            mongo, coordinator_cfg, kind, shard_start, shard_end, shard=True)
+        return status >= DownloadStatus.SAVED
+
+    def _record(shard_start, shard_end, status):
+        if use_coordinator:
+            ka_download_coordinator.record_progress(
+                mongo, coordinator_cfg, kind, shard_start, shard_end, status,
+                shard=True)
+
+    def _download_shard(shard):
+        shard_start, shard_end = shard
+        shard_file = shard_filename(output_file, kind, shard_start, shard_end)
+        if _shard_done(shard_start, shard_end, shard_file):
+            if verbose:
+                print >> sys.stderr, ("Shard [%s, %s) of %s already "
+                    "downloaded, skipping." % (shard_start, shard_end, kind))
+            return None
+
+        try:
+            _record(shard_start, shard_end, DownloadStatus.STARTED)
+            tmp_file = shard_file + ".tmp"
+            writer = open_entity_writer(tmp_file, output_format, json_key)
+            try:
+                for response_list in iter_entity_batches(
+                        kind, is_ndb, shard_start, shard_end,
+                        fetch_interval_seconds, max_entities_per_fetch,
+                        max_attempts_per_fetch, index_name, verbose,
+                        adaptive=adaptive):
+                    writer.write_batch(response_list)
+            finally:
+                writer.close()
+            _record(shard_start, shard_end, DownloadStatus.FETCHED)
+
+            os.rename(tmp_file, shard_file)
+            _record(shard_start, shard_end, DownloadStatus.SAVED)
+        except Exception as e:
+            g_logger.error("Failed to download shard [%s, %s) of %s: %s" % (
+                shard_start, shard_end, kind, e))
+            return shard
+        return None
+
+    shards = split_time_range(start_dt, end_dt, num_shards)
+    pool = multiprocessing.pool.ThreadPool(max(1, num_workers))
+    try:
+        failed_shards = filter(None, pool.map(_download_shard, shards))
+    finally:
+        pool.close()
+        pool.join()
+
+    if failed_shards:
+        raise UserWarning("Failed to download %d of %d shards of %s: %s" % (
+            len(failed_shards), len(shards), kind, failed_shards))
+
+    return [shard_filename(output_file, kind, shard_start, shard_end)
+            for shard_start, shard_end in shards]
 
 
 def get_cmd_line_args():
@@ -196,7 +442,8 @@ def get_cmd_line_args():
 
     parser = optparse.OptionParser(usage="%prog [options]",
         description="Fetches problem logs from khanacademy.org using its "
-                    "v1 API. Outputs in pickled entities.")
+                    "v1 API. Outputs in pickled entities, length-prefixed "
+                    "protobuf records or gzipped json lines.")
     parser.add_option("-s", "--start_date",
         default=date_util.to_date_iso(yesterday_dt),
         help="Earliest inclusive date of logs to fetch, in ISO 8601 format. "
@@ -220,6 +467,28 @@ def get_cmd_line_args():
         action="store_true", dest="is_ndb", default=False)
     parser.add_option("-k", "--key", default="backup_timestamp",
         help="Name of entity property to use in a date range query.")
+    parser.add_option("--shards", default=1, type="int",
+        help="Split the date range into this many independently "
+             "downloaded and checkpointed shards. Defaults to 1 (no "
+             "sharding).")
+    parser.add_option("-w", "--workers", default=4, type="int",
+        help="Max # of shards to download concurrently. Defaults to 4.")
+    parser.add_option("-a", "--adaptive", action="store_true", default=False,
+        help="Resize the fetch interval according to the observed entity "
+             "density. Always on when --shards is greater than 1.")
+    parser.add_option("-c", "--config",
+        help="Config file (as used by gae_download.py) with the mongo "
+             "db and coordinator_cfg in which shard progress is recorded.")
+    parser.add_option("-f", "--format", default="pickle",
+        choices=["pickle", "pbstream", "json"],
+        help="Output format: one pickled list of protobufs (pickle), "
+             "length-prefixed protobuf records written as they are fetched "
+             "(pbstream, readable by load_pbufs_to_hive.py -f pbstream), or "
+             "gzipped '<key>\\t<json>' lines written as they are fetched "
+             "(json). Defaults to pickle.")
+    parser.add_option("-j", "--json_key", default="key",
+        help="Entity property written before the tab in json output. "
+             "Defaults to key.")
 
     options, _ = parser.parse_args()
 
@@ -227,29 +496,107 @@ def get_cmd_line_args():
         print >> sys.stderr, 'Please specify an entity type to back up'
         exit(1)
     if not options.output_file:
-        options.output_file = options.type + ".pickle"
+        extension = {"pickle": ".pickle",
+                     "pbstream": ".pbstream",
+                     "json": ".json.gz"}[options.format]
+        options.output_file = options.type + extension
 
     return options
 
 
+def merge_shard_files(shard_files, output_file, output_format):
+    """Combines the shard files of a sharded download into output_file.
+
+    Length-prefixed protobuf streams and gzip files can simply be
+    concatenated; pickled shards have to be loaded and re-pickled.
+    """
+    with open(output_file, 'wb') as out:
+        if output_format == "pickle":
+            entity_list = []
+            for shard_file in shard_files:
+                with open(shard_file, 'rb') as f:
+                    entity_list += pickle.load(f)
+            pickle.dump(entity_list, out)
+        else:
+            for shard_file in shard_files:
+                with open(shard_file, 'rb') as f:
+                    shutil.copyfileobj(f, out)
+
+
+def download_and_merge_shards(options, start_dt, end_dt):
+    """Runs a sharded download and merges the shards into the output file."""
+    mongo = None
+    coordinator_cfg = None
+    if options.config:
+        config = load_unstripped_json(options.config)
+        mongo = pymongo.Connection(config['dbhost'], config['dbport'])
+        coordinator_cfg = config['coordinator_cfg']
+
+    shard_files = download_entities_sharded(options.type,
+                                            options.is_ndb,
+                                            start_dt, end_dt,
+                                            options.shards,
+                                            options.workers,
+                                            options.output_file,
+                                            int(options.interval),
+                                            int(options.max_logs),
+                                            int(options.max_retries),
+                                            options.key,
+                                            mongo=mongo,
+                                            coordinator_cfg=coordinator_cfg,
+                                            output_format=options.format,
+                                            json_key=options.json_key)
+
+    merge_shard_files(shard_files, options.output_file, options.format)
+
+    for (shard_start, shard_end), shard_file in zip(
+            split_time_range(start_dt, end_dt, options.shards), shard_files):
+        if mongo is not None:
+            ka_download_coordinator.record_progress(mongo, coordinator_cfg,
+                options.type, shard_start, shard_end, DownloadStatus.LOADED,
+                shard=True)
+        os.remove(shard_file)
+
+    print >> sys.stderr, ("Merged %d shards into %s.  Exiting." %
+                          (len(shard_files), options.output_file))
+
+
 def main():
     options = get_cmd_line_args()
     end_dt = date_util.from_date_iso(options.end_date)
     start_dt = date_util.from_date_iso(options.start_date)
 
-    entity_list = download_entities(options.type,
-                                    options.is_ndb,
-                                    start_dt, end_dt,
-                                    int(options.interval),
-                                    int(options.max_logs),
-                                    int(options.max_retries),
-                                    options.key)
-
-    with open(options.output_file, 'wb') as f:
-        pickle.dump(entity_list, f)
+    if options.shards > 1 or options.config:
+        download_and_merge_shards(options, start_dt, end_dt)
+        return
+
+    # Batches are handed to the writer as they are fetched, so with the
+    # streaming formats memory use does not grow with the size of the range.
+    # They go to a temporary file that's only renamed into place once the
+    # whole range is written, so a failed download never leaves a truncated
+    # file that looks complete.
+    tmp_file = options.output_file + ".tmp"
+    writer = open_entity_writer(tmp_file, options.format, options.json_key)
+    written = False
+    try:
+        for response_list in iter_entity_batches(options.type,
+                                                 options.is_ndb,
+                                                 start_dt, end_dt,
+                                                 int(options.interval),
+                                                 int(options.max_logs),
+                                                 int(options.max_retries),
+                                                 options.key,
+                                                 adaptive=options.adaptive):
+            writer.write_batch(response_list)
+        written = True
+    finally:
+        writer.close()
+        if not written:
+            os.remove(tmp_file)
+    os.rename(tmp_file, options.output_file)
 
     print >> sys.stderr, ("Downloaded and wrote %d entities.  Exiting." %
-                          len(entity_list))
+                          writer.count)
 
 
 if __name__ == '__main__':
@@ -23,16 +23,19 @@ ROOT="$(dirname $0)"
 
 export PYTHONPATH="${ROOT}:${PYTHONPATH}"   # for oauth_util directory
 
-"$PYTHON" "$ROOT/fetch_entities.py" \
-    -s "${day}T00:00:00Z" -e "${day_next}T00:00:00Z" \
-    -t ProblemLog -o "$log_dir/$day-ProblemLog.pickle" \
-    >"$log_dir/$day-ProblemLog.log" 2>&1
-
-gzip "$log_dir/$day-ProblemLog.pickle"
-
-"$PYTHON" "$ROOT/fetch_entities.py" \
-    -s "${day}T00:00:00Z" -e "${day_next}T00:00:00Z" \
-    -t VideoLog -o "$log_dir/$day-VideoLog.pickle" \
-    >"$log_dir/$day-VideoLog.log" 2>&1
-
-gzip "$log_dir/$day-VideoLog.pickle"
+# fetch_entities.py exits non-zero without writing its output file when a
+# download fails, so only gzip what it actually wrote.
+status=0
+for kind in ProblemLog VideoLog; do
+    if "$PYTHON" "$ROOT/fetch_entities.py" \
+        -s "${day}T00:00:00Z" -e "${day_next}T00:00:00Z" \
+        -t "$kind" -o "$log_dir/$day-$kind.pickle" \
+        >"$log_dir/$day-$kind.log" 2>&1; then
+        gzip "$log_dir/$day-$kind.pickle"
+    else
+        echo "Failed to fetch $kind for $day; see $log_dir/$day-$kind.log" >&2
+        status=1
+    fi
+done
+
+exit $status
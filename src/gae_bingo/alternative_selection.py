@@ -0,0 +1,72 @@
+"""Weighted assignment of bingo identities to experiment alternatives.
+
+An identity's alternative is picked by hashing the experiment's hashable
+name with the identity, taking the MD5 of that modulo the total weight of
+the alternatives, and walking the alternatives from heaviest to lightest
+(ties in their original order) until the running weight covers it.
+
+This module has no App Engine dependencies so that offline tools, like
+map_reduce/py/bingo_alternative_selector.py, make exactly the same
+assignments as gae_bingo.modulo_choose.
+"""
+
+import bisect
+import hashlib
+import struct
+
+_MD5_WORDS = struct.Struct(">QQ")
+
+
+def digest_words(experiment_hashable_name, identity):
+    """The MD5 digest of name + identity as (high, low) 64 bit words."""
+    return _MD5_WORDS.unpack(
+        hashlib.md5(experiment_hashable_name + str(identity)).digest())
+
+
+class SelectionTable(object):
+    """Precomputed lookup table for picking among weighted alternatives.
+
+    Alternative positions[i] owns the hash values in [lows[i], lows[i + 1]),
+    lows being ascending, so a pick is a binary search.
+    """
+
+    def __init__(self, weights):
+        """weights is the list of alternative weights, in alternative order."""
+        self.total_weight = sum(weights)
+
+        # Same order modulo_choose has always walked them in: heaviest first,
+        # keeping the original order among equal weights.
+        order = sorted(range(len(weights)), key=lambda i: weights[i],
+                       reverse=True)
+
+        # The first alternative in that order owns the top of the range, so
+        # build the ascending boundaries from the last one.
+        self.lows = []
+        self.positions = []
+        low = 0
+        for position in reversed(order):
+            self.lows.append(low)
+            self.positions.append(position)
+            low += weights[position]
+
+        # 2 ** 64 % total_weight, for reducing the 128 bit hash. (With no
+        # weight at all, hash_index raises ZeroDivisionError as it always has.)
+        self.high_word_multiplier = ((1 << 64) % self.total_weight
+                                     if self.total_weight else 0)
+
+    def hash_index(self, experiment_hashable_name, identity):
+        """int(md5(name + identity).hexdigest(), 16) % total_weight, computed
+        from the digest's two 64 bit words instead of a hex string.
+        """
+        high, low = digest_words(experiment_hashable_name, identity)
+        return (((high % self.total_weight) * self.high_word_multiplier +
+                 low) % self.total_weight)
+
+    def position_for_index(self, index_weight):
+        """The position of the alternative that owns index_weight."""
+        return self.positions[bisect.bisect_right(self.lows, index_weight) - 1]
+
+    def choose(self, experiment_hashable_name, identity):
+        """The position of the alternative identity is assigned to."""
+        return self.position_for_index(
+            self.hash_index(experiment_hashable_name, identity))
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+import hashlib
+import random
+import unittest
+
+import alternative_selection
+
+
+def original_modulo_choose(experiment_hashable_name, weights, identity):
+    """modulo_choose as it was before SelectionTable, returning a position."""
+    alternatives_weight = sum(weights)
+
+    sig = hashlib.md5(experiment_hashable_name + str(identity)).hexdigest()
+    sig_num = int(sig, base=16)
+    index_weight = sig_num % alternatives_weight
+
+    current_weight = alternatives_weight
+    for position in sorted(range(len(weights)),
+                           key=lambda i: weights[i],
+                           reverse=True):
+
+        current_weight -= weights[position]
+        if index_weight >= current_weight:
+            return position
+
+
+class SelectionTableTest(unittest.TestCase):
+    def assert_same_choices(self, weights, name="monkeys"):
+        table = alternative_selection.SelectionTable(weights)
+        for i in xrange(2000):
+            identity = "_gae_bingo_random:%s" % i
+            self.assertEqual(original_modulo_choose(name, weights, identity),
+                             table.choose(name, identity))
+
+    def test_unweighted(self):
+        self.assert_same_choices([1, 1])
+        self.assert_same_choices([1, 1, 1, 1, 1])
+
+    def test_weighted(self):
+        self.assert_same_choices([100, 200, 400], name="crocodiles")
+        self.assert_same_choices([3, 0, 3, 7, 1, 7])
+
+    def test_random_weights(self):
+        rng = random.Random(0)
+        for _ in xrange(20):
+            weights = [rng.choice([0, 1, 2, 5, 10 ** 6, 2 ** 70])
+                       for _ in xrange(rng.randint(1, 6))]
+            if sum(weights):
+                self.assert_same_choices(weights, name=u"exp %s" % weights)
+
+    def test_no_weight(self):
+        table = alternative_selection.SelectionTable([0, 0])
+        self.assertRaises(ZeroDivisionError, table.choose, "monkeys", "x")
+
+
+if __name__ == '__main__':
+    unittest.main()
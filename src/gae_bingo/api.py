@@ -1,3 +1,4 @@
+import copy
 import itertools
 import logging
 import os
@@ -8,10 +9,10 @@ from .gae_bingo import choose_alternative, delete_experiment, resume_experiment
 from .gae_bingo import archive_experiment, modulo_choose
 from .models import _GAEBingoExperimentNotes
 from .cache import BingoCache
-from .stats import describe_result_in_words
+from .stats import analyze, describe_result_in_words
 from .config import can_control_experiments, retrieve_identity
 from .jsonify import jsonify
-from .plots import get_experiment_timeline_data
+from .plots import get_experiment_stats_timeline, get_experiment_timeline_data
 from .identity import identity
 
 class GAEBingoAPIRequestHandler(RequestHandler):
@@ -63,6 +64,9 @@ class Experiments(GAEBingoAPIRequestHandler):
                 # Combine related experiments and alternatives into a single
                 # canonical experiment for response
                 if experiment.canonical_name not in experiment_results:
+                    # A copy, since the cached experiment is shared between
+                    # requests
+                    experiment = copy.copy(experiment)
                     experiment.alternatives = alternatives
                     experiment_results[experiment.canonical_name] = experiment
 
@@ -154,7 +158,10 @@ class ExperimentConversions(GAEBingoAPIRequestHandler):
         bingo_cache = self.request_bingo_cache()
         experiment_name = self.request.get("experiment_name")
         experiment = bingo_cache.get_experiment(experiment_name)
-        alternatives = bingo_cache.get_alternatives(experiment_name)
+        # Copies, since the cached alternatives are shared between requests
+        # and we're about to load their latest counts into them.
+        alternatives = [copy.copy(alternative) for alternative in
+                        bingo_cache.get_alternatives(experiment_name)]
 
         if not experiment or not alternatives:
             raise Exception("No experiment matching name: %s" % canonical_name)
@@ -174,7 +181,10 @@ class ExperimentConversions(GAEBingoAPIRequestHandler):
                 "total_participants": reduce(lambda a, b: a + b, map(lambda alternative: alternative.participants, alternatives)),
                 "total_conversions": reduce(lambda a, b: a + b, map(lambda alternative: alternative.conversions, alternatives)),
                 "alternatives": alternatives,
-                "significance_test_results": describe_result_in_words(alternatives),
+                "significance_test_results": describe_result_in_words(
+                    alternatives, experiment.conversion_type),
+                "stats": analyze(alternatives, experiment.conversion_type),
+                "stats_timeline": get_experiment_stats_timeline(experiment),
                 "y_axis_title": experiment.y_axis_title,
                 "timeline_series": get_experiment_timeline_data(experiment),
                 "short_circuit_number": short_circuit_number
@@ -260,7 +270,8 @@ class Alternatives(GAEBingoAPIRequestHandler):
 
             if experiment.canonical_name not in chosen_alternatives:
                 alternatives = bingo_cache.get_alternatives(experiment_name)
-                alternative = modulo_choose(experiment.hashable_name, alternatives, id)
+                alternative = modulo_choose(experiment.hashable_name, alternatives, id,
+                                            bingo_cache.get_selection_table(experiment_name))
                 chosen_alternatives[experiment.canonical_name] = str(alternative.content)
 
         context = {
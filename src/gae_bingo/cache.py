@@ -1,4 +1,7 @@
-import hashlib
+import copy
+import datetime
+import logging
+import time
 
 from google.appengine.ext import db
 from google.appengine.ext import deferred
@@ -6,7 +9,9 @@ from google.appengine.api import memcache
 from google.appengine.datastore import entity_pb
 from google.appengine.ext.webapp import RequestHandler
 
+from .alternative_selection import SelectionTable
 from .models import _GAEBingoExperiment, _GAEBingoAlternative, _GAEBingoIdentityRecord, _GAEBingoSnapshotLog
+from .models import _GAEBingoSnapshotRollup, fold_unpersisted_counts
 from identity import identity
 import request_cache
 from config import QUEUE_NAME
@@ -22,15 +27,74 @@ import pickle_util
 #
 # Example: import config_django
 
+# The BingoCache this instance last loaded from memcache, with its models
+# decoded, and the generation it was loaded at. While the generation in
+# memcache doesn't change, requests get copies of it instead of unpickling
+# the whole BingoCache and decoding its models all over again.
+_instance_bingo_cache = (None, None)
+
+def timeline_version_key(experiment):
+    """Memcache key of the version of experiment's timeline, which changes
+    each time a snapshot of it is logged.
+    """
+    # Key names are unique even among experiments that reuse a name
+    return "_gae_bingo_timeline_version:%s" % experiment.key().name()
+
 def init_request_cache_from_memcache():
     if not request_cache.cache.get("loaded_from_memcache"):
-        request_cache.cache.update(memcache.get_multi([BingoCache.MEMCACHE_KEY, BingoIdentityCache.key_for_identity(identity())]))
+        cached = memcache.get_multi([BingoCache.GENERATION_KEY, BingoIdentityCache.key_for_identity(identity())])
+        generation = cached.pop(BingoCache.GENERATION_KEY, None)
+        request_cache.cache.update(cached)
+
+        bingo_cache = BingoCache.load_from_memcache(generation)
+        if bingo_cache:
+            request_cache.cache[BingoCache.MEMCACHE_KEY] = bingo_cache
+
         request_cache.cache["loaded_from_memcache"] = True
 
 class BingoCache(object):
 
     MEMCACHE_KEY = "_gae_bingo_cache"
 
+    # Counter bumped every time the BingoCache in memcache changes
+    GENERATION_KEY = "_gae_bingo_cache_generation"
+
+    @staticmethod
+    def load_from_memcache(generation):
+        """ Return a copy of this instance's BingoCache if it's still at
+        generation, otherwise load the BingoCache from memcache and remember
+        it for later requests.
+
+        Returns None if the BingoCache isn't in memcache.
+        """
+        global _instance_bingo_cache
+
+        instance_generation, bingo_cache = _instance_bingo_cache
+        if generation is None:
+            # The generation was evicted. Restart it from the time, as
+            # store_if_dirty does, so later requests can use this instance's
+            # copy again. If another request restarted it first, we don't
+            # know which generation we're about to read.
+            generation = long(time.time() * 1000)
+            if not memcache.add(BingoCache.GENERATION_KEY, generation):
+                generation = None
+
+        if generation is None or generation != instance_generation:
+            # Read after the generation, so this is at least as new.
+            bingo_cache = memcache.get(BingoCache.MEMCACHE_KEY) or None
+            if bingo_cache:
+                bingo_cache.decode_models()
+
+            # Remember a miss too, so requests don't each go back to memcache
+            # for it; loading from the datastore bumps the generation.
+            if generation is not None:
+                _instance_bingo_cache = (generation, bingo_cache)
+
+        if not bingo_cache:
+            return None
+
+        return bingo_cache.copy_for_request()
+
     @staticmethod
     def get():
         init_request_cache_from_memcache()
@@ -49,6 +113,7 @@ class BingoCache(object):
 
         self.alternatives = {} # Protobuf version of alternatives for extremely fast (de)serialization
         self.alternative_models = {} # Deserialized alternative models
+        self.selection_tables = {} # SelectionTables for the alternative models
 
         self.experiment_names_by_conversion_name = {} # Mapping of conversion names to experiment names
         self.experiment_names_by_canonical_name = {} # Mapping of canonical names to experiment names
@@ -61,12 +126,56 @@ class BingoCache(object):
         # Wipe out deserialized models before serialization for speed
         self.experiment_models = {}
         self.alternative_models = {}
+        self.selection_tables = {}
 
         # No longer dirty
         self.dirty = False
 
         memcache.set(BingoCache.MEMCACHE_KEY, self)
 
+        # Let every instance know there's a new version. If the generation
+        # was evicted, restart it from the time so it can't go back to a
+        # number some instance has already seen.
+        memcache.incr(BingoCache.GENERATION_KEY,
+                      initial_value=long(time.time() * 1000))
+
+    def decode_models(self):
+        """Decode every experiment and alternative model, and build their
+        SelectionTables.
+        """
+        self.selection_tables = {}
+        for experiment_name in self.experiments:
+            self.get_experiment(experiment_name)
+        for experiment_name in self.alternatives:
+            self.get_selection_table(experiment_name)
+
+    def copy_for_request(self):
+        """ A copy of this BingoCache that a request can modify freely.
+
+        The decoded models are shared with the original and every other
+        request, so they must never be changed in place. Anything that changes
+        or puts a model works on a fresh one from decode_experiment or
+        decode_alternatives, and anything that only decorates one for display
+        works on a copy.copy of it.
+        """
+        bingo_cache = copy.copy(self)
+
+        bingo_cache.experiments = dict(self.experiments)
+        bingo_cache.experiment_models = dict(self.experiment_models)
+        bingo_cache.alternatives = dict(
+                (name, dict(alternatives))
+                for name, alternatives in self.alternatives.iteritems())
+        bingo_cache.alternative_models = dict(self.alternative_models)
+        bingo_cache.selection_tables = dict(self.selection_tables)
+        bingo_cache.experiment_names_by_conversion_name = dict(
+                (name, list(names)) for name, names in
+                self.experiment_names_by_conversion_name.iteritems())
+        bingo_cache.experiment_names_by_canonical_name = dict(
+                (name, list(names)) for name, names in
+                self.experiment_names_by_canonical_name.iteritems())
+
+        return bingo_cache
+
     def persist_to_datastore(self):
         """ Persist current state of experiment and alternative models to
         datastore. Their sums might be slightly out-of-date during any
@@ -75,55 +184,82 @@ class BingoCache(object):
         """
         experiments_to_put = []
         for experiment_name in self.experiments:
-            experiment_model = self.get_experiment(experiment_name)
+            # Fresh models, since put changes them and the cached ones may
+            # be shared with other requests.
+            experiment_model = self.decode_experiment(experiment_name)
             if experiment_model:
                 experiments_to_put.append(experiment_model)
 
-        alternatives_to_put = []
+        legacy_counter_keys = []
         for experiment_name in self.alternatives:
-            alternative_models = self.get_alternatives(experiment_name)
+            # Fresh models, since the cached ones may be shared with other
+            # requests.
+            alternative_models = self.decode_alternatives(experiment_name)
+            if not alternative_models:
+                continue
+
+            # When persisting to datastore, we want to store the most recent
+            # value we've got. An experiment's alternatives are one entity
+            # group, so their counts are folded in one transaction.
+            db.run_in_transaction(fold_unpersisted_counts, alternative_models)
             for alternative_model in alternative_models:
-                # When persisting to datastore, we want to store the most recent value we've got
-                alternative_model.load_latest_counts()
-                alternatives_to_put.append(alternative_model)
+                legacy_counter_keys += alternative_model.legacy_counter_keys()
                 self.update_alternative(alternative_model)
 
-        # When periodically persisting to datastore, first make sure memcache
-        # has relatively up-to-date participant/conversion counts for each
-        # alternative.
+        # The legacy counters' counts are in the datastore now.
+        if legacy_counter_keys:
+            memcache.delete_multi(legacy_counter_keys)
+
+        # Then make sure memcache has relatively up-to-date
+        # participant/conversion counts for each alternative.
         self.dirty = True
         self.store_if_dirty()
 
-        # Once memcache is done, put both experiments and alternatives.
-        async_experiments = db.put_async(experiments_to_put)
-        async_alternatives = db.put_async(alternatives_to_put)
-
-        async_experiments.get_result()
-        async_alternatives.get_result()
+        db.put(experiments_to_put)
 
     def log_cache_snapshot(self):
 
         # Log current data on live experiments to the datastore
         log_entries = []
+        logged_experiments = []
 
         for experiment_name in self.experiments:
             experiment_model = self.get_experiment(experiment_name)
             if experiment_model and experiment_model.live:
                 log_entries += self.log_experiment_snapshot(experiment_model)
+                logged_experiments.append(experiment_model)
 
         db.put(log_entries)
+
+        # Timelines cached for the previous snapshot are now out of date
+        if logged_experiments:
+            memcache.offset_multi(
+                    dict((timeline_version_key(experiment), 1)
+                         for experiment in logged_experiments),
+                    initial_value=long(time.time() * 1000))
             
     def log_experiment_snapshot(self, experiment_model):
+        """The snapshot log entries of experiment_model's alternatives, and
+        the hourly and daily rollups they update.
+        """
 
         log_entries = []
+        rollups = []
+        time_recorded = datetime.datetime.now()
         
         alternative_models = self.get_alternatives(experiment_model.name)
         for alternative_model in alternative_models:
             # When logging, we want to store the most recent value we've got
-            log_entry = _GAEBingoSnapshotLog(parent=experiment_model, alternative_number=alternative_model.number, conversions=alternative_model.latest_conversions_count(), participants=alternative_model.latest_participants_count())
+            participants, conversions = alternative_model.latest_counts()
+            log_entry = _GAEBingoSnapshotLog(parent=experiment_model, alternative_number=alternative_model.number, conversions=conversions, participants=participants, time_recorded=time_recorded)
             log_entries.append(log_entry)
 
-        return log_entries
+            for resolution in (_GAEBingoSnapshotRollup.HOURLY,
+                               _GAEBingoSnapshotRollup.DAILY):
+                rollups.append(_GAEBingoSnapshotRollup.from_snapshot_log(
+                        experiment_model, resolution, log_entry))
+
+        return log_entries + rollups
     
     @staticmethod
     def load_from_datastore(archives=False):
@@ -206,6 +342,7 @@ class BingoCache(object):
         # Clear out alternative models cache so they'll be re-grabbed w/ next .get_alternatives
         if alternative.experiment_name in self.alternative_models:
             del self.alternative_models[alternative.experiment_name]
+        self.selection_tables.pop(alternative.experiment_name, None)
 
         self.dirty = True
 
@@ -223,6 +360,8 @@ class BingoCache(object):
         if experiment.name in self.alternative_models:
             del self.alternative_models[experiment.name]
 
+        self.selection_tables.pop(experiment.name, None)
+
         if experiment.conversion_name in self.experiment_names_by_conversion_name:
             self.experiment_names_by_conversion_name[experiment.conversion_name].remove(experiment.name)
 
@@ -263,11 +402,15 @@ class BingoCache(object):
         if not experiment:
             return
 
+        # Fresh models, since the cached ones may be shared with other
+        # requests. They're decoded inside the transaction so a retry starts
+        # over from the cached state.
+        experiment = self.decode_experiment(experiment.name) or experiment
         experiment.archived = True
         experiment.live = False
         experiment.put()
 
-        alts = self.get_alternatives(experiment.name)
+        alts = self.decode_alternatives(experiment.name)
         for alternative in alts:
             alternative.archived = True
             alternative.live = False
@@ -285,19 +428,37 @@ class BingoCache(object):
     def get_experiment(self, experiment_name):
         if experiment_name not in self.experiment_models:
             if experiment_name in self.experiments:
-                self.experiment_models[experiment_name] = db.model_from_protobuf(entity_pb.EntityProto(self.experiments[experiment_name]))
+                self.experiment_models[experiment_name] = self.decode_experiment(experiment_name)
 
         return self.experiment_models.get(experiment_name)
 
+    def decode_experiment(self, experiment_name):
+        """A new experiment model for experiment_name, not shared with anyone."""
+        if experiment_name not in self.experiments:
+            return None
+        return db.model_from_protobuf(entity_pb.EntityProto(self.experiments[experiment_name]))
+
     def get_alternatives(self, experiment_name):
         if experiment_name not in self.alternative_models:
             if experiment_name in self.alternatives:
-                self.alternative_models[experiment_name] = []
-                for alternative_number in self.alternatives[experiment_name]:
-                    self.alternative_models[experiment_name].append(db.model_from_protobuf(entity_pb.EntityProto(self.alternatives[experiment_name][alternative_number])))
+                self.alternative_models[experiment_name] = self.decode_alternatives(experiment_name)
 
         return self.alternative_models.get(experiment_name) or []
 
+    def get_selection_table(self, experiment_name):
+        """The SelectionTable for get_alternatives(experiment_name)."""
+        if experiment_name not in self.selection_tables:
+            alternatives = self.get_alternatives(experiment_name)
+            self.selection_tables[experiment_name] = SelectionTable(
+                    [alternative.weight for alternative in alternatives])
+
+        return self.selection_tables[experiment_name]
+
+    def decode_alternatives(self, experiment_name):
+        """New alternative models for experiment_name, not shared with anyone."""
+        return [db.model_from_protobuf(entity_pb.EntityProto(self.alternatives[experiment_name][alternative_number]))
+                for alternative_number in self.alternatives.get(experiment_name, {})]
+
     def get_experiment_names_by_conversion_name(self, conversion_name):
         return self.experiment_names_by_conversion_name.get(conversion_name) or []
 
@@ -308,6 +469,41 @@ class BingoIdentityCache(object):
 
     MEMCACHE_KEY = "_gae_bingo_identity_cache:%s"
 
+    # Identities waiting to be persisted are queued in memcache slots
+    # head + 1 through tail, where tail is incr'd to append to the queue.
+    QUEUE_HEAD_KEY = "_gae_bingo_identity_queue_head"
+    QUEUE_TAIL_KEY = "_gae_bingo_identity_queue_tail"
+    QUEUE_SLOT_KEY = "_gae_bingo_identity_queue:%s"
+
+    # A flush that finds a slot empty, because its identity was evicted or
+    # hasn't been written yet, adds this marker to it so that a late append
+    # fails and moves on to a new slot instead of writing behind the head.
+    QUEUE_SKIPPED = "_gae_bingo_identity_queue_skipped"
+    QUEUE_SKIPPED_SECONDS = 60 * 60
+
+    # Slots an append tries before giving up on the identity
+    QUEUE_APPEND_ATTEMPTS = 3
+
+    # If the head is evicted, the flush starts this many slots before the
+    # tail instead of rescanning the queue from the beginning.
+    QUEUE_RECOVERY_WINDOW = 20000
+
+    # Only one flush_identity_queue at a time
+    FLUSH_LOCK_KEY = "_gae_bingo_identity_flush_lock"
+    FLUSH_LOCK_SECONDS = 10 * 60
+
+    # Running totals of identities written to the datastore, and of queued
+    # identities lost to memcache eviction (slots found empty, which an
+    # append very rarely hasn't written yet), for monitoring.
+    FLUSHED_COUNT_KEY = "_gae_bingo_identity_flushed_count"
+    DROPPED_COUNT_KEY = "_gae_bingo_identity_dropped_count"
+
+    # Kick off a flush every time this many identities have been queued
+    FLUSH_EVERY = 500
+
+    # Identity records put per datastore RPC
+    PUT_BATCH_SIZE = 250
+
     @staticmethod
     def key_for_identity(ident):
         return BingoIdentityCache.MEMCACHE_KEY % ident
@@ -337,43 +533,34 @@ class BingoIdentityCache(object):
 
     def persist_to_datastore(self, ident):
 
-        # Add the memcache value to a memcache bucket which
-        # will be persisted to the datastore when it overflows
-        # or when the periodic cron job is run
-        sig = hashlib.md5(str(ident)).hexdigest()
-        sig_num = int(sig, base=16)
-        bucket = sig_num % 51
-        key = "_gae_bingo_identity_bucket:%s" % bucket
-
-        list_identities = memcache.get(key) or []
-        list_identities.append(ident)
-
-        if len(list_identities) > 50:
-
-            # If over 50 identities are waiting for persistent storage, 
-            # go ahead and kick off a deferred task to do so
-            # in case it'll be a while before the cron job runs.
-            deferred.defer(persist_gae_bingo_identity_records, list_identities, _queue=QUEUE_NAME)
-
-            # There are race conditions here such that we could miss persistence
-            # of some identities, but that's not a big deal as long as
-            # there is no statistical correlation b/w the experiment and those
-            # being lost.
-            memcache.set(key, [])
-
-        else:
-
-            memcache.set(key, list_identities)
+        # Append the identity to a write-behind queue in memcache which is
+        # flushed to the datastore when it has grown by FLUSH_EVERY
+        # identities or when the periodic cron job is run. The incr hands
+        # each identity its own slot, so concurrent appends can't clobber
+        # one another, and the add fails if a flush has already passed the
+        # slot by, in which case we take another one.
+        flush = False
+        for _ in xrange(BingoIdentityCache.QUEUE_APPEND_ATTEMPTS):
+            slot = memcache.incr(BingoIdentityCache.QUEUE_TAIL_KEY, initial_value=0)
+
+            if slot is None:
+                # Memcache may be down and returning None for incr. The
+                # identity will be queued again the next time it changes.
+                return
+
+            flush = flush or slot % BingoIdentityCache.FLUSH_EVERY == 0
+            if memcache.add(BingoIdentityCache.QUEUE_SLOT_KEY % slot, ident):
+                break
+
+        if flush:
+            # Go ahead and kick off a deferred task to persist the queue in
+            # case it'll be a while before the cron job runs.
+            deferred.defer(flush_identity_queue, _queue=QUEUE_NAME)
 
     @staticmethod
-    def persist_buckets_to_datastore():
-        # Persist all memcache buckets to datastore
-        dict_buckets = memcache.get_multi(["_gae_bingo_identity_bucket:%s" % bucket for bucket in range(0, 50)])
-
-        for key in dict_buckets:
-            if len(dict_buckets[key]) > 0:
-                deferred.defer(persist_gae_bingo_identity_records, dict_buckets[key], _queue=QUEUE_NAME)
-                memcache.set(key, [])
+    def persist_queue_to_datastore():
+        # Persist the queued identities to the datastore
+        deferred.defer(flush_identity_queue, _queue=QUEUE_NAME)
 
     @staticmethod
     def load_from_datastore():
@@ -431,24 +618,100 @@ def store_if_dirty():
         bingo_identity_cache.store_for_identity_if_dirty(identity())
 
 def persist_gae_bingo_identity_records(list_identities):
+    """ Put the memcached BingoIdentityCache of each identity in the datastore,
+    in batches of BingoIdentityCache.PUT_BATCH_SIZE.
 
+    Returns the number of identities persisted; identities whose cache has
+    been evicted from memcache are skipped.
+    """
     dict_identity_caches = memcache.get_multi([BingoIdentityCache.key_for_identity(ident) for ident in list_identities])
 
+    records = []
     for ident in list_identities:
         identity_cache = dict_identity_caches.get(BingoIdentityCache.key_for_identity(ident))
 
         if identity_cache:
-            bingo_identity = _GAEBingoIdentityRecord(
+            records.append(_GAEBingoIdentityRecord(
                         key_name = _GAEBingoIdentityRecord.key_for_identity(ident),
                         identity = ident,
                         pickled = pickle_util.dump(identity_cache),
-                    )
-            bingo_identity.put()
+                    ))
+
+    batch_size = BingoIdentityCache.PUT_BATCH_SIZE
+    for i in xrange(0, len(records), batch_size):
+        db.put(records[i:i + batch_size])
+
+    return len(records)
+
+def flush_identity_queue():
+    """ Persist every identity in the BingoIdentityCache write-behind queue. """
+    if not memcache.add(BingoIdentityCache.FLUSH_LOCK_KEY, True,
+                        time=BingoIdentityCache.FLUSH_LOCK_SECONDS):
+        # Another flush is running, and will get our identities
+        return
+
+    try:
+        counters = memcache.get_multi([BingoIdentityCache.QUEUE_HEAD_KEY,
+                                       BingoIdentityCache.QUEUE_TAIL_KEY])
+        head = counters.get(BingoIdentityCache.QUEUE_HEAD_KEY)
+        tail = counters.get(BingoIdentityCache.QUEUE_TAIL_KEY) or 0
+
+        if head is None or tail < head:
+            # The head was evicted, or the tail was and restarted from 0.
+            # Anything further back than the window has been flushed or
+            # evicted long ago.
+            head = max(0, tail - BingoIdentityCache.QUEUE_RECOVERY_WINDOW)
+
+        flushed = dropped = 0
+        batch_size = BingoIdentityCache.PUT_BATCH_SIZE
+        for start in xrange(head + 1, tail + 1, batch_size):
+            slot_keys = [BingoIdentityCache.QUEUE_SLOT_KEY % slot
+                         for slot in xrange(start, min(start + batch_size, tail + 1))]
+            dict_slots = memcache.get_multi(slot_keys)
+
+            missing_keys = [key for key in slot_keys if key not in dict_slots]
+            if missing_keys:
+                # Mark empty slots as skipped. Where that fails, an append
+                # has just filled the slot, so read it again; where it
+                # works, an append still on its way will use another slot.
+                not_skipped = memcache.add_multi(
+                        dict((key, BingoIdentityCache.QUEUE_SKIPPED)
+                             for key in missing_keys),
+                        time=BingoIdentityCache.QUEUE_SKIPPED_SECONDS)
+                if not_skipped:
+                    dict_slots.update(memcache.get_multi(not_skipped))
+                dropped += len(missing_keys) - len(not_skipped)
+
+            # Every slot is now either consumed here or marked skipped.
+            # Markers are left to expire so late appends keep failing.
+            consumed = dict((key, ident) for key, ident in dict_slots.iteritems()
+                            if ident != BingoIdentityCache.QUEUE_SKIPPED)
+
+            # The same identity is often queued several times
+            list_identities = list(set(consumed.values()))
+            persisted = persist_gae_bingo_identity_records(list_identities)
+
+            flushed += persisted
+            dropped += len(list_identities) - persisted
+
+            memcache.delete_multi(consumed.keys())
+            memcache.set(BingoIdentityCache.QUEUE_HEAD_KEY,
+                         start + len(slot_keys) - 1)
+
+        if flushed or dropped:
+            memcache.offset_multi({BingoIdentityCache.FLUSHED_COUNT_KEY: flushed,
+                                   BingoIdentityCache.DROPPED_COUNT_KEY: dropped},
+                                  initial_value=0)
+            logging.info("Flushed %s gae_bingo identities, dropped %s" %
+                         (flushed, dropped))
+
+    finally:
+        memcache.delete(BingoIdentityCache.FLUSH_LOCK_KEY)
 
 class PersistToDatastore(RequestHandler):
     def get(self):
         BingoCache.get().persist_to_datastore()
-        BingoIdentityCache.persist_buckets_to_datastore()
+        BingoIdentityCache.persist_queue_to_datastore()
         
 class LogSnapshotToDatastore(RequestHandler):
     def get(self):
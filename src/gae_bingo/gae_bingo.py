@@ -1,10 +1,10 @@
-import hashlib
 import logging
 import time
 import urllib
 
 from google.appengine.api import memcache
 
+from .alternative_selection import SelectionTable
 from .cache import BingoCache, bingo_and_identity_cache
 from .models import create_experiment_and_alternatives, ConversionTypes
 from .identity import identity
@@ -82,11 +82,14 @@ def participate_in_experiments(experiments,
 
         else:
 
-            alternative = _find_alternative_for_user(experiment.hashable_name,
-                                                    alternatives)
+            alternative = _find_alternative_for_user(
+                    experiment.hashable_name,
+                    alternatives,
+                    selection_table=BingoCache.get().get_selection_table(
+                        experiment.name))
 
             if experiment.name not in bingo_identity_cache.participating_tests:
-                if alternative.increment_participants():
+                if alternative.increment_participants(identity()):
                     bingo_identity_cache.participate_in(experiment.name)
 
             # It shouldn't matter which experiment's alternative content
@@ -235,9 +238,11 @@ def score_conversion(experiment_name):
 
     alternative = _find_alternative_for_user(
                       experiment.hashable_name,
-                      bingo_cache.get_alternatives(experiment_name))
+                      bingo_cache.get_alternatives(experiment_name),
+                      selection_table=bingo_cache.get_selection_table(
+                          experiment_name))
 
-    if alternative.increment_conversions():
+    if alternative.increment_conversions(identity()):
         bingo_identity_cache.convert_in(experiment_name)
 
 def choose_alternative(canonical_name, alternative_number):
@@ -261,6 +266,8 @@ def choose_alternative(canonical_name, alternative_number):
                                 alternatives)
 
         if len(alternative_chosen) == 1:
+            # A fresh model, since the cached one is shared between requests
+            experiment = bingo_cache.decode_experiment(experiment.name)
             experiment.live = False
             experiment.set_short_circuit_content(alternative_chosen[0].content)
             bingo_cache.update_experiment(experiment)
@@ -313,6 +320,8 @@ def resume_experiment(canonical_name):
         return
 
     for experiment in experiments:
+        # A fresh model, since the cached one is shared between requests
+        experiment = bingo_cache.decode_experiment(experiment.name)
         experiment.live = True
         bingo_cache.update_experiment(experiment)
 
@@ -352,11 +361,51 @@ def find_alternative_for_user(canonical_name, identity_val):
     return _find_alternative_for_user(
                 experiment.hashable_name,
                 bingo_cache.get_alternatives(experiment_name),
-                identity_val).content
+                identity_val,
+                bingo_cache.get_selection_table(experiment_name)).content
+
+def find_alternatives_for_users(canonical_name, identity_vals):
+    """ Bulk version of find_alternative_for_user: returns a list with the
+    alternative content each of identity_vals belongs to, or None if the
+    experiment doesn't exist.
+
+    Unlike find_alternative_for_user, this ignores the current gae_bingo
+    administrator's alternative override cookie.
+
+    canonical_name -- the canonical name of the experiment
+    identity_vals -- a list of strings or instances of GAEBingoIdentity
+
+    """
+
+    bingo_cache = BingoCache.get()
+    experiment_names = bingo_cache.get_experiment_names_by_canonical_name(
+            canonical_name)
+
+    if not experiment_names:
+        return None
+
+    experiment_name = experiment_names[-1]
+    experiment = bingo_cache.get_experiment(experiment_name)
+
+    if not experiment:
+        return None
+
+    if not experiment.live:
+        # Experiment has ended - everybody gets the result that was selected.
+        return [experiment.short_circuit_content] * len(identity_vals)
+
+    alternatives = bingo_cache.get_alternatives(experiment_name)
+    selection_table = bingo_cache.get_selection_table(experiment_name)
+    contents = [alternative.content for alternative in alternatives]
+
+    return [contents[selection_table.choose(experiment.hashable_name,
+                                            identity(identity_val))]
+            for identity_val in identity_vals]
 
 def _find_alternative_for_user(experiment_hashable_name,
                                alternatives,
-                               identity_val=None):
+                               identity_val=None,
+                               selection_table=None):
 
     if can_control_experiments():
         # If gae_bingo administrator, allow possible override of alternative
@@ -374,23 +423,22 @@ def _find_alternative_for_user(experiment_hashable_name,
 
     return modulo_choose(experiment_hashable_name,
                          alternatives,
-                         identity(identity_val))
-
-def modulo_choose(experiment_hashable_name, alternatives, identity):
-    alternatives_weight = sum(map(lambda alt: alt.weight, alternatives))
+                         identity(identity_val),
+                         selection_table)
 
-    sig = hashlib.md5(experiment_hashable_name + str(identity)).hexdigest()
-    sig_num = int(sig, base=16)
-    index_weight = sig_num % alternatives_weight
+def modulo_choose(experiment_hashable_name, alternatives, identity,
+                  selection_table=None):
+    """ Pick identity's alternative; see alternative_selection.
 
-    current_weight = alternatives_weight
-    for alternative in sorted(alternatives,
-                              key=lambda alt: alt.weight,
-                              reverse=True):
+    selection_table is the SelectionTable for alternatives, such as
+    BingoCache.get_selection_table's. It's built here if not given.
+    """
+    if selection_table is None:
+        selection_table = SelectionTable(
+                [alternative.weight for alternative in alternatives])
 
-        current_weight -= alternative.weight
-        if index_weight >= current_weight:
-            return alternative
+    return alternatives[selection_table.choose(experiment_hashable_name,
+                                               identity)]
 
 def create_redirect_url(destination, conversion_names):
     """ Create a URL that redirects to destination after scoring conversions
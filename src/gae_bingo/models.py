@@ -1,5 +1,7 @@
 import datetime
+import hashlib
 import os
+import random
 
 from google.appengine.ext import db
 from google.appengine.api import memcache
@@ -106,6 +108,13 @@ class _GAEBingoExperiment(db.Model):
             "Conversions (%)"
 
 
+# Each alternative's participant and conversion counts are spread over this
+# many memcache counters, so that concurrent increments on a popular
+# experiment don't all contend for the same key. The counters only hold what
+# has been counted since BingoCache.persist_to_datastore last folded them
+# into the alternative's participants and conversions.
+COUNTER_SHARDS = 16
+
 class _GAEBingoAlternative(db.Model):
     number = db.IntegerProperty()
     experiment_name = db.StringProperty()
@@ -116,6 +125,10 @@ class _GAEBingoAlternative(db.Model):
     archived = db.BooleanProperty(default = False)
     weight = db.IntegerProperty(default = 1)
 
+    # How much of each memcache counter shard participants and conversions
+    # already include, as a pickled dict of "<counter>:<shard>" to count.
+    pickled_persisted_counts = db.BlobProperty()
+
     @staticmethod
     def key_for_experiment_name_and_number(experiment_name, number):
         return "_gae_alternative:%s:%s" % (experiment_name, number)
@@ -138,60 +151,153 @@ class _GAEBingoAlternative(db.Model):
     def pretty_conversion_rate(self):
         return "%4.2f%%" % (self.conversion_rate * 100)
 
+    @property
+    def persisted_counts(self):
+        if self.pickled_persisted_counts:
+            return pickle_util.load(self.pickled_persisted_counts)
+        else:
+            return {}
+
+    def set_persisted_counts(self, value):
+        self.pickled_persisted_counts = pickle_util.dump(value)
+
     def key_for_self(self):
         return _GAEBingoAlternative.key_for_experiment_name_and_number(self.experiment_name, self.number)
 
-    def increment_participants(self):
-        """ Increment a memcache.incr-backed counter to keep track of participants in a scalable fashion.
-        
-        It's possible that the cached _GAEBingoAlternative entities will fall a bit behind
-        due to concurrency issues, but the memcache.incr'd version should stay up-to-date and
-        be persisted.
+    def counter_keys(self, counter):
+        """ Memcache keys of all shards of the "participants" or "conversions"
+        counter.
+        """
+        return ["%s:%s:%s" % (self.key_for_self(), counter, shard) for shard in xrange(COUNTER_SHARDS)]
+
+    def _counter_key(self, counter, shard_key):
+        if shard_key is None:
+            shard = random.randrange(COUNTER_SHARDS)
+        else:
+            shard = int(hashlib.md5(str(shard_key)).hexdigest()[:8], 16) % COUNTER_SHARDS
+        return "%s:%s:%s" % (self.key_for_self(), counter, shard)
+
+    def _increment(self, counter, shard_key):
+        count = memcache.incr(self._counter_key(counter, shard_key), initial_value=0)
+
+        # Memcache may be down and returning None for incr.
+        return count is not None
+
+    def increment_participants(self, shard_key=None):
+        """ Increment a sharded memcache.incr-backed counter to keep track of participants in a scalable fashion.
+
+        shard_key, usually the participant's bingo identity, picks the shard
+        to increment; a random one is used if it's not given. The count is
+        included by latest_participants_count until it's persisted.
 
         Returns:
             True if participants was successfully incremented, False otherwise."
         """
-        participants = memcache.incr("%s:participants" % self.key_for_self(), initial_value=self.participants)
-
-        if participants is None:
-            # Memcache may be down and returning None for incr. Don't update the model in this case.
-            return False
+        return self._increment("participants", shard_key)
 
-        self.participants = participants
-        return True
+    def increment_conversions(self, shard_key=None):
+        """ Increment a sharded memcache.incr-backed counter to keep track of conversions in a scalable fashion.
 
-    def increment_conversions(self):
-        """ Increment a memcache.incr-backed counter to keep track of conversions in a scalable fashion.
-
-        It's possible that the cached _GAEBingoAlternative entities will fall a bit behind
-        due to concurrency issues, but the memcache.incr'd version should stay up-to-date and
-        be persisted.
+        See increment_participants.
 
         Returns:
             True if conversions was successfully incremented, False otherwise.
         """
-        conversions = memcache.incr("%s:conversions" % self.key_for_self(), initial_value=self.conversions)
+        return self._increment("conversions", shard_key)
+
+    def legacy_counter_keys(self):
+        """ Memcache keys of the unsharded absolute counters used before
+        COUNTER_SHARDS, which BingoCache.persist_to_datastore folds in and
+        deletes.
+        """
+        return ["%s:participants" % self.key_for_self(), "%s:conversions" % self.key_for_self()]
 
-        if conversions is None:
-            # Memcache may be down and returning None for incr. Don't update the model in this case.
-            return False
+    def unpersisted_counts(self):
+        """ The counts in each memcache shard and legacy counter, from one
+        get_multi.
 
-        self.conversions = conversions
-        return True
+        Returns a dict of memcache key to count, for counters with a count.
+        """
+        counts = memcache.get_multi(self.counter_keys("participants") + self.counter_keys("conversions") +
+                                    self.legacy_counter_keys())
+        return dict((key, long(value)) for key, value in counts.iteritems() if value)
 
     def latest_participants_count(self):
-        return max(self.participants, long(memcache.get("%s:participants" % self.key_for_self()) or 0))
+        return self.latest_counts()[0]
 
     def latest_conversions_count(self):
-        return max(self.conversions, long(memcache.get("%s:conversions" % self.key_for_self()) or 0))
+        return self.latest_counts()[1]
+
+    def latest_counts(self):
+        """ (participants, conversions), including unpersisted counts. """
+        return self._add_counts(self.unpersisted_counts())[:2]
+
+    def _add_counts(self, counts):
+        """ Add what the shards in counts have counted since they were
+        persisted to participants and conversions.
+
+        Returns (participants, conversions, shard counts) where the shard
+        counts are the new persisted_counts to go with those totals.
+        """
+        # Legacy counters held absolute counts, including the persisted ones
+        legacy_participants, legacy_conversions = self.legacy_counter_keys()
+        participants = max(self.participants, counts.get(legacy_participants, 0))
+        conversions = max(self.conversions, counts.get(legacy_conversions, 0))
+
+        persisted_counts = self.persisted_counts
+        shard_counts = {}
+        prefix = "%s:" % self.key_for_self()
+        for key in self.counter_keys("participants") + self.counter_keys("conversions"):
+            shard = key[len(prefix):]
+            count = counts.get(key, 0)
+            new_count = count - persisted_counts.get(shard, 0)
+            if new_count < 0:
+                # The shard was evicted and started over since it was
+                # persisted, so all it has counted is new
+                new_count = count
+            if shard.startswith("participants:"):
+                participants += new_count
+            else:
+                conversions += new_count
+            if count:
+                shard_counts[shard] = count
+        return participants, conversions, shard_counts
 
     def reset_counts(self):
-        memcache.delete_multi(["%s:participants" % self.key_for_self(), "%s:conversions" % self.key_for_self()])
+        memcache.delete_multi(self.counter_keys("participants") + self.counter_keys("conversions") +
+                              self.legacy_counter_keys())
 
     def load_latest_counts(self):
-        # When persisting to datastore, we want to store the most recent value we've got
-        self.participants = self.latest_participants_count()
-        self.conversions = self.latest_conversions_count()
+        """ Fold the shards' unpersisted counts into participants and
+        conversions.
+
+        The shards only ever go up; persisted_counts is updated along with
+        the totals to record how much of each shard they now include, so
+        whichever copy of this alternative is stored next, its totals and
+        persisted_counts agree and nothing is counted twice or lost.
+        """
+        # When displaying, we want the most recent value we've got
+        self.participants, self.conversions, shard_counts = self._add_counts(self.unpersisted_counts())
+        self.set_persisted_counts(shard_counts)
+
+
+def fold_unpersisted_counts(alternatives):
+    """ Fold the memcache shards into the stored counts of alternatives, all
+    of one experiment, and put them.
+
+    The counts are folded into the datastore's copies (which may be newer
+    than the given models), so this must run in a transaction. The models'
+    other properties are stored as they are. Legacy counters are left for
+    the caller to delete once the transaction has committed.
+    """
+    stored_alternatives = db.get([alternative.key() for alternative in alternatives])
+    for alternative, stored in zip(alternatives, stored_alternatives):
+        if stored:
+            alternative.participants = stored.participants
+            alternative.conversions = stored.conversions
+            alternative.pickled_persisted_counts = stored.pickled_persisted_counts
+        alternative.load_latest_counts()
+    db.put(alternatives)
 
 
 class _GAEBingoSnapshotLog(db.Model):
@@ -201,6 +307,52 @@ class _GAEBingoSnapshotLog(db.Model):
     time_recorded = db.DateTimeProperty(auto_now_add = True)
 
 
+class _GAEBingoSnapshotRollup(db.Model):
+    """The last snapshot of an alternative logged in an hour or a day.
+
+    Snapshot counts are cumulative, so the last one logged in a period
+    stands for the whole period. Rollups are children of the experiment,
+    keyed by resolution, period and alternative number, so each snapshot
+    simply overwrites its period's rollups.
+    """
+    HOURLY = "hour"
+    DAILY = "day"
+
+    resolution = db.StringProperty()
+    period_start = db.DateTimeProperty()
+    alternative_number = db.IntegerProperty()
+    conversions = db.IntegerProperty(default = 0)
+    participants = db.IntegerProperty(default = 0)
+    time_recorded = db.DateTimeProperty()
+
+    @staticmethod
+    def period_start_for(resolution, time_recorded):
+        if resolution == _GAEBingoSnapshotRollup.DAILY:
+            return datetime.datetime(time_recorded.year, time_recorded.month,
+                                     time_recorded.day)
+        return time_recorded.replace(minute=0, second=0, microsecond=0)
+
+    @staticmethod
+    def key_name_for(resolution, period_start, alternative_number):
+        return "%s:%s:%s" % (resolution, period_start.strftime("%Y%m%d%H"),
+                             alternative_number)
+
+    @staticmethod
+    def from_snapshot_log(experiment, resolution, log_entry):
+        period_start = _GAEBingoSnapshotRollup.period_start_for(
+                resolution, log_entry.time_recorded)
+        return _GAEBingoSnapshotRollup(
+                key_name = _GAEBingoSnapshotRollup.key_name_for(
+                    resolution, period_start, log_entry.alternative_number),
+                parent = experiment,
+                resolution = resolution,
+                period_start = period_start,
+                alternative_number = log_entry.alternative_number,
+                conversions = log_entry.conversions,
+                participants = log_entry.participants,
+                time_recorded = log_entry.time_recorded)
+
+
 class _GAEBingoExperimentNotes(db.Model):
     """Notes and list of emotions associated w/ results of an experiment."""
 
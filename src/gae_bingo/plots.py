@@ -1,35 +1,148 @@
+import datetime
 import logging
 import os
 import time
 
+from google.appengine.api import memcache
 from google.appengine.ext.webapp import RequestHandler
 
-from .cache import BingoCache
-from .models import _GAEBingoSnapshotLog, ConversionTypes
+from .cache import BingoCache, timeline_version_key
+from .models import _GAEBingoSnapshotLog, _GAEBingoSnapshotRollup
+from .models import ConversionTypes
+from . import stats
 
-def get_experiment_timeline_data(experiment):
+# Posterior samples per snapshot for the stats timeline. Fewer than
+# stats.analyze's default, since there's a snapshot per hour of experiment.
+SNAPSHOT_POSTERIOR_SAMPLES = 5000
 
-    bingo_cache = BingoCache.get()
-        
+# Timelines show a point per hour for this many recent days, and a point per
+# day before that.
+HOURLY_TIMELINE_DAYS = 7
+
+# Cached timelines are replaced whenever a snapshot is logged anyway, this
+# just stops finished experiments' timelines from hanging around.
+TIMELINE_CACHE_SECONDS = 24 * 60 * 60
+
+def fetch_snapshot_logs(experiment, before=None):
+    """experiment's 1000 most recent raw snapshot logs, or those recorded
+    before the datetime before.
+    """
     query = _GAEBingoSnapshotLog.all().ancestor(experiment)
+    if before is not None:
+        query.filter("time_recorded <", before)
     query.order('-time_recorded')
-    experiment_snapshots = query.fetch(1000)
-    
+    return query.fetch(1000)
+
+def fetch_timeline_snapshots(experiment):
+    """The snapshots to plot for experiment, oldest first: its daily rollups,
+    then its hourly rollups for the last HOURLY_TIMELINE_DAYS days.
+
+    Experiments without rollups, which stopped before rollups were logged,
+    get their most recent raw snapshot logs instead. Experiments that were
+    live when rollups started being logged also get the raw snapshot logs
+    from before their first rollup, condensed to the same periods.
+    """
+    query = _GAEBingoSnapshotRollup.all().ancestor(experiment)
+    query.filter("resolution =", _GAEBingoSnapshotRollup.DAILY)
+    daily = list(query.run(batch_size=1000))
+
+    if not daily:
+        return sorted(fetch_snapshot_logs(experiment),
+                      key=lambda log: log.time_recorded)
+
+    latest = max(rollup.time_recorded for rollup in daily)
+    hourly_start = _GAEBingoSnapshotRollup.period_start_for(
+            _GAEBingoSnapshotRollup.DAILY,
+            latest - datetime.timedelta(days=HOURLY_TIMELINE_DAYS))
+    alternative_numbers = sorted(set(rollup.alternative_number
+                                     for rollup in daily))
+
+    # Hourly rollups have predictable keys, so get them rather than query
+    key_names = []
+    hour = hourly_start
+    while hour <= latest:
+        key_names += [_GAEBingoSnapshotRollup.key_name_for(
+                          _GAEBingoSnapshotRollup.HOURLY, hour, number)
+                      for number in alternative_numbers]
+        hour += datetime.timedelta(hours=1)
+    hourly = _GAEBingoSnapshotRollup.get_by_key_name(key_names,
+                                                     parent=experiment)
+
+    snapshots = [rollup for rollup in daily
+                 if rollup.period_start < hourly_start]
+    snapshots += [rollup for rollup in hourly if rollup]
+
+    first = min(rollup.time_recorded for rollup in daily)
+    snapshots += _rollups_from_logs(
+            experiment, fetch_snapshot_logs(experiment, before=first),
+            hourly_start, snapshots)
+
+    return sorted(snapshots, key=lambda rollup: rollup.time_recorded)
+
+def _rollups_from_logs(experiment, logs, hourly_start, rollups):
+    """Unsaved rollups of snapshot logs, daily before hourly_start and hourly
+    after, for the periods that rollups doesn't already cover.
+    """
+    def period(rollup):
+        return (rollup.resolution, rollup.period_start,
+                rollup.alternative_number)
+
+    covered = set(period(rollup) for rollup in rollups)
+    latest = {}
+    for log in logs:
+        resolution = (_GAEBingoSnapshotRollup.HOURLY
+                      if log.time_recorded >= hourly_start
+                      else _GAEBingoSnapshotRollup.DAILY)
+        rollup = _GAEBingoSnapshotRollup.from_snapshot_log(
+                experiment, resolution, log)
+        key = period(rollup)
+        if key in covered:
+            continue
+        # The last log in a period stands for it, as with logged rollups
+        if key not in latest or latest[key].time_recorded < log.time_recorded:
+            latest[key] = rollup
+
+    return latest.values()
+
+def _get_cached_timeline(experiment, name, compute):
+    """compute(), cached in memcache until experiment's next snapshot."""
+    version_key = timeline_version_key(experiment)
+    version = memcache.get(version_key)
+    if version is None:
+        memcache.add(version_key, long(time.time() * 1000))
+        version = memcache.get(version_key)
+
+    cache_key = "_gae_bingo_%s:%s:%s" % (name, experiment.key().name(),
+                                         version)
+    timeline = memcache.get(cache_key)
+    if timeline is None:
+        timeline = compute()
+        memcache.set(cache_key, timeline, time=TIMELINE_CACHE_SECONDS)
+    return timeline
+
+def get_experiment_timeline_data(experiment):
+    return _get_cached_timeline(experiment, "timeline",
+            lambda: _experiment_timeline_data(
+                experiment, fetch_timeline_snapshots(experiment)))
+
+def _experiment_timeline_data(experiment, experiment_snapshots):
+
+    bingo_cache = BingoCache.get()
+
     experiment_data_map = {}
     experiment_data = []
     y_scale_multiplier = 1.0 if experiment.conversion_type == ConversionTypes.Counting else 100.0
-    
-    def get_alternative_content_str(alt_num):
-        alts = bingo_cache.get_alternatives(experiment.name)
-        for alt in alts:
-            if alt.number == alt_num:
-                return str(alt.content)
-        return "Alternative #" + str(alt_num) 
+
+    alternative_content_strs = dict(
+            (alt.number, str(alt.content))
+            for alt in bingo_cache.get_alternatives(experiment.name))
     
     for snapshot in experiment_snapshots:
 
         if snapshot.alternative_number not in experiment_data_map:
-            alternative_content_str = get_alternative_content_str(snapshot.alternative_number)
+            alternative_content_str = alternative_content_strs.get(
+                    snapshot.alternative_number,
+                    "Alternative #" + str(snapshot.alternative_number))
             experiment_data.append({ "name": alternative_content_str, "data": [] })
             experiment_data_map[snapshot.alternative_number] = experiment_data[-1]
 
@@ -43,3 +156,65 @@ def get_experiment_timeline_data(experiment):
         experiment_data_map[snapshot.alternative_number]["data"].append([utc_time, conv_rate])
 
     return experiment_data
+
+def group_snapshots(snapshot_logs):
+    """Group snapshot logs into the snapshots they were logged in, oldest
+    first, as lists of logs ordered by alternative number.
+
+    BingoCache.log_experiment_snapshot logs every alternative at once, so a
+    new snapshot starts whenever an alternative shows up again.
+    """
+    snapshots = []
+    numbers_seen = set()
+    for log in sorted(snapshot_logs, key=lambda log: log.time_recorded):
+        if not snapshots or log.alternative_number in numbers_seen:
+            snapshots.append([])
+            numbers_seen = set()
+        snapshots[-1].append(log)
+        numbers_seen.add(log.alternative_number)
+
+    for snapshot in snapshots:
+        snapshot.sort(key=lambda log: log.alternative_number)
+    return snapshots
+
+def _snapshot_stats_key(experiment, utc_time):
+    return "_gae_bingo_snapshot_stats:%s:%d" % (experiment.key().name(),
+                                                utc_time)
+
+def get_experiment_stats_timeline(experiment):
+    """stats.analyze of every snapshot in experiment's timeline, oldest
+    first, each with the snapshot's "time" and "alternative_numbers" added.
+
+    Snapshots never change once logged, so their results are cached in
+    memcache and only snapshots logged since the last call are analyzed.
+    """
+    return _get_cached_timeline(experiment, "stats_timeline",
+            lambda: _experiment_stats_timeline(
+                experiment, fetch_timeline_snapshots(experiment)))
+
+def _experiment_stats_timeline(experiment, experiment_snapshots):
+    snapshots = []
+    for logs in group_snapshots(experiment_snapshots):
+        utc_time = time.mktime(logs[0].time_recorded.timetuple()) * 1000
+        snapshots.append((_snapshot_stats_key(experiment, utc_time),
+                          utc_time, logs))
+
+    cached = memcache.get_multi([key for key, _, _ in snapshots])
+
+    timeline = []
+    new_results = {}
+    for key, utc_time, logs in snapshots:
+        results = cached.get(key)
+        if results is None:
+            results = stats.analyze(logs, experiment.conversion_type,
+                                    num_samples=SNAPSHOT_POSTERIOR_SAMPLES)
+            results["time"] = utc_time
+            results["alternative_numbers"] = [log.alternative_number
+                                              for log in logs]
+            new_results[key] = results
+        timeline.append(results)
+
+    if new_results:
+        memcache.set_multi(new_results)
+
+    return timeline
@@ -1,6 +1,24 @@
 import logging
+import math
 
-# This file in particular is almost a direct port from Patrick McKenzie's A/Bingo's abingo/lib/abingo/statistics.rb
+try:
+    import numpy
+except ImportError:
+    logging.warning("numpy is not available, so gae_bingo can't compute "
+                    "the probability each alternative is best.")
+    numpy = None
+
+# zscore was originally a direct port from Patrick McKenzie's A/Bingo's abingo/lib/abingo/statistics.rb
+#
+# analyze() handles any number of alternatives, and both conversion types:
+#
+#   - A chi-square test of whether the alternatives differ at all, with an
+#     exact p-value. Binary conversions are compared as a 2 x k contingency
+#     table of converted / not converted participants; counting conversions
+#     as Poisson rates, conversions per participant.
+#   - The posterior probability that each alternative is the best, estimated
+#     by Monte Carlo from Beta (binary) or Gamma (counting) posteriors with
+#     uniform priors.
 
 HANDY_Z_SCORE_CHEATSHEET = [[0.10, 1.29], [0.05, 1.65], [0.01, 2.33], [0.001, 3.08]]
 
@@ -36,35 +54,184 @@ def zscore(alternatives):
 
     return numerator / float((frac1 + frac2) ** 0.5)
 
-def p_value(alternatives):
+def p_value(alternatives, conversion_type="binary"):
+    """The exact p-value of the chi-square test that the alternatives differ."""
+    return analyze(alternatives, conversion_type, num_samples=0)["p_value"]
+
+def is_statistically_significant(alternatives, p = 0.05,
+                                 conversion_type="binary"):
+    p_val = p_value(alternatives, conversion_type)
+    return p_val is not None and p_val <= p
+
+# Posterior samples drawn by analyze() to estimate win probabilities
+NUM_POSTERIOR_SAMPLES = 20000
+
+def analyze(alternatives, conversion_type="binary",
+            num_samples=NUM_POSTERIOR_SAMPLES):
+    """Statistics for alternatives, anything with participants and
+    conversions (such as _GAEBingoAlternatives or _GAEBingoSnapshotLogs).
+
+    Returns a dict with
+        chi_square, degrees_of_freedom, p_value: the test that the
+            alternatives' conversion rates differ. p_value is None if it
+            can't be computed yet (fewer than two alternatives with
+            participants, or no conversions at all).
+        win_probabilities: the probability each alternative has the highest
+            true conversion rate, in order, or None if numpy isn't available
+            or num_samples is 0.
+    """
+    participants = [float(alternative.participants)
+                    for alternative in alternatives]
+    conversions = [float(alternative.conversions)
+                   for alternative in alternatives]
+
+    if conversion_type == "counting":
+        chi_square, df = _poisson_chi_square(participants, conversions)
+    else:
+        chi_square, df = _contingency_chi_square(participants, conversions)
+
+    p = None
+    if df > 0:
+        p = chi_square_survival(chi_square, df)
+
+    win_probabilities = None
+    if numpy is not None and num_samples > 0 and alternatives:
+        win_probabilities = _win_probabilities(
+                participants, conversions, conversion_type, num_samples)
+
+    return {
+            "chi_square": chi_square,
+            "degrees_of_freedom": df,
+            "p_value": p,
+            "win_probabilities": win_probabilities,
+        }
 
-    index = 0
-    z = zscore(alternatives)
-    z = abs(z)
+def _contingency_chi_square(participants, conversions):
+    """Pearson's chi-square for converted vs. not converted participants."""
+    rows = [(c, n - c) for n, c in zip(participants, conversions) if n > 0]
+    total = sum(n for n in participants if n > 0)
+    column_totals = [sum(row[j] for row in rows) for j in (0, 1)]
 
-    found_p = None
-    while index < len(HANDY_Z_SCORE_CHEATSHEET):
-        if z > HANDY_Z_SCORE_CHEATSHEET[index][1]:
-            found_p = HANDY_Z_SCORE_CHEATSHEET[index][0]
-        index += 1
+    if len(rows) < 2 or not all(column_totals):
+        return 0.0, 0
 
-    return found_p
+    chi_square = 0.0
+    for row in rows:
+        row_total = sum(row)
+        for observed, column_total in zip(row, column_totals):
+            expected = row_total * column_total / total
+            chi_square += (observed - expected) ** 2 / expected
 
-def is_statistically_significant(p = 0.05):
-    return p_value <= p
+    return chi_square, len(rows) - 1
 
-def describe_result_in_words(alternatives):
+def _poisson_chi_square(participants, conversions):
+    """Chi-square for conversion counts vs. those expected if every
+    alternative had the pooled rate of conversions per participant.
+    """
+    pairs = [(n, c) for n, c in zip(participants, conversions) if n > 0]
+    total_participants = sum(n for n, c in pairs)
+    total_conversions = sum(c for n, c in pairs)
 
-    try:
-        z = zscore(alternatives)
-    except Exception, e:
-        return str(e)
+    if len(pairs) < 2 or not total_conversions:
+        return 0.0, 0
 
-    p = p_value(alternatives)
+    chi_square = 0.0
+    for n, c in pairs:
+        expected = total_conversions * n / total_participants
+        chi_square += (c - expected) ** 2 / expected
+
+    return chi_square, len(pairs) - 1
+
+def _win_probabilities(participants, conversions, conversion_type,
+                       num_samples):
+    # Seeded, so the same counts always get the same answer
+    random_state = numpy.random.RandomState(0)
+    participants = numpy.array(participants)
+    conversions = numpy.array(conversions)
+    size = (num_samples, len(participants))
+
+    if conversion_type == "counting":
+        # Gamma(1 + conversions, rate 1 + participants) posterior rates
+        samples = random_state.gamma(1. + conversions,
+                                     1. / (1. + participants), size=size)
+    else:
+        # Beta(1 + conversions, 1 + non-conversions) posterior rates
+        conversions = numpy.minimum(conversions, participants)
+        samples = random_state.beta(1. + conversions,
+                                    1. + participants - conversions,
+                                    size=size)
+
+    winners = numpy.bincount(samples.argmax(axis=1),
+                             minlength=len(participants))
+    return (winners / float(num_samples)).tolist()
+
+def chi_square_survival(chi_square, df):
+    """P(X >= chi_square) for X chi-square distributed with df degrees of
+    freedom: the regularized upper incomplete gamma function Q(df/2, x/2).
+    """
+    return _upper_incomplete_gamma(df / 2.0, chi_square / 2.0)
+
+def _upper_incomplete_gamma(a, x, eps=1e-14, max_iterations=1000):
+    # Following Numerical Recipes' gammq: a series for x < a + 1,
+    # otherwise a continued fraction.
+    if x <= 0:
+        return 1.0
+
+    log_prefactor = -x + a * math.log(x) - math.lgamma(a)
+
+    if x < a + 1:
+        term = total = 1.0 / a
+        ap = a
+        for _ in xrange(max_iterations):
+            ap += 1
+            term *= x / ap
+            total += term
+            if abs(term) < abs(total) * eps:
+                break
+        return max(0.0, 1.0 - total * math.exp(log_prefactor))
+
+    tiny = 1e-300
+    b = x + 1.0 - a
+    c = 1.0 / tiny
+    d = 1.0 / b
+    h = d
+    for i in xrange(1, max_iterations):
+        an = -i * (i - a)
+        b += 2.0
+        d = an * d + b
+        if abs(d) < tiny:
+            d = tiny
+        c = b + an / c
+        if abs(c) < tiny:
+            c = tiny
+        d = 1.0 / d
+        delta = d * c
+        h *= delta
+        if abs(delta - 1.0) < eps:
+            break
+    return math.exp(log_prefactor) * h
+
+def _description_threshold(p):
+    """The smallest of our confidence thresholds that p is within."""
+    for threshold, _ in reversed(HANDY_Z_SCORE_CHEATSHEET):
+        if p <= threshold:
+            return threshold
+    return None
+
+def describe_result_in_words(alternatives, conversion_type="binary"):
+
+    if len(alternatives) < 2:
+        return "Need at least two alternatives to compare."
+
+    if sum(1 for alternative in alternatives if alternative.participants) < 2:
+        return "Can't compare the alternatives until at least two of them have participants."
+
+    results = analyze(alternatives, conversion_type)
+    p = results["p_value"]
 
     words = ""
 
-    if alternatives[0].participants < 10 or alternatives[1].participants < 10:
+    if min(alternative.participants for alternative in alternatives) < 10:
         words += "Take these results with a grain of salt since your samples are so small: "
 
     best_alternative = max(alternatives, key=lambda alternative: alternative.conversion_rate)
@@ -72,7 +239,7 @@ def describe_result_in_words(alternatives):
 
     words += """The best alternative you have is:[%(best_alternative_content)s], which had 
     %(best_alternative_conversions)s conversions from %(best_alternative_participants)s participants 
-    (%(best_alternative_pretty_conversion_rate)s).  The other alternative was [%(worst_alternative_content)s], 
+    (%(best_alternative_pretty_conversion_rate)s).  The worst alternative was [%(worst_alternative_content)s], 
     which had %(worst_alternative_conversions)s conversions from %(worst_alternative_participants)s participants 
     (%(worst_alternative_pretty_conversion_rate)s).  """ % {
                 "best_alternative_content": best_alternative.content,
@@ -85,17 +252,29 @@ def describe_result_in_words(alternatives):
                 "worst_alternative_pretty_conversion_rate": worst_alternative.pretty_conversion_rate,
             }
 
-    if p is None:
-        words += "However, this difference is not statistically significant."
+    threshold = _description_threshold(p) if p is not None else None
+
+    if threshold is None:
+        words += "However, this difference is not statistically significant"
+        if p is not None:
+            words += " (p = %.3g)" % p
+        words += ".  "
     else:
-        words += """This difference is %(percentage_likelihood)s likely to be statistically significant, which means you can be 
+        words += """This difference is %(percentage_likelihood)s likely to be statistically significant (p = %(p).3g), which means you can be 
         %(description)s that it is the result of your alternatives actually mattering, rather than 
         being due to random chance.  However, this statistical test can't measure how likely the currently 
         observed magnitude of the difference is to be accurate or not.  It only says "better," not "better 
-        by so much.\"""" % {
-                    "percentage_likelihood": PERCENTAGES[p],
-                    "description": DESCRIPTION_IN_WORDS[p],
+        by so much."  """ % {
+                    "percentage_likelihood": PERCENTAGES[threshold],
+                    "description": DESCRIPTION_IN_WORDS[threshold],
+                    "p": p,
                 }
 
-    return words
+    if results["win_probabilities"] is not None:
+        best_index = max(range(len(alternatives)),
+                         key=lambda i: results["win_probabilities"][i])
+        words += "There is a %.1f%% chance that [%s] is truly the best alternative." % (
+                results["win_probabilities"][best_index] * 100,
+                alternatives[best_index].content)
 
+    return words.strip()
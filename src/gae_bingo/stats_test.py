@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+import math
+import unittest
+
+import stats
+
+
+def normal_two_sided_p(z):
+    """P(|Z| >= |z|) for a standard normal Z."""
+    return math.erfc(abs(z) / math.sqrt(2.0))
+
+
+class Alternative(object):
+    """Stand-in for models._GAEBingoAlternative."""
+    def __init__(self, content, participants, conversions):
+        self.content = content
+        self.participants = participants
+        self.conversions = conversions
+
+    @property
+    def conversion_rate(self):
+        if self.participants > 0:
+            return float(self.conversions) / float(self.participants)
+        return 0
+
+    @property
+    def pretty_conversion_rate(self):
+        return "%4.2f%%" % (self.conversion_rate * 100)
+
+
+class DistributionTest(unittest.TestCase):
+    def test_chi_square_survival(self):
+        # Critical values from the tables, and scipy.stats.chi2.sf
+        self.assertAlmostEqual(0.05, stats.chi_square_survival(3.841459, 1))
+        self.assertAlmostEqual(0.05, stats.chi_square_survival(5.991465, 2))
+        self.assertAlmostEqual(0.01, stats.chi_square_survival(11.344867, 3))
+        self.assertAlmostEqual(0.9188914116546758,
+                               stats.chi_square_survival(0.5, 3))
+        self.assertAlmostEqual(1.694474393006737e-05,
+                               stats.chi_square_survival(40, 10), places=15)
+        self.assertEqual(1.0, stats.chi_square_survival(0, 4))
+
+    def test_one_degree_of_freedom_is_normal(self):
+        # With one degree of freedom, chi-square is z squared
+        self.assertAlmostEqual(normal_two_sided_p(2.5),
+                               stats.chi_square_survival(6.25, 1))
+
+
+class AnalyzeTest(unittest.TestCase):
+    def test_two_alternatives_match_zscore(self):
+        # Pearson's chi-square on a 2 x 2 table is the pooled z test squared
+        alternatives = [Alternative("a", 1000, 100), Alternative("b", 1000, 130)]
+        results = stats.analyze(alternatives)
+        pooled = 230 / 2000.
+        z = (0.13 - 0.10) / (pooled * (1 - pooled) * 2 / 1000.) ** 0.5
+        self.assertAlmostEqual(z ** 2, results["chi_square"])
+        self.assertEqual(1, results["degrees_of_freedom"])
+        self.assertAlmostEqual(normal_two_sided_p(z),
+                               results["p_value"])
+
+    def test_many_alternatives(self):
+        alternatives = [Alternative("a", 500, 50), Alternative("b", 500, 52),
+                        Alternative("c", 500, 90)]
+        results = stats.analyze(alternatives)
+        self.assertEqual(2, results["degrees_of_freedom"])
+        self.assertTrue(results["p_value"] < 0.001)
+        win = results["win_probabilities"]
+        self.assertAlmostEqual(1.0, sum(win))
+        self.assertTrue(win[2] > 0.99)
+
+    def test_counting(self):
+        alternatives = [Alternative("a", 100, 300), Alternative("b", 100, 330)]
+        results = stats.analyze(alternatives, "counting")
+        # (300 - 315)^2 / 315 + (330 - 315)^2 / 315
+        self.assertAlmostEqual(450 / 315., results["chi_square"])
+        self.assertTrue(results["win_probabilities"][1] > 0.8)
+
+    def test_no_test_without_data(self):
+        self.assertEqual(None, stats.p_value([Alternative("a", 10, 0),
+                                              Alternative("b", 10, 0)]))
+        self.assertEqual(None, stats.p_value([Alternative("a", 10, 3),
+                                              Alternative("b", 0, 0)]))
+        self.assertFalse(stats.is_statistically_significant(
+            [Alternative("a", 0, 0), Alternative("b", 0, 0)]))
+
+    def test_win_probabilities_are_repeatable(self):
+        alternatives = [Alternative("a", 40, 10), Alternative("b", 40, 12)]
+        self.assertEqual(stats.analyze(alternatives)["win_probabilities"],
+                         stats.analyze(alternatives)["win_probabilities"])
+
+
+class DescribeTest(unittest.TestCase):
+    def test_significant(self):
+        words = stats.describe_result_in_words(
+            [Alternative("a", 500, 50), Alternative("b", 500, 52),
+             Alternative("c", 500, 90)])
+        self.assertTrue("99.9% likely" in words)
+        self.assertTrue("[c] is truly the best" in words)
+
+    def test_not_significant(self):
+        words = stats.describe_result_in_words(
+            [Alternative("a", 50, 5), Alternative("b", 50, 6)])
+        self.assertTrue("not statistically significant (p = " in words)
+
+    def test_no_participants(self):
+        words = stats.describe_result_in_words(
+            [Alternative("a", 0, 0), Alternative("b", 50, 6)])
+        self.assertTrue(words.startswith("Can't compare"))
+
+
+if __name__ == '__main__':
+    unittest.main()
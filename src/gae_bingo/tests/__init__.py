@@ -188,7 +188,7 @@ class RunStep(RequestHandler):
 
     def persist(self):
         BingoCache.get().persist_to_datastore()
-        BingoIdentityCache.persist_buckets_to_datastore()
+        BingoIdentityCache.persist_queue_to_datastore()
         return True
 
     def flush_hippo_counts_memcache(self):
@@ -196,13 +196,13 @@ class RunStep(RequestHandler):
 
         for alternatives in alternative_lists:
             for alternative in alternatives:
-                memcache.delete("%s:conversions" % alternative.key_for_self())
-                memcache.delete("%s:participants" % alternative.key_for_self())
+                alternative.reset_counts()
 
         return True
 
     def flush_bingo_memcache(self):
-        memcache.delete(BingoCache.MEMCACHE_KEY)
+        memcache.delete_multi([BingoCache.MEMCACHE_KEY,
+                               BingoCache.GENERATION_KEY])
         return True
 
     def flush_all_memcache(self):
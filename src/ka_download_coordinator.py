@@ -1,5 +1,6 @@
 """Library to monitor and coordinate the loading of datastore entities from GAE.
 The record_progress() function records the GAE download progress.
+The get_progress() function reads back the recorded status of a download task.
 The get_failed_jobs() function gets the failed download tasks for reprocessing.
 """
 import datetime as dt
@@ -18,22 +19,49 @@ class DownloadStatus:
 
 
 def get_failed_jobs(mongo, config):
-    """Get gae download tasks with status != SUCCESS."""
+    """Get gae download tasks with status != SUCCESS.
+
+    The shards of sharded downloads aren't jobs of their own (the sharded
+    download resumes them itself), so they're left out.
+    """
     def _get_failed_jobs(mongo, config):
         mongo_db = mongo[config['control_db']]
         mongo_collection = mongo_db['ProgressLogs']
-        query = {"status": {"$lt": DownloadStatus.SUCCESS}}
+        query = {"status": {"$lt": DownloadStatus.SUCCESS},
+                 "shard": {"$ne": True}}
         return mongo_collection.find(query)
     func = db_decorator(5, _get_failed_jobs)
     return func(mongo, config)
 
 
-def get_key(kind, start_dt, end_dt):
+def get_key(kind, start_dt, end_dt, shard=False):
     key = "%s%s%s" % (kind, start_dt, end_dt)
+    if shard:
+        # Don't collide with a whole-range job over the same range
+        key = "shard" + key
     return re.sub(r'[^a-zA-Z0-9]', '', key)
 
 
-def record_progress(mongo, config, kind, start_dt, end_dt, status):
+def get_progress(mongo, config, kind, start_dt, end_dt, shard=False):
+    """Return the DownloadStatus of a given (entity, time-range) block.
+
+    Returns DownloadStatus.NONE if the block has never been recorded.
+    shard says whether the block is a shard of a sharded download.
+    """
+    def _get_progress(mongo, config, kind, start_dt, end_dt):
+        key = get_key(kind, start_dt, end_dt, shard)
+        mongo_db = mongo[config['control_db']]
+        mongo_collection = mongo_db['ProgressLogs']
+        db_doc = mongo_collection.find_one(key)
+        if not db_doc:
+            return DownloadStatus.NONE
+        return db_doc['status']
+    func = db_decorator(max_tries=5, func=_get_progress)
+    return func(mongo, config, kind, start_dt, end_dt)
+
+
+def record_progress(mongo, config, kind, start_dt, end_dt, status,
+                    shard=False):
     """Mark the downloading status of a given (entity, time-range) block
 
     gae_download.py downloads data, and communicates via this method as
@@ -49,9 +77,11 @@ def record_progress(mongo, config, kind, start_dt, end_dt, status):
         kind: datastore entity type
         start_dt, end_dt: backup_timestamp range of the entity type
         status: one of the enum values in DownloadStatus
+        shard: whether the block is a shard of a sharded download, which
+            get_failed_jobs() leaves out
     """
     def _record_progress(mongo, config, kind, start_dt, end_dt, status):
-        key = get_key(kind, start_dt, end_dt)
+        key = get_key(kind, start_dt, end_dt, shard)
         mongo_db = mongo[config['control_db']]
         mongo_collection = mongo_db['ProgressLogs']
         db_doc = mongo_collection.find_one(key)
@@ -61,6 +91,8 @@ def record_progress(mongo, config, kind, start_dt, end_dt, status):
         history[str(status)] = dt.datetime.now()
         doc = {'_id': key, 'kind': kind, 'start_dt': start_dt,
                'end_dt': end_dt, 'status': status, 'history': history}
+        if shard:
+            doc['shard'] = True
         mongo_collection.save(doc)
     func = db_decorator(max_tries=5, func=_record_progress)
     func(mongo, config, kind, start_dt, end_dt, status)
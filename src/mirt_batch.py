@@ -0,0 +1,368 @@
+"""Vectorized likelihood computations for mirt_train_EM.py.
+
+Rather than handing one user at a time to a worker pool, all users'
+responses are packed once into flat, CSR-style arrays (UserResponses):
+the responses of user u are rows offsets[u]:offsets[u + 1] of
+exercises_ind, correct and log_time_taken.  The log likelihood and its
+gradient for everybody are then a handful of numpy operations, with
+per-exercise sums done by np.bincount.
+
+SharedUserState keeps those arrays, and every user's abilities, in
+shared memory created once at load time.  Worker pool processes get it
+when they start (see init_worker), so tasks only name a range of users
+[start, end) to work on: ShardedLikelihood sends the couplings (theta)
+and a user range per shard, and gets back their summed gradients.
+
+sample_abilities_batch is the E-step counterpart: a Metropolis-Hastings
+sampler which proposes and accepts or rejects new abilities for all users
+at once.  Its random numbers come from a counter-based generator keyed on
+(seed, epoch, user, step), so results don't depend on how users are
+split between workers, or on what ran before in a process.
+
+theta here is anything with W_correct, W_time and sigma_time arrays
+shaped like those of assessment.mirt_util.Parameters.
+"""
+
+import ctypes
+import multiprocessing
+
+import numpy as np
+
+
+# The SharedUserState of this worker process; see init_worker.
+_worker_state = None
+
+
+def _sigmoid(X):
+    return 1. / (1. + np.exp(-X))
+
+
+def shared_array(shape, dtype, values=None):
+    """A numpy array backed by shared memory, which processes forked
+    after its creation read and write without copying.
+    """
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    raw = multiprocessing.RawArray(ctypes.c_char,
+                                   max(size, 1) * dtype.itemsize)
+    array = np.frombuffer(raw, dtype=dtype, count=size).reshape(shape)
+    if values is not None:
+        array[...] = values
+    return array
+
+
+class UserResponses(object):
+    """All users' (de-duplicated) responses, packed into flat arrays."""
+
+    def __init__(self, offsets, exercises_ind, correct, log_time_taken):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.exercises_ind = np.asarray(exercises_ind, dtype=np.int64)
+        self.correct = np.asarray(correct, dtype=np.float64)
+        self.log_time_taken = np.asarray(log_time_taken, dtype=np.float64)
+
+    @property
+    def user_ind(self):
+        """The user each response belongs to."""
+        return np.repeat(np.arange(self.num_users), np.diff(self.offsets))
+
+    @classmethod
+    def from_user_states(cls, user_states):
+        """Pack the state dicts made by mirt_train_EM.create_user_state."""
+        lengths = [len(state['exercises_ind']) for state in user_states]
+        offsets = np.zeros(len(user_states) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        def concatenate(field, dtype):
+            if not user_states:
+                return np.zeros(0, dtype=dtype)
+            return np.concatenate([state[field] for state in user_states]
+                                  ).astype(dtype)
+
+        return cls(offsets,
+                   concatenate('exercises_ind', np.int64),
+                   concatenate('correct', np.float64),
+                   concatenate('log_time_taken', np.float64))
+
+    @property
+    def num_users(self):
+        return len(self.offsets) - 1
+
+    @property
+    def num_responses(self):
+        return int(self.offsets[-1])
+
+    def shard(self, start, end):
+        """The responses of users start through end - 1.
+
+        Only the offsets are copied; the rest are views on our arrays.
+        """
+        lo, hi = self.offsets[start], self.offsets[end]
+        return UserResponses(self.offsets[start:end + 1] - lo,
+                             self.exercises_ind[lo:hi],
+                             self.correct[lo:hi],
+                             self.log_time_taken[lo:hi])
+
+    def to_shared(self):
+        """A copy of these responses in shared memory."""
+        return UserResponses(
+            shared_array(self.offsets.shape, np.int64, self.offsets),
+            shared_array(self.exercises_ind.shape, np.int64,
+                         self.exercises_ind),
+            shared_array(self.correct.shape, np.float64, self.correct),
+            shared_array(self.log_time_taken.shape, np.float64,
+                         self.log_time_taken))
+
+    def shard_bounds(self, num_shards):
+        """Split users into num_shards contiguous [start, end) ranges with
+        about the same number of responses in each.
+        """
+        targets = np.linspace(0, self.num_responses, num_shards + 1)
+        bounds = np.searchsorted(self.offsets, targets)
+        bounds[0], bounds[-1] = 0, self.num_users
+        return [(int(start), int(end))
+                for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def L_dL_batch(theta, responses, abilities, correct_only=False):
+    """Negative log likelihood and its gradient wrt the couplings of the
+    mIRT model, summed over every user in responses.
+
+    abilities is a (num_abilities, num_users) array.  Returns
+    (L, dW_correct, dW_time, dsigma_time), without the regularization
+    terms, which mirt_train_EM.L_dL adds.
+    """
+    num_exercises = theta.W_correct.shape[0]
+    ex = responses.exercises_ind
+
+    # pad the abilities with a row of 1s to act as a bias, and line them up
+    # with the responses: one (num_abilities + 1)-vector per response
+    abilities = np.vstack((abilities, np.ones((1, abilities.shape[1]))))
+    abilities = abilities[:, responses.user_ind]
+
+    # the probability of getting each response correct
+    Y = np.einsum('ij,ji->i', theta.W_correct[ex, :], abilities)
+    Z = _sigmoid(Y)
+    Zt = responses.correct
+    pdata = Zt * Z + (1. - Zt) * (1. - Z)
+    dLdY = ((2. * Zt - 1.) * Z * (1. - Z)) / pdata
+
+    L = -np.sum(np.log(pdata))
+    dW_correct = -_per_exercise_outer(ex, dLdY, abilities, num_exercises)
+
+    if correct_only:
+        dW_time = np.zeros(theta.W_time.shape)
+        dsigma_time = np.zeros(theta.sigma_time.shape)
+        return L, dW_correct, dW_time, dsigma_time
+
+    # the probability of taking log_time_taken to answer
+    sigma = theta.sigma_time[ex]
+    Y = np.einsum('ij,ji->i', theta.W_time[ex, :], abilities)
+    err = Y - responses.log_time_taken
+    L += np.sum(err ** 2 / sigma ** 2) / 2.
+    dW_time = _per_exercise_outer(ex, err / sigma ** 2, abilities,
+                                  num_exercises)
+    # normalization for the Gaussian
+    L += np.sum(0.5 * np.log(sigma ** 2))
+    dsigma_time = np.bincount(ex, weights=-err ** 2 / sigma ** 3 + 1. / sigma,
+                              minlength=num_exercises)
+
+    return L, dW_correct, dW_time, dsigma_time
+
+
+def energy_batch(theta, responses, abilities):
+    """Energy (negative log joint probability, up to a constant) of each
+    user's responses and abilities, under a unit Gaussian prior.
+
+    abilities is a (num_abilities, num_users) array; returns a num_users
+    array.  Like mirt_util.sample_abilities_diffusion, this always includes
+    the response time terms.
+    """
+    ex = responses.exercises_ind
+    user_ind = responses.user_ind
+    W_correct = theta.W_correct[ex, :]
+    W_time = theta.W_time[ex, :]
+    # abilities @ couplings, plus the bias column
+    padded = abilities[:, user_ind]
+    Y_correct = (np.einsum('ij,ji->i', W_correct[:, :-1], padded) +
+                 W_correct[:, -1])
+    Y_time = np.einsum('ij,ji->i', W_time[:, :-1], padded) + W_time[:, -1]
+
+    Z = _sigmoid(Y_correct)
+    Zt = responses.correct
+    pdata = Zt * Z + (1. - Zt) * (1. - Z)
+    sigma = theta.sigma_time[ex]
+    err = Y_time - responses.log_time_taken
+    E_response = (-np.log(pdata) + err ** 2 / (2. * sigma ** 2) +
+                  0.5 * np.log(sigma ** 2))
+
+    E = np.bincount(user_ind, weights=E_response,
+                    minlength=responses.num_users)
+    return E + 0.5 * np.sum(abilities ** 2, axis=0)
+
+
+def sample_abilities_batch(theta, responses, abilities, num_steps, epsilon,
+                           seed, first_user=0):
+    """Metropolis-Hastings sample abilities for every user in responses.
+
+    abilities is a (num_abilities, num_users) array of starting points,
+    which is updated in place with the final samples.  Each step proposes
+    a Gaussian move of scale epsilon for all users together, and accepts
+    or rejects each.  User u draws from the random stream (seed,
+    first_user + u); seed can be anything hashable into integers, such
+    as an (option, epoch) tuple.  Returns the final energy of each user.
+    """
+    num_abilities, num_users = abilities.shape
+    users = np.arange(first_user, first_user + num_users, dtype=np.uint64)
+    key = _rng_key(seed)
+    # per step, 2 uniforms per Gaussian (Box-Muller) and 1 to accept
+    draws_per_step = 2 * num_abilities + 1
+
+    E = energy_batch(theta, responses, abilities)
+    for step in xrange(num_steps):
+        counter = step * draws_per_step
+        noise = np.vstack([
+            counter_normal(key, users, counter + 2 * k)
+            for k in xrange(num_abilities)])
+        proposal = abilities + epsilon * noise
+        E_proposal = energy_batch(theta, responses, proposal)
+
+        # accept with probability min(1, exp(E - E_proposal))
+        log_u = np.log(counter_uniform(key, users,
+                                       counter + draws_per_step - 1))
+        accept = log_u < E - E_proposal
+        abilities[:, accept] = proposal[:, accept]
+        E[accept] = E_proposal[accept]
+    return E
+
+
+_MASK64 = 2 ** 64 - 1
+
+
+def _rng_key(seed):
+    """Fold an int, or tuple of ints, into one 64-bit generator key."""
+    if not isinstance(seed, tuple):
+        seed = (seed,)
+    key = 0
+    for part in seed:
+        key = (key * 0x100000001b3 +
+               _mix64_int(int(part) & _MASK64)) & _MASK64
+    return np.uint64(key)
+
+
+def _mix64_int(x):
+    """splitmix64's finalizer, on a python int."""
+    x = (x ^ (x >> 30)) * 0xbf58476d1ce4e5b9 & _MASK64
+    x = (x ^ (x >> 27)) * 0x94d049bb133111eb & _MASK64
+    return x ^ (x >> 31)
+
+
+def _mix64(x):
+    """splitmix64's finalizer, on a uint64 array (wrapping arithmetic)."""
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+def counter_uniform(key, streams, counter):
+    """Uniform (0, 1) draw number counter of each of the random streams.
+
+    A pure function of its arguments: draw i of stream s is the same
+    whether or not other draws or streams are ever generated.
+    """
+    with np.errstate(over='ignore'):
+        x = _mix64(streams * np.uint64(0x9e3779b97f4a7c15) ^ key)
+        x = _mix64(x + np.uint64(counter) * np.uint64(0xd1b54a32d192ed03))
+    # the top 53 bits, centered in their interval so we never return 0
+    return ((x >> np.uint64(11)).astype(np.float64) + 0.5) * 2. ** -53
+
+
+def counter_normal(key, streams, counter):
+    """Standard normal draws from uniform draws counter and counter + 1."""
+    u1 = counter_uniform(key, streams, counter)
+    u2 = counter_uniform(key, streams, counter + 1)
+    return np.sqrt(-2. * np.log(u1)) * np.cos(2. * np.pi * u2)
+
+
+def _per_exercise_outer(ex, dLdY, abilities, num_exercises):
+    """sum over responses r of exercise e of dLdY[r] * abilities[:, r]."""
+    return np.column_stack([
+        np.bincount(ex, weights=dLdY * abilities[k],
+                    minlength=num_exercises)
+        for k in xrange(abilities.shape[0])])
+
+
+class SharedUserState(object):
+    """Every user's responses and abilities, in shared memory.
+
+    abilities is a (num_abilities, num_users) array; column u holds the
+    abilities of the user whose responses are responses.shard(u, u + 1).
+    """
+
+    def __init__(self, responses, abilities):
+        self.responses = responses
+        self.abilities = abilities
+
+    @classmethod
+    def from_user_states(cls, user_states, num_abilities):
+        """Pack the state dicts made by mirt_train_EM.create_user_state."""
+        responses = UserResponses.from_user_states(user_states).to_shared()
+        abilities = shared_array((num_abilities, len(user_states)),
+                                 np.float64)
+        for u, state in enumerate(user_states):
+            abilities[:, u] = state['abilities'][:, 0]
+        return cls(responses, abilities)
+
+    @property
+    def num_users(self):
+        return self.responses.num_users
+
+
+def init_worker(state):
+    """Pool initializer: remember the SharedUserState for tasks to use.
+
+    Pass it as Pool(initializer=init_worker, initargs=(state,)); the shared
+    memory is inherited by the workers rather than pickled.
+    """
+    global _worker_state
+    _worker_state = state
+
+
+def worker_state():
+    """The SharedUserState given to init_worker in this process."""
+    return _worker_state
+
+
+def _L_dL_shard(args):
+    theta, start, end, correct_only = args
+    state = _worker_state
+    return L_dL_batch(theta, state.responses.shard(start, end),
+                      state.abilities[:, start:end], correct_only)
+
+
+class ShardedLikelihood(object):
+    """L_dL_batch over all users, split between pool workers by user range.
+
+    The pool must have been started with init_worker(state).  Abilities are
+    read from the shared state at each call, so they need no shipping after
+    an E-step.  With pool=None everything is computed in this process.
+    """
+
+    def __init__(self, state, pool, num_shards, correct_only=False):
+        self.state = state
+        self.pool = pool
+        self.correct_only = correct_only
+        self.bounds = state.responses.shard_bounds(max(num_shards, 1))
+
+    @property
+    def num_users(self):
+        return self.state.num_users
+
+    def L_dL(self, theta):
+        """(L, dW_correct, dW_time, dsigma_time) summed over all users."""
+        if self.pool is None:
+            return L_dL_batch(theta, self.state.responses,
+                              self.state.abilities, self.correct_only)
+        results = self.pool.map(_L_dL_shard,
+                                [(theta, start, end, self.correct_only)
+                                 for start, end in self.bounds])
+        return tuple(sum(parts) for parts in zip(*results))
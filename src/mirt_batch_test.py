@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+import multiprocessing
+import unittest
+
+import numpy as np
+
+import mirt_batch
+
+
+NUM_ABILITIES = 2
+NUM_EXERCISES = 7
+
+
+class Theta(object):
+    """Stand-in for assessment.mirt_util.Parameters."""
+    def __init__(self, rng):
+        self.num_abilities = NUM_ABILITIES
+        self.num_exercises = NUM_EXERCISES
+        self.W_correct = rng.randn(NUM_EXERCISES, NUM_ABILITIES + 1)
+        self.W_time = rng.randn(NUM_EXERCISES, NUM_ABILITIES + 1)
+        self.sigma_time = 0.5 + rng.rand(NUM_EXERCISES)
+
+
+def make_user_states(rng, num_users):
+    user_states = []
+    for _ in xrange(num_users):
+        n = rng.randint(1, NUM_EXERCISES + 1)
+        user_states.append({
+            'exercises_ind': rng.permutation(NUM_EXERCISES)[:n],
+            'correct': rng.randint(0, 2, n),
+            'log_time_taken': np.log(rng.randint(1, 100, n)),
+            'abilities': rng.randn(NUM_ABILITIES, 1),
+        })
+    return user_states
+
+
+def L_dL_per_user(theta, state):
+    """The per-user computation the batch version replaces."""
+    abilities = np.append(state['abilities'], [[1.]], axis=0)
+    ex = state['exercises_ind']
+    Z = mirt_batch._sigmoid(np.dot(theta.W_correct[ex, :], abilities))
+    Zt = state['correct'].reshape(Z.shape)
+    pdata = Zt * Z + (1. - Zt) * (1. - Z)
+    dLdY = ((2. * Zt - 1.) * Z * (1. - Z)) / pdata
+    L = -np.sum(np.log(pdata))
+    dW_correct = -np.dot(dLdY, abilities.T)
+
+    sigma = theta.sigma_time[ex].reshape((-1, 1))
+    err = (np.dot(theta.W_time[ex, :], abilities) -
+           state['log_time_taken'].reshape((-1, 1)))
+    L += np.sum(err ** 2 / sigma ** 2) / 2. + np.sum(0.5 * np.log(sigma ** 2))
+    dW_time = np.dot(err / sigma ** 2, abilities.T)
+    dsigma_time = (-err ** 2 / sigma ** 3).ravel() + 1. / sigma.ravel()
+    return L, dW_correct, dW_time, dsigma_time
+
+
+class BatchLikelihoodTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.theta = Theta(rng)
+        self.user_states = make_user_states(rng, 50)
+        self.responses = mirt_batch.UserResponses.from_user_states(
+            self.user_states)
+        self.abilities = np.hstack([s['abilities'] for s in self.user_states])
+
+    def expected(self):
+        L = 0.
+        dW_correct = np.zeros(self.theta.W_correct.shape)
+        dW_time = np.zeros(self.theta.W_time.shape)
+        dsigma_time = np.zeros(self.theta.sigma_time.shape)
+        for state in self.user_states:
+            Lu, dWc, dWt, ds = L_dL_per_user(self.theta, state)
+            ex = state['exercises_ind']
+            L += Lu
+            dW_correct[ex, :] += dWc
+            dW_time[ex, :] += dWt
+            dsigma_time[ex] += ds
+        return L, dW_correct, dW_time, dsigma_time
+
+    def assert_results_equal(self, expected, actual):
+        self.assertEqual(len(expected), len(actual))
+        for e, a in zip(expected, actual):
+            np.testing.assert_allclose(e, a)
+
+    def test_matches_per_user(self):
+        self.assert_results_equal(self.expected(), mirt_batch.L_dL_batch(
+            self.theta, self.responses, self.abilities))
+
+    def test_correct_only(self):
+        L, dW_correct, dW_time, dsigma_time = mirt_batch.L_dL_batch(
+            self.theta, self.responses, self.abilities, correct_only=True)
+        self.assertFalse(dW_time.any() or dsigma_time.any())
+        np.testing.assert_allclose(self.expected()[1], dW_correct)
+
+    def test_shard_bounds(self):
+        bounds = self.responses.shard_bounds(3)
+        self.assertEqual(0, bounds[0][0])
+        self.assertEqual(50, bounds[-1][1])
+        for (_, end), (start, _) in zip(bounds[:-1], bounds[1:]):
+            self.assertEqual(end, start)
+
+    def test_sharded_workers(self):
+        state = mirt_batch.SharedUserState.from_user_states(
+            self.user_states, NUM_ABILITIES)
+        pool = multiprocessing.Pool(3, initializer=mirt_batch.init_worker,
+                                    initargs=(state,))
+        try:
+            likelihood = mirt_batch.ShardedLikelihood(state, pool, 5)
+            self.assertEqual(50, likelihood.num_users)
+            self.assert_results_equal(self.expected(),
+                                      likelihood.L_dL(self.theta))
+
+            # Workers see abilities updated in shared memory
+            state.abilities *= -1
+            for s in self.user_states:
+                s['abilities'] *= -1
+            self.assert_results_equal(self.expected(),
+                                      likelihood.L_dL(self.theta))
+        finally:
+            pool.terminate()
+
+    def test_shared_state(self):
+        state = mirt_batch.SharedUserState.from_user_states(
+            self.user_states, NUM_ABILITIES)
+        np.testing.assert_array_equal(self.abilities, state.abilities)
+        user = state.responses.shard(3, 4)
+        np.testing.assert_array_equal(self.user_states[3]['exercises_ind'],
+                                      user.exercises_ind)
+
+
+class SamplerTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(1)
+        self.theta = Theta(rng)
+        self.user_states = make_user_states(rng, 40)
+        self.responses = mirt_batch.UserResponses.from_user_states(
+            self.user_states)
+        self.abilities = np.hstack([s['abilities'] for s in self.user_states])
+
+    def sample(self, abilities, start, end, seed=(0, 3), num_steps=20):
+        return mirt_batch.sample_abilities_batch(
+            self.theta, self.responses.shard(start, end),
+            abilities[:, start:end], num_steps, 0.5, seed, first_user=start)
+
+    def test_energy(self):
+        # compare with energy of one user computed directly
+        E = mirt_batch.energy_batch(self.theta, self.responses,
+                                    self.abilities)
+        user = self.user_states[7]
+        Lu = L_dL_per_user(self.theta, user)[0]
+        self.assertAlmostEqual(
+            Lu + 0.5 * np.sum(user['abilities'] ** 2), E[7])
+
+    def test_independent_of_sharding(self):
+        whole = self.abilities.copy()
+        E_whole = self.sample(whole, 0, 40)
+        pieces = self.abilities.copy()
+        E_pieces = np.concatenate([self.sample(pieces, 0, 15),
+                                   self.sample(pieces, 15, 40)])
+        np.testing.assert_array_equal(whole, pieces)
+        np.testing.assert_array_equal(E_whole, E_pieces)
+        # and the returned energies are those of the samples
+        np.testing.assert_allclose(E_whole, mirt_batch.energy_batch(
+            self.theta, self.responses, whole))
+
+    def test_seed_changes_samples(self):
+        a = self.abilities.copy()
+        b = self.abilities.copy()
+        self.sample(a, 0, 40, seed=(0, 3))
+        self.sample(b, 0, 40, seed=(0, 4))
+        self.assertFalse(np.array_equal(a, b))
+        self.assertFalse(np.array_equal(a, self.abilities))
+
+    def test_counter_rng(self):
+        key = mirt_batch._rng_key((5, 6))
+        streams = np.arange(20000, dtype=np.uint64)
+        u = mirt_batch.counter_uniform(key, streams, 3)
+        self.assertTrue(np.all((u > 0) & (u < 1)))
+        self.assertAlmostEqual(0.5, np.mean(u), places=2)
+        np.testing.assert_array_equal(
+            u[100:200], mirt_batch.counter_uniform(key, streams[100:200], 3))
+        normal = mirt_batch.counter_normal(key, streams, 0)
+        self.assertAlmostEqual(0., np.mean(normal), places=1)
+        self.assertAlmostEqual(1., np.std(normal), places=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
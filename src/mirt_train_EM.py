@@ -25,7 +25,6 @@ import optparse
 import scipy
 import scipy.optimize
 import sys
-import time
 
 # necessary to do this after importing numpy to take avantage of
 # multiple cores on unix
@@ -34,12 +33,17 @@ affinity.set_process_affinity_mask(0, 2 ** multiprocessing.cpu_count() - 1)
 # the following is imported the Khan web application source
 import accuracy_model_util as acc_util
 from assessment import mirt_util
+import mirt_batch
 
 
 # used to index the fields in with a line of text in the input data file
 linesplit = acc_util.linesplit
 idx_pl = acc_util.FieldIndexer(acc_util.FieldIndexer.plog_fields)
 
+# the default of mirt_util.sample_abilities_diffusion, which the E-step
+# sampled with before it was batched, so runs without -l behave as before
+DEFAULT_SAMPLING_EPSILON = 0.5
+
 
 # num_exercises and generate_exercise_ind are used in the creation of a
 # defaultdict for mapping exercise names to an unique integer index
@@ -54,35 +58,29 @@ def generate_exercise_ind():
 
 
 def sample_abilities_diffusion(args):
-    """Sample the ability vector for this user, from the posterior over user
-    ability conditioned on the observed exercise performance.
-    use Metropolis-Hastings with Gaussian proposal distribution.
-
-    This is just a wrapper around the corresponding function in mirt_util.
+    """Sample the ability vectors for users start through end - 1, from the
+    posterior over user ability conditioned on the observed exercise
+    performance.  use Metropolis-Hastings with Gaussian proposal
+    distribution.
+
+    The users' responses and abilities come from the shared state given to
+    mirt_batch.init_worker, and the new abilities are written back to it.
+    All the users are sampled together by mirt_batch.sample_abilities_batch,
+    each with its own random stream for this epoch.  Returns the summed
+    energy of the users.
     """
     # TODO(jascha) make this a better sampler (eg, use the HMC sampler from
     # TMIRT)
+    theta, options, epoch, start, end = args
+    state = mirt_batch.worker_state()
 
-    # make sure each student gets a different random sequence
-    id = multiprocessing.current_process()._identity
-    if len(id) > 0:
-        np.random.seed([id[0], time.time() * 1e9])
-    else:
-        np.random.seed([time.time() * 1e9])
-
-    theta, state, options, user_index = args
-    abilities = state['abilities']
-    correct = state['correct']
-    log_time_taken = state['log_time_taken']
-    exercises_ind = state['exercises_ind']
+    E = mirt_batch.sample_abilities_batch(
+            theta, state.responses.shard(start, end),
+            state.abilities[:, start:end], options.sampling_num_steps,
+            options.sampling_epsilon, seed=(options.seed, epoch),
+            first_user=start)
 
-    num_steps = options.sampling_num_steps
-
-    abilities, Eabilities, _, _ = mirt_util.sample_abilities_diffusion(
-            theta, exercises_ind, correct, log_time_taken,
-            abilities, num_steps)
-
-    return abilities, Eabilities, user_index
+    return np.sum(E)
 
 
 def get_cmd_line_options():
@@ -92,9 +90,15 @@ def get_cmd_line_options():
     parser.add_option("-s", "--sampling_num_steps", type=int, default=50,
                       help=("Number of sampling steps to use for "
                             "sample_abilities_diffusion"))
-    parser.add_option("-l", "--sampling_epsilon", type=float, default=0.1,
+    parser.add_option("-l", "--sampling_epsilon", type=float,
+                      default=DEFAULT_SAMPLING_EPSILON,
                       help=("The length scale to use for sampling update "
-                            "proposals"))
+                            "proposals.  Defaults to %r" %
+                            DEFAULT_SAMPLING_EPSILON))
+    parser.add_option("-d", "--seed", type=int, default=0,
+                      help=("Seed for the random initial abilities and the "
+                            "ability sampler.  Defaults to 0, so every run "
+                            "is identical unless a different seed is given"))
     parser.add_option("-n", "--num_epochs", type=int, default=10000,
                       help=("The number of EM iterations to do during "
                             "learning"))
@@ -183,63 +187,18 @@ def create_user_state(lines, exercise_ind_dict, options):
     return state
 
 
-def L_dL_singleuser(arg):
+def L_dL(theta_flat, likelihood, num_exercises, options):
     """ calculate log likelihood and gradient wrt couplings of mIRT model
-        for single user """
-    theta, state, options = arg
-
-    abilities = state['abilities'].copy()
-    correct = state['correct']
-    exercises_ind = state['exercises_ind']
-
-    dL = mirt_util.Parameters(theta.num_abilities, len(exercises_ind))
-
-    # pad the abilities vector with a 1 to act as a bias
-    abilities = np.append(abilities.copy(),
-                          np.ones((1, abilities.shape[1])),
-                          axis=0)
-    # the abilities to exercise coupling parameters for this exercise
-    W_correct = theta.W_correct[exercises_ind, :]
-
-    # calculate the probability of getting a question in this exercise correct
-    Y = np.dot(W_correct, abilities)
-    Z = mirt_util.sigmoid(Y)  # predicted correctness value
-    Zt = correct.reshape(Z.shape)  # true correctness value
-    pdata = Zt * Z + (1. - Zt) * (1. - Z)  # = 2*Zt*Z - Z + const
-    dLdY = ((2. * Zt - 1.) * Z * (1. - Z)) / pdata
-
-    L = -np.sum(np.log(pdata))
-    dL.W_correct = -np.dot(dLdY, abilities.T)
-
-    if not options.correct_only:
-        # calculate the probability of taking time response_time to answer
-        log_time_taken = state['log_time_taken']
-        # the abilities to time coupling parameters for this exercise
-        W_time = theta.W_time[exercises_ind, :]
-        sigma = theta.sigma_time[exercises_ind].reshape((-1, 1))
-        Y = np.dot(W_time, abilities)
-        err = (Y - log_time_taken.reshape((-1, 1)))
-        L += np.sum(err ** 2 / sigma ** 2) / 2.
-        dLdY = err / sigma ** 2
-
-        dL.W_time = np.dot(dLdY, abilities.T)
-        dL.sigma_time = (-err ** 2 / sigma ** 3).ravel()
 
-        # normalization for the Gaussian
-        L += np.sum(0.5 * np.log(sigma ** 2))
-        dL.sigma_time += 1. / sigma.ravel()
-
-    return L, dL, exercises_ind
-
-
-def L_dL(theta_flat, user_states, num_exercises, options, pool):
-    """ calculate log likelihood and gradient wrt couplings of mIRT model """
+    likelihood is a mirt_batch.ShardedLikelihood holding the responses and
+    current abilities of every user.
+    """
 
     L = 0.
     theta = mirt_util.Parameters(options.num_abilities, num_exercises,
                                  vals=theta_flat.copy())
 
-    nu = float(len(user_states))
+    nu = float(likelihood.num_users)
 
     # note that the nu gets divided back out below, so the regularization term
     # does not end up with a factor of nu.
@@ -252,21 +211,11 @@ def L_dL(theta_flat, user_states, num_exercises, options, pool):
     L += np.sum(options.regularization * nu / theta.sigma_time ** 2)
     dL.sigma_time += -2. * options.regularization * nu / theta.sigma_time ** 3
 
-    # TODO(jascha) this would be faster if user_states was divided into
-    # minibatches instead of single students
-    if pool is None:
-        rslts = map(L_dL_singleuser,
-                    [(theta, state, options) for state in user_states])
-    else:
-        rslts = pool.map(L_dL_singleuser,
-                         [(theta, state, options) for state in user_states],
-                         chunksize=100)
-    for r in rslts:
-        Lu, dLu, exercise_indu = r
-        L += Lu
-        dL.W_correct[exercise_indu, :] += dLu.W_correct
-        dL.W_time[exercise_indu, :] += dLu.W_time
-        dL.sigma_time[exercise_indu] += dLu.sigma_time
+    Lu, dW_correct, dW_time, dsigma_time = likelihood.L_dL(theta)
+    L += Lu
+    dL.W_correct += dW_correct
+    dL.W_time += dW_time
+    dL.sigma_time += dsigma_time
 
     if options.correct_only:
         dL.W_time[:, :] = 0.
@@ -340,9 +289,7 @@ def main():
     options = get_cmd_line_options()
     print >>sys.stderr, "Starting main.", options  # DEBUG
 
-    pool = None
-    if options.workers > 0:
-        pool = Pool(options.workers)
+    np.random.seed(options.seed)
 
     exercise_ind_dict = defaultdict(generate_exercise_ind)
 
@@ -423,6 +370,26 @@ def main():
         print >>sys.stderr, "Loaded parameters from %s" % (
             options.resume_from_file)
 
+    # Pack everybody's responses and abilities into shared memory once.
+    # The pool is started afterwards, so its workers inherit them, and tasks
+    # only name a range of users.
+    state = mirt_batch.SharedUserState.from_user_states(
+        user_states, options.num_abilities)
+    num_users = state.num_users
+    if not options.emit_features:
+        user_states = user_states_train = user_states_test = None
+
+    mirt_batch.init_worker(state)
+    pool = None
+    if options.workers > 0:
+        pool = Pool(options.workers, initializer=mirt_batch.init_worker,
+                    initargs=(state,))
+    # a few shards per worker, so that uneven shards even out
+    num_shards = max(options.workers, 1) * 4
+    shard_bounds = state.responses.shard_bounds(num_shards)
+    likelihood = mirt_batch.ShardedLikelihood(
+        state, pool, num_shards, options.correct_only)
+
     # now do num_epochs EM steps
     for epoch in range(options.num_epochs):
         print >>sys.stderr, "epoch %d, " % epoch,
@@ -430,37 +397,24 @@ def main():
         # Expectation step
         # Compute (and print) the energies during learning as a diagnostic.
         # These should decrease.
-        Eavg = 0.
-        # TODO(jascha) this would be faster if user_states was divided into
-        # minibatches instead of single students
+        tasks = [(theta, options, epoch, start, end)
+                 for start, end in shard_bounds]
         if pool is None:
-            rslts = map(sample_abilities_diffusion,
-                        [(theta, user_states[ind], options, ind)
-                            for ind in range(len(user_states))])
+            rslts = map(sample_abilities_diffusion, tasks)
         else:
-            rslts = pool.map(sample_abilities_diffusion,
-                            [(theta, user_states[ind], options, ind)
-                                for ind in range(len(user_states))],
-                            chunksize=100)
-        for r in rslts:
-            abilities, El, ind = r
-            user_states[ind]['abilities'] = abilities.copy()
-            Eavg += El / float(len(user_states))
+            rslts = pool.map(sample_abilities_diffusion, tasks)
+        Eavg = sum(rslts) / float(num_users)
         print >>sys.stderr, "E joint log L + const %f, " % (
                 -Eavg / np.log(2.)),
 
         # debugging info -- accumulate mean and covariance of abilities vector
-        mn_a = 0.
-        cov_a = 0.
-        for state in user_states:
-            mn_a += state['abilities'][:, 0].T / float(len(user_states))
-            cov_a += (state['abilities'][:, 0] ** 2).T / (
-                        float(len(user_states)))
+        mn_a = np.mean(state.abilities, axis=1)
+        cov_a = np.mean(state.abilities ** 2, axis=1)
         print >>sys.stderr, "<abilities>", mn_a,
         print >>sys.stderr, ", <abilities^2>", cov_a, ", ",
 
-        # check_grad(L_dL, theta.flat(), args=(user_states,
-        #     num_exercises, options, pool))
+        # check_grad(L_dL, theta.flat(), args=(likelihood,
+        #     num_exercises, options))
 
         # Maximization step
         old_theta_flat = theta.flat()
@@ -468,7 +422,7 @@ def main():
         theta_flat, L, _ = scipy.optimize.fmin_l_bfgs_b(
             L_dL,
             theta.flat(),
-            args=(user_states, num_exercises, options, pool),
+            args=(likelihood, num_exercises, options),
             disp=0,
             maxfun=options.max_pass_lbfgs, m=100)
         theta = mirt_util.Parameters(options.num_abilities, num_exercises,
@@ -496,8 +450,7 @@ def main():
         # Then, flip ability and coupling sign for dimenions w/ negative mean.
         theta.W_correct[:, :-1] *= coupling_sign
         theta.W_time[:, :-1] *= coupling_sign
-        for user_state in user_states:
-            user_state['abilities'] *= coupling_sign.T
+        state.abilities *= coupling_sign.T
 
         # save state as a .npz
         np.savez("%s_epoch=%d.npz" % (options.output, epoch),
@@ -529,6 +482,9 @@ def main():
             print >>f1, nm
         f1.close()
 
+    if pool is not None:
+        pool.close()
+
     if options.emit_features:
         if options.training_set_size < 1.0:
             emit_features(user_states_test, theta, options, "test")